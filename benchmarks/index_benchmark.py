@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# index_benchmark.py: Compare recall, latency and size of search indexes
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measures recall, latency and size of every type of search index
+
+The embeddings are read from a trained model, or generated randomly. The
+exact index is used as ground truth:
+
+    python3 benchmarks/index_benchmark.py --model datasets/wd_model.bin \\
+        --types annoy ivf pq
+    python3 benchmarks/index_benchmark.py --random 100000 100
+
+With --target-recall, the fastest search_k of each type that reaches that
+recall is shown at the end, to compare latencies at equal recall:
+
+    python3 benchmarks/index_benchmark.py --random 100000 200 \
+        --types annoy reduced --search-k -1 1000 5000 20000 \
+        --type-params '{"reduced": {"n_components": 32}}' \
+        --target-recall 0.9
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import timeit
+import numpy as np
+from kgeserver import index
+from kgeserver import tuning
+
+
+def folder_size(path):
+    """Returns the size in bytes of a file, or all the files of a folder"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, names in os.walk(path) for name in names)
+
+
+def recall(found, expected):
+    """Returns the mean fraction of expected neighbours that were found"""
+    return np.mean([len(set(row_found) & set(row_expected)) /
+                    float(len(row_expected))
+                    for row_found, row_expected in zip(found, expected)])
+
+
+def measure(search_index, queries, k, search_k):
+    """Returns the results and the latency (ms) of each query"""
+    results, latencies = [], []
+    for item in queries:
+        start = timeit.default_timer()
+        ids, distances = search_index.query_item(item, k, search_k=search_k)
+        latencies.append((timeit.default_timer() - start) * 1000)
+        results.append(ids)
+    return results, np.array(latencies)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", help="A trained model (skge format)")
+    parser.add_argument("--random", nargs=2, type=int, metavar=("N", "F"),
+                        help="Use N random vectors of size F")
+    parser.add_argument("--types", nargs="+", default=["annoy", "ivf", "pq"])
+    parser.add_argument("--params", default="{}",
+                        help="JSON with build params, e.g. '{\"n_trees\": 50}'")
+    parser.add_argument("--type-params", default="{}",
+                        help="JSON with build params of each type, e.g. "
+                        "'{\"reduced\": {\"n_components\": 32}}'")
+    parser.add_argument("--target-recall", type=float,
+                        help="Show the fastest setting with this recall")
+    parser.add_argument("--search-k", nargs="+", type=int, default=[-1])
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.model:
+        import skge
+        embeddings = skge.TransE.load(args.model).E
+    elif args.random:
+        embeddings = np.random.RandomState(0).normal(size=args.random)
+    else:
+        parser.error("Either --model or --random is required")
+    params = json.loads(args.params)
+    type_params = json.loads(args.type_params)
+
+    random = np.random.RandomState(137)
+    queries = random.choice(embeddings.shape[0],
+                            min(args.queries, embeddings.shape[0]),
+                            replace=False).tolist()
+    exact = index.build_index("exact", embeddings)
+    expected = exact.batch_query_items(queries, args.k)[0]
+
+    print("{} vectors of size {}, float64 matrix: {:.1f} MB".format(
+        embeddings.shape[0], embeddings.shape[1],
+        embeddings.astype(np.float64).nbytes / 2 ** 20))
+    print("{:>8} {:>9} {:>8} {:>10} {:>10} {:>10} {:>9}".format(
+        "type", "search_k", "recall", "mean ms", "p99 ms", "size MB",
+        "build s"))
+    workdir = tempfile.mkdtemp()
+    curves = {}
+    try:
+        for index_type in args.types:
+            start = timeit.default_timer()
+            search_index = index.build_index(
+                index_type, embeddings,
+                **dict(params, **type_params.get(index_type, {})))
+            build_time = timeit.default_timer() - start
+            path = os.path.join(workdir, index_type)
+            search_index.save(path)
+            search_index = index.load_index(path, embeddings.shape[1])
+            size = folder_size(path) / 2 ** 20
+
+            curves[index_type] = []
+            for search_k in args.search_k:
+                found, latencies = measure(search_index, queries, args.k,
+                                           search_k)
+                curves[index_type].append({
+                    "search_k": search_k,
+                    "recall": recall(found, expected),
+                    "mean_ms": latencies.mean()})
+                print("{:>8} {:>9} {:>8.4f} {:>10.3f} {:>10.3f} {:>10.1f} "
+                      "{:>9.1f}".format(index_type, search_k,
+                                        recall(found, expected),
+                                        latencies.mean(),
+                                        np.percentile(latencies, 99),
+                                        size, build_time))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.target_recall is not None:
+        print("Fastest settings with recall >= {}:".format(
+            args.target_recall))
+        for index_type, curve in curves.items():
+            point = tuning.choose_settings(curve, args.target_recall)
+            reached = point["recall"] >= args.target_recall
+            print("{:>8}: search_k {:>7}, recall {:.4f}, {:.3f} ms{}".format(
+                index_type, point["search_k"], point["recall"],
+                point["mean_ms"], "" if reached else " (not reached)"))
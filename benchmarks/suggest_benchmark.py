@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# suggest_benchmark.py: Compare latency of local and Elasticsearch autocomplete
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measures the latency of entity name suggestions
+
+Queries are prefixes (1 to 6 characters) of labels stored on the local
+autocomplete index. If a dataset id is given, the same queries are also sent
+to Elasticsearch through EntityDAO, so it must be executed where the
+service is able to reach Elasticsearch:
+
+    python3 benchmarks/suggest_benchmark.py datasets/wd/wd_1234_suggest \\
+        --dataset-id 3 --dataset-type WikidataDataset
+"""
+import os
+import sys
+import random
+import argparse
+import timeit
+import numpy as np
+from kgeserver.autocomplete import PrefixIndex, _unpack_string
+
+
+def measure(function, queries):
+    """Returns the latency (ms) of each call to function"""
+    latencies = []
+    for query in queries:
+        start = timeit.default_timer()
+        function(query)
+        latencies.append((timeit.default_timer() - start) * 1000)
+    return np.array(latencies)
+
+
+def report(name, latencies):
+    print("{:>15}: mean {:.3f} ms, p50 {:.3f} ms, p95 {:.3f} ms, "
+          "p99 {:.3f} ms".format(name, latencies.mean(),
+                                 np.percentile(latencies, 50),
+                                 np.percentile(latencies, 95),
+                                 np.percentile(latencies, 99)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("suggest_folder", help="Local autocomplete index")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=10)
+    parser.add_argument("--dataset-id", default=None)
+    parser.add_argument("--dataset-type", default="WikidataDataset")
+    args = parser.parse_args()
+
+    prefix_index = PrefixIndex()
+    prefix_index.load_from_folder(args.suggest_folder)
+
+    random.seed(137)
+    n_labels = len(prefix_index.text_offsets) - 1
+    queries = []
+    for _ in range(args.queries):
+        label = _unpack_string(prefix_index.texts, prefix_index.text_offsets,
+                               random.randrange(n_labels))
+        queries.append(label[:random.randint(1, 6)])
+
+    report("local", measure(
+        lambda q: prefix_index.suggest(q, size=args.size), queries))
+
+    if args.dataset_id is not None:
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                        "rest-service"))
+        import data_access
+        entity_dao = data_access.EntityDAO(args.dataset_type, args.dataset_id)
+        report("elasticsearch", measure(
+            lambda q: entity_dao.suggest_entity(q, size=args.size), queries))
@@ -15,4 +15,11 @@ echo "$WORKING_DIR_EX"
 echo "*** Launch gunicorn"
 export SQLITE_DATABASE_FILE_PATH="$DATASETS_PATH/server.db"
 export $DATASETS_PATH
-exec gunicorn -b 0.0.0.0:8000 routes:app -w 4 --threads 4 --reload -t 120 --log-level debug --access-logfile '-'
+# With PRELOAD_INDEXES=true datasets are loaded once before forking workers,
+# so all of them share the same memory. Reloading is not compatible with it
+if [ "${PRELOAD_INDEXES,,}" = "true" ]; then
+    GUNICORN_LOAD="--preload"
+else
+    GUNICORN_LOAD="--reload"
+fi
+exec gunicorn -b 0.0.0.0:8000 routes:app -w 4 --threads 4 $GUNICORN_LOAD -t 120 --log-level debug --access-logfile '-'
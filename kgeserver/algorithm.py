@@ -54,6 +54,68 @@ class HolEEval(experiment.FilteredRankingEval):
     def scores_s(self, mdl, o, p):
         return np.dot(mdl.E, self.ER[o])
 
+    def batch_scores_o(self, mdl, ss, p):
+        return np.dot(mdl.E[ss], self.ER.T)
+
+    def batch_scores_s(self, mdl, os, p):
+        return np.dot(self.ER[os], mdl.E.T)
+
+
+def fold_in_entities(E, R, triples, n_entities, iterations=3):
+    """Estimates TransE embeddings of the entities added after training
+
+    With TransE, the object of a triple is close to subject + predicate.
+    Each new entity is placed on the mean of E[s] + R[p] of its triples
+    (s, entity, p) and E[o] - R[p] of its triples (entity, o, p), using the
+    entities that already have an embedding. Entities only linked to other
+    new entities get one on the next iterations.
+
+    :param np.ndarray E: The embeddings of the entities of the model
+    :param np.ndarray R: The embeddings of the relations of the model
+    :param list triples: The triples of the dataset, as (s, o, p) ids
+    :param int n_entities: The number of entities of the dataset
+    :param int iterations: The maximum number of iterations
+    :return: A (n_entities - len(E), ncomp) matrix, with the embedding of
+             entity len(E) + i on row i. Entities without any triple with
+             known entities are left as zero
+    :rtype: np.ndarray
+    """
+    first_id = E.shape[0]
+    delta = np.zeros((n_entities - first_id, E.shape[1]))
+    known = np.zeros(n_entities, dtype=bool)
+    known[:first_id] = True
+
+    # Triples with relations added after training can't be used
+    triples = np.asarray(triples, dtype=np.int64).reshape(-1, 3)
+    triples = triples[triples[:, 2] < R.shape[0]]
+    subs, objs, preds = triples[:, 0], triples[:, 1], triples[:, 2]
+
+    def vectors(ids):
+        old = ids < first_id
+        result = np.empty((len(ids), E.shape[1]))
+        result[old] = E[ids[old]]
+        result[~old] = delta[ids[~old] - first_id]
+        return result
+
+    for _ in range(iterations):
+        sums = np.zeros_like(delta)
+        counts = np.zeros(len(delta))
+        as_object = known[subs] & ~known[objs]
+        np.add.at(sums, objs[as_object] - first_id,
+                  vectors(subs[as_object]) + R[preds[as_object]])
+        np.add.at(counts, objs[as_object] - first_id, 1)
+        as_subject = known[objs] & ~known[subs]
+        np.add.at(sums, subs[as_subject] - first_id,
+                  vectors(objs[as_subject]) - R[preds[as_subject]])
+        np.add.at(counts, subs[as_subject] - first_id, 1)
+
+        found = counts > 0
+        if not found.any():
+            break
+        delta[found] = sums[found] / counts[found, None]
+        known[first_id:] |= found
+    return delta
+
 
 class ModelTrainer(experiment.Experiment):
     """Creates a Model from a dataset and trains it"""
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# Autocomplete class: local prefix index to suggest entity names
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import json
+import unicodedata
+import numpy as np
+
+
+def normalize(text):
+    """Returns the text ASCII-folded, lowercased and without extra spaces
+
+    :param str text: The text to normalize
+    :return: The normalized text
+    :rtype: str
+    """
+    text = unicodedata.normalize('NFKD', text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(text.lower().split())
+
+
+def _pack_strings(strings):
+    """Packs a list of strings in a byte array and an offsets array"""
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in encoded])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return blob, offsets
+
+
+def _unpack_string(blob, offsets, position):
+    """Returns the string on the given position of a packed array"""
+    start, end = offsets[position], offsets[position + 1]
+    return bytes(blob[start:end]).decode('utf-8')
+
+
+class PrefixIndex():
+    """Autocomplete engine based on a sorted array of labels
+
+    All labels and alt labels of the entities are normalized and stored on
+    a sorted array of fixed size strings, which allows to find every label
+    starting with a prefix using binary search. Results are ranked by the
+    score of the entity (usually its degree on the dataset graph).
+
+    All arrays are saved as ``.npy`` files inside a folder, and are loaded
+    as memory mapped arrays, so they are shared between processes.
+    """
+    # Labels longer than this are truncated on the sorted array
+    MAX_KEY_LENGTH = 64
+
+    def __init__(self):
+        self.keys = None        # Sorted normalized labels
+        self.key_doc = None     # Document of each label
+        self.texts = None       # Original text of each label (packed)
+        self.text_offsets = None
+        self.scores = None      # Score of each document
+        self.docs = None        # JSON documents (packed)
+        self.doc_offsets = None
+
+    def build(self, documents, scores):
+        """Builds the index from a list of entity documents
+
+        The documents are the same dicts stored on the search database. Its
+        ``label`` and ``alt_label`` fields will be used as suggestions.
+
+        :param list documents: The entity documents
+        :param list scores: The score of each document, same order
+        """
+        keys = []
+        key_doc = []
+        texts = []
+        seen = set()
+        for doc_id, document in enumerate(documents):
+            suggestions = list(document['label'].values()) +\
+                [alt for alts in document['alt_label'].values()
+                 for alt in alts]
+            for text in suggestions:
+                key = normalize(text).encode('utf-8')[:self.MAX_KEY_LENGTH]
+                if not key or (key, doc_id) in seen:
+                    continue
+                seen.add((key, doc_id))
+                keys.append(key)
+                key_doc.append(doc_id)
+                texts.append(text)
+
+        key_length = max([len(key) for key in keys] + [1])
+        keys = np.array(keys, dtype='S{}'.format(key_length))
+        order = np.argsort(keys, kind='mergesort')
+
+        self.keys = keys[order]
+        self.key_doc = np.array(key_doc, dtype=np.int32)[order]
+        self.texts, self.text_offsets = _pack_strings(
+            [texts[position] for position in order])
+        self.scores = np.asarray(scores, dtype=np.float32)
+        self.docs, self.doc_offsets = _pack_strings(
+            [json.dumps(document) for document in documents])
+
+    def save_to_folder(self, folder):
+        """Saves all the arrays of the index inside a folder
+
+        :param str folder: The path of the folder
+        """
+        os.makedirs(folder, exist_ok=True)
+        for name in ('keys', 'key_doc', 'texts', 'text_offsets', 'scores',
+                     'docs', 'doc_offsets'):
+            np.save(os.path.join(folder, name + ".npy"), getattr(self, name))
+        return True
+
+    def load_from_folder(self, folder):
+        """Loads (memory mapped) all the arrays of the index from a folder
+
+        :param str folder: The path of the folder
+        """
+        for name in ('keys', 'key_doc', 'texts', 'text_offsets', 'scores',
+                     'docs', 'doc_offsets'):
+            setattr(self, name, np.load(os.path.join(folder, name + ".npy"),
+                                        mmap_mode='r'))
+        return True
+
+    def prefix_range(self, input_string):
+        """Returns the range of sorted labels that starts with the input
+
+        :param str input_string: The text written by the user
+        :return: The first and last (not included) position of the labels
+        :rtype: tuple
+        """
+        key_length = self.keys.dtype.itemsize
+        prefix = normalize(input_string).encode('utf-8')
+        if not prefix:
+            return 0, 0
+        if len(prefix) > self.MAX_KEY_LENGTH:
+            # Longer keys were truncated too, so they may match
+            prefix = prefix[:self.MAX_KEY_LENGTH]
+        if len(prefix) > key_length:
+            # Longer than every label
+            return 0, 0
+        if len(prefix) == key_length:
+            # No key is longer, so only the exact key can match
+            return (np.searchsorted(self.keys, prefix, side='left'),
+                    np.searchsorted(self.keys, prefix, side='right'))
+        # UTF-8 never uses the 0xff byte, so it is greater than any suffix
+        return (np.searchsorted(self.keys, prefix, side='left'),
+                np.searchsorted(self.keys, prefix + b'\xff', side='left'))
+
+    def suggest(self, input_string, size=10):
+        """Returns the best ranked entities with a label starting with input
+
+        Each entity is returned only once, with the label that matched.
+
+        :param str input_string: The text written by the user
+        :param int size: The maximum number of suggestions
+        :return: A list of pairs (document, text)
+        :rtype: list
+        """
+        start, end = self.prefix_range(input_string)
+        if end <= start:
+            return []
+        docs = np.asarray(self.key_doc[start:end])
+        scores = self.scores[docs]
+
+        # Only the best candidates are sorted. An entity may have several
+        # labels, so more candidates than needed are taken
+        candidates = size * 8
+        if len(docs) > candidates:
+            order = np.argpartition(-scores, candidates)[:candidates]
+            order = order[np.argsort(-scores[order], kind='mergesort')]
+            if len(np.unique(docs[order])) < size:
+                order = np.argsort(-scores, kind='mergesort')
+        else:
+            order = np.argsort(-scores, kind='mergesort')
+
+        suggestions = []
+        seen = set()
+        for position in order:
+            doc_id = docs[position]
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            document = json.loads(
+                _unpack_string(self.docs, self.doc_offsets, doc_id))
+            text = _unpack_string(self.texts, self.text_offsets,
+                                  start + position)
+            suggestions.append((document, text))
+            if len(suggestions) >= size:
+                break
+        return suggestions
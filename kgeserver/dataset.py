@@ -694,6 +694,34 @@ class Dataset():
         # self.subs = all_dataset['subs']
         return True
 
+    def save_vocabulary(self, filepath):
+        """Saves only the entities and relations of the dataset on the disk
+
+        The file can be read with :class:`Vocabulary`, which is much faster
+        to load than the whole dataset when triples are not needed.
+
+        :param string filepath: The path of the file where should be saved
+        :return: True if operation was successful
+        :rtype: bool
+        """
+        vocabulary = Vocabulary(self.entities, self.relations,
+                                dataset_class=self.__class__)
+        return vocabulary.save_to_binary(filepath)
+
+    def save_relation_index(self, filepath):
+        """Saves the triples of the dataset sorted by predicate and object
+
+        The file can be read with :class:`RelationIndex`, to find the
+        subjects of a predicate and object without loading the dataset.
+
+        :param string filepath: The path of the file where should be saved
+        :return: True if operation was successful
+        :rtype: bool
+        """
+        relation_index = RelationIndex()
+        relation_index.build(self.subs)
+        return relation_index.save_to_binary(filepath)
+
     def _load_elements_into_dict(self, el_dict, el_list):
         """Insert elements from a list into dict
 
@@ -840,6 +868,222 @@ class Dataset():
             raise ExecuteQueryError("Error on JSON decoder")
 
 
+class Vocabulary():
+    """Entities and relations of a dataset, without its triples
+
+    Offers the same methods than Dataset to translate between elements
+    and its ids, and to check them.
+    """
+    def __init__(self, entities=None, relations=None, dataset_class=None):
+        """Creates the vocabulary
+
+        :param list entities: The entities, sorted by id
+        :param list relations: The relations, sorted by id
+        :param class dataset_class: The class of the original dataset
+        """
+        self.entities = entities if entities is not None else []
+        self.relations = relations if relations is not None else []
+        self.dataset_class = dataset_class or Dataset
+        # Used to check elements the same way the original dataset does
+        self.checker = self.dataset_class()
+        self.entities_dict = {entity: i for i, entity
+                              in enumerate(self.entities)}
+        self.relations_dict = {relation: i for i, relation
+                               in enumerate(self.relations)}
+
+    def check_entity(self, entity):
+        """Check the entity given and return a valid representation
+
+        :param string entity: The input entity representation
+        :return: A valid representation or None
+        :rtype: string
+        """
+        return self.checker.check_entity(entity)
+
+    def check_relation(self, relation):
+        """Check the relation given and return a valid representation
+
+        :param string relation: The input relation representation
+        :return: A valid representation or None
+        :rtype: string
+        """
+        return self.checker.check_relation(relation)
+
+    def get_entity_id(self, entity):
+        """Gets the id given an entity
+
+        The entity is checked first, as the original dataset does, so
+        Wikidata entities can be given by their URI.
+
+        :param string entity: The entity string
+        :return: The entity id, or None if it is not on the vocabulary
+        :rtype: int
+        """
+        return self.entities_dict.get(self.check_entity(entity))
+
+    def get_entity(self, id):
+        """Gets the entity given an id
+
+        The entity is returned as the original dataset does, so Wikidata
+        entities are returned as URIs.
+
+        :param integer id: The id to find
+        :return: The entity, or None if the id is not valid
+        :rtype: string
+        """
+        try:
+            if id < 0:
+                return None
+            return getattr(self.checker, "entity_base", "") + \
+                self.entities[id]
+        except (IndexError, TypeError):
+            return None
+
+    def get_relation_id(self, relation):
+        """Gets the id given an relation
+
+        :param string relation: The relation string
+        :return: The relation id, or None if it is not on the vocabulary
+        :rtype: int
+        """
+        return self.relations_dict.get(self.check_relation(relation))
+
+    def get_relation(self, id):
+        """Gets the relation given an id
+
+        :param int id: The relation identifier to find
+        :return: The relation, or None if the id is not valid
+        :rtype: string
+        """
+        try:
+            if id < 0:
+                return None
+            return getattr(self.checker, "relation_base", "") + \
+                self.relations[id]
+        except (IndexError, TypeError):
+            return None
+
+    def save_to_binary(self, filepath):
+        """Saves the vocabulary on the disk
+
+        :param string filepath: The path of the file where should be saved
+        :return: True if operation was successful
+        :rtype: bool
+        """
+        with open(filepath, "w+b") as f:
+            pickle.dump({'entities': self.entities,
+                         'relations': self.relations,
+                         '__class__': self.dataset_class}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        return True
+
+    def load_from_binary(self, filepath):
+        """Loads the vocabulary from the disk
+
+        :param string filepath: The path of the binary file
+        :return: True if operation was successful
+        :rtype: bool
+        """
+        with open(filepath, "rb") as f:
+            vocabulary = pickle.load(f)
+        self.__init__(vocabulary['entities'], vocabulary['relations'],
+                      dataset_class=vocabulary.get('__class__'))
+        return True
+
+
+class RelationIndex():
+    """Triples of a dataset, sorted to find subjects of a relation
+
+    Triples are stored as three arrays of ids sorted by predicate, object
+    and subject, so the subjects of all triples with a predicate (and an
+    object) are a contiguous range of them, found with binary search. The
+    positions of the triples sorted by predicate, subject and object are
+    also stored, to find the objects of a predicate and subject.
+    """
+    def __init__(self):
+        self.predicates = np.zeros(0, dtype=np.int32)
+        self.objects = np.zeros(0, dtype=np.int32)
+        self.subjects = np.zeros(0, dtype=np.int32)
+        self.by_subject = np.zeros(0, dtype=np.int64)
+
+    def build(self, triples):
+        """Sorts the triples of a dataset
+
+        :param list triples: Triples as (subject, object, predicate) ids
+        """
+        triples = np.asarray(triples, dtype=np.int32).reshape(-1, 3)
+        order = np.lexsort((triples[:, 0], triples[:, 1], triples[:, 2]))
+        self.subjects = triples[order, 0]
+        self.objects = triples[order, 1]
+        self.predicates = triples[order, 2]
+        self.by_subject = np.lexsort((self.objects, self.subjects,
+                                      self.predicates))
+
+    def find_subjects(self, predicate, obj=None):
+        """Returns the subjects of the triples with a predicate and object
+
+        :param int predicate: The predicate id
+        :param int obj: The object id. If None, any object is valid
+        :return: The sorted ids of the subjects, without duplicates
+        :rtype: np.ndarray
+        """
+        start = np.searchsorted(self.predicates, predicate, side='left')
+        end = np.searchsorted(self.predicates, predicate, side='right')
+        if obj is not None:
+            objects = self.objects[start:end]
+            start, end = (start + np.searchsorted(objects, obj, side='left'),
+                          start + np.searchsorted(objects, obj,
+                                                  side='right'))
+        return np.unique(self.subjects[start:end])
+
+    def find_objects(self, predicate, subject):
+        """Returns the objects of the triples with a predicate and subject
+
+        :param int predicate: The predicate id
+        :param int subject: The subject id
+        :return: The sorted ids of the objects, without duplicates
+        :rtype: np.ndarray
+        """
+        start = np.searchsorted(self.predicates, predicate, side='left')
+        end = np.searchsorted(self.predicates, predicate, side='right')
+        positions = self.by_subject[start:end]
+        subjects = self.subjects[positions]
+        first = np.searchsorted(subjects, subject, side='left')
+        last = np.searchsorted(subjects, subject, side='right')
+        return np.unique(self.objects[positions[first:last]])
+
+    def save_to_binary(self, filepath):
+        """Saves the relation index on the disk
+
+        :param string filepath: The path of the file where should be saved
+        :return: True if operation was successful
+        :rtype: bool
+        """
+        with open(filepath, "w+b") as f:
+            np.savez(f, subjects=self.subjects, objects=self.objects,
+                     predicates=self.predicates, by_subject=self.by_subject)
+        return True
+
+    def load_from_binary(self, filepath):
+        """Loads the relation index from the disk
+
+        :param string filepath: The path of the binary file
+        :return: True if operation was successful
+        :rtype: bool
+        """
+        with np.load(filepath) as arrays:
+            self.subjects = arrays["subjects"]
+            self.objects = arrays["objects"]
+            self.predicates = arrays["predicates"]
+            if "by_subject" in arrays:
+                self.by_subject = arrays["by_subject"]
+            else:
+                # Saved before objects could be searched
+                self.by_subject = np.lexsort((self.objects, self.subjects,
+                                              self.predicates))
+        return True
+
+
 class MaxTriesExceededError(Exception):
     "MaxTriesExceededError"
     def __init__(self, message):
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# EmbeddingStore class: embeddings of a trained model, ready to be served
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+import skge
+import kgeserver.index as index
+
+# Types the embeddings can be stored with
+DTYPES = ("float32", "float16", "int8")
+
+
+def quantize(matrix, dtype):
+    """Converts the rows of a matrix to a smaller type
+
+    int8 rows are scaled to use the whole range, so each row has a float32
+    scale: row ~= values * scale.
+
+    :param np.ndarray matrix: A (n, f) matrix
+    :param str dtype: One of DTYPES
+    :return: The values and the scale of each row (None if not int8)
+    :rtype: tuple
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dtype != "int8":
+        return matrix.astype(dtype), None
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales[scales == 0] = 1
+    values = np.rint(matrix / scales[:, np.newaxis]).astype(np.int8)
+    return values, scales.astype(np.float32)
+
+
+def dequantize(values, scales=None):
+    """Returns float32 vectors from values returned by :func:`quantize`"""
+    vectors = np.asarray(values, dtype=np.float32)
+    if scales is not None:
+        vectors = vectors * np.asarray(scales)[..., np.newaxis]
+    return vectors
+
+
+class EmbeddingStore():
+    """The entity and relation embeddings of a trained model
+
+    Models are saved by skge with float64 E and R matrices, and must be
+    loaded whole to read any row. A store keeps them on a folder as memory
+    mapped .npy arrays of a smaller type, so only the rows used are read:
+    float32 (half the memory, same scores and distances), float16 or int8
+    with a scale for each row (a quarter or an eighth of the memory, with
+    some precision loss).
+
+    Rows are always returned as float32, with :meth:`entities` and
+    :meth:`relations`. The E and R attributes return whole matrices, so a
+    store can be used instead of a model to build search indexes.
+    """
+    # Rows converted at once when building a store
+    ROWS_PER_BLOCK = 65536
+
+    def __init__(self):
+        self.dtype = None
+        self.holographic = False
+        self.n_entities = 0
+        self.n_relations = 0
+        self.dimension = 0
+        self.folder = None
+        self.meta = {}
+        self.arrays = {}
+
+    def build(self, model, folder=None, dtype="float32", **meta):
+        """Converts the embeddings of a trained model
+
+        :param skge.Model model: A trained TransE or HolE model
+        :param str folder: The folder where the store is saved. If None, it
+                           is kept on memory
+        :param str dtype: One of float32, float16 or int8
+        :param meta: Other values stored on the meta.json of the store
+        :raises ValueError: If the type is not valid
+        """
+        if dtype not in DTYPES:
+            raise ValueError("The type must be one of {}".format(DTYPES))
+        self.dtype = dtype
+        self.holographic = isinstance(model, skge.HolE)
+        self.n_entities, self.dimension = np.shape(model.E)
+        self.n_relations = np.shape(model.R)[0]
+        self.folder = folder
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+        for name, matrix in (("entities", model.E), ("relations", model.R)):
+            self.arrays[name] = self._convert(matrix, name)
+
+        # meta.json is written the last: a store without it is incomplete
+        self.meta = dict(meta, dtype=self.dtype,
+                         model="HolE" if self.holographic else "TransE",
+                         n_entities=self.n_entities,
+                         n_relations=self.n_relations,
+                         dimension=self.dimension)
+        if folder is not None:
+            with open(os.path.join(folder, index.META_FILE), "w") as f:
+                json.dump(self.meta, f)
+
+    def _convert(self, matrix, name):
+        """Converts a matrix by blocks, on memory or on the folder"""
+        shape = np.shape(matrix)
+        # Little-endian, so float32 stores can be exported as they are
+        storage = np.dtype(self.dtype).newbyteorder('<')
+        if self.folder is None:
+            values = np.empty(shape, dtype=storage)
+        else:
+            values = open_memmap(self.path(name), mode="w+", dtype=storage,
+                                 shape=shape)
+        scales = None
+        if self.dtype == "int8":
+            scales = np.empty(shape[0], dtype=np.float32)
+        for start in range(0, shape[0], self.ROWS_PER_BLOCK):
+            end = start + self.ROWS_PER_BLOCK
+            block_values, block_scales = quantize(matrix[start:end],
+                                                  self.dtype)
+            values[start:end] = block_values
+            if scales is not None:
+                scales[start:end] = block_scales
+        if self.folder is not None:
+            values.flush()
+            if scales is not None:
+                np.save(self.path(name + "_scales"), scales)
+        return values, scales
+
+    def path(self, name):
+        """Returns the path of an array of the store
+
+        :param str name: entities, relations, or one of them ending with
+                         _scales (int8 stores only)
+        :rtype: str
+        """
+        return os.path.join(self.folder, name + ".npy")
+
+    def load(self, folder):
+        """Loads a store saved on a folder
+
+        :param str folder: The folder where the store is saved
+        :raises OSError: If the store is not complete
+        """
+        with open(os.path.join(folder, index.META_FILE)) as f:
+            self.meta = json.load(f)
+        self.folder = folder
+        self.dtype = self.meta["dtype"]
+        self.holographic = self.meta["model"] == "HolE"
+        self.n_entities = self.meta["n_entities"]
+        self.n_relations = self.meta["n_relations"]
+        self.dimension = self.meta["dimension"]
+        for name in ("entities", "relations"):
+            values = np.load(self.path(name), mmap_mode='r')
+            scales = None
+            if self.dtype == "int8":
+                scales = np.load(self.path(name + "_scales"))
+            self.arrays[name] = (values, scales)
+        return True
+
+    def _rows(self, name, rows):
+        values, scales = self.arrays[name]
+        if rows is None:
+            return dequantize(values, scales)
+        if not isinstance(rows, slice):
+            rows = np.asarray(rows, dtype=np.int64)
+        return dequantize(values[rows],
+                          None if scales is None else scales[rows])
+
+    def entities(self, rows=None):
+        """Returns the embeddings of some entities, as float32
+
+        :param rows: An entity id, a list or array of ids, or a slice. If
+                     None, all entities are returned
+        :rtype: np.ndarray
+        """
+        return self._rows("entities", rows)
+
+    def relations(self, rows=None):
+        """Returns the embeddings of some relations, as float32
+
+        :param rows: A relation id, a list or array of ids, or a slice. If
+                     None, all relations are returned
+        :rtype: np.ndarray
+        """
+        return self._rows("relations", rows)
+
+    @property
+    def E(self):
+        """The embeddings of all entities (as the E matrix of a model)"""
+        return self.entities()
+
+    @property
+    def R(self):
+        """The embeddings of all relations (as the R matrix of a model)"""
+        return self.relations()
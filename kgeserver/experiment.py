@@ -25,9 +25,9 @@
 from __future__ import print_function
 import argparse
 import numpy as np
-from numpy import argsort
 from collections import defaultdict as ddict
 import pickle
+import itertools
 import timeit
 import logging
 from sklearn.metrics import precision_recall_curve, auc, roc_auc_score
@@ -315,7 +315,41 @@ class FilteredRankingEval(object):
             else:
                 self.neval[p] = np.int(np.ceil(neval * len(sos) / len(xs)))
 
+    # Maximum number of scores computed at once (test triples x entities)
+    BLOCK_ELEMENTS = 2 ** 22
+
+    def batch_scores_o(self, mdl, ss, p):
+        """Returns the scores of all objects for several subjects
+
+        Child classes may replace it with a single matrix operation.
+
+        :param list ss: The subject ids
+        :param int p: The predicate id
+        :return: A (len(ss), n_entities) matrix
+        :rtype: np.ndarray
+        """
+        return np.vstack([self.scores_o(mdl, s, p).flatten() for s in ss])
+
+    def batch_scores_s(self, mdl, os, p):
+        """Returns the scores of all subjects for several objects
+
+        :param list os: The object ids
+        :param int p: The predicate id
+        :return: A (len(os), n_entities) matrix
+        :rtype: np.ndarray
+        """
+        return np.vstack([self.scores_s(mdl, o, p).flatten() for o in os])
+
     def positions(self, mdl):
+        """Returns the raw and filtered ranks of the test triples
+
+        Test triples of each predicate are scored by batches, and the rank
+        of the true entity is the number of entities with a higher score.
+        Filtered ranks do not count the other true triples.
+
+        :return: The raw and filtered ranks of heads and tails, by predicate
+        :rtype: tuple
+        """
         pos = {}
         fpos = {}
 
@@ -329,32 +363,56 @@ class FilteredRankingEval(object):
             if hasattr(self, 'prepare'):
                 self.prepare(mdl, p)
 
-            for s, o in sos[:self.neval[p]]:
-                scores_o = self.scores_o(mdl, s, p).flatten()
-                sortidx_o = argsort(scores_o)[::-1]
-                ppos['tail'].append(np.where(sortidx_o == o)[0][0] + 1)
-
-                rm_idx = self.tt[p]['os'][s]
-                rm_idx = [i for i in rm_idx if i != o]
-                scores_o[rm_idx] = -np.Inf
-                sortidx_o = argsort(scores_o)[::-1]
-                pfpos['tail'].append(np.where(sortidx_o == o)[0][0] + 1)
-
-                scores_s = self.scores_s(mdl, o, p).flatten()
-                sortidx_s = argsort(scores_s)[::-1]
-                ppos['head'].append(np.where(sortidx_s == s)[0][0] + 1)
-
-                rm_idx = self.tt[p]['ss'][o]
-                rm_idx = [i for i in rm_idx if i != s]
-                scores_s[rm_idx] = -np.Inf
-                sortidx_s = argsort(scores_s)[::-1]
-                pfpos['head'].append(np.where(sortidx_s == s)[0][0] + 1)
+            sos = np.array(sos[:self.neval[p]], dtype=np.int64).reshape(-1, 2)
+            batch = max(1, self.BLOCK_ELEMENTS // max(1, len(mdl.E)))
+            for start in range(0, len(sos), batch):
+                ss = sos[start:start + batch, 0]
+                os = sos[start:start + batch, 1]
+
+                raw, filtered = _ranks(self.batch_scores_o(mdl, ss, p), os,
+                                       [self.tt[p]['os'][s] for s in ss])
+                ppos['tail'].extend(raw)
+                pfpos['tail'].extend(filtered)
+
+                raw, filtered = _ranks(self.batch_scores_s(mdl, os, p), ss,
+                                       [self.tt[p]['ss'][o] for o in os])
+                ppos['head'].extend(raw)
+                pfpos['head'].extend(filtered)
             pos[p] = ppos
             fpos[p] = pfpos
 
         return pos, fpos
 
 
+def _ranks(scores, true_ids, known):
+    """Returns the raw and filtered ranks of the true entity of each row
+
+    :param np.ndarray scores: A (n, n_entities) matrix of scores
+    :param np.ndarray true_ids: The true entity of each row
+    :param list known: The entities of the true triples of each row. They
+                       are not counted on filtered ranks, except the true one
+    :return: The raw and filtered ranks, starting from 1
+    :rtype: tuple
+    """
+    rows = np.arange(len(true_ids))
+    true_scores = scores[rows, true_ids]
+    higher = scores > true_scores[:, np.newaxis]
+    raw = higher.sum(axis=1) + 1
+
+    # Sparse mask of the known entities, without duplicates
+    lengths = [len(entities) for entities in known]
+    mask_rows = np.repeat(rows, lengths)
+    mask_cols = np.fromiter(itertools.chain.from_iterable(known),
+                            dtype=np.int64, count=sum(lengths))
+    keep = mask_cols != true_ids[mask_rows]
+    cells = np.unique(mask_rows[keep] * scores.shape[1] + mask_cols[keep])
+    mask_rows, mask_cols = np.divmod(cells, scores.shape[1])
+    filtered = raw - np.bincount(mask_rows,
+                                 weights=higher[mask_rows, mask_cols],
+                                 minlength=len(rows)).astype(np.int64)
+    return raw.tolist(), filtered.tolist()
+
+
 class LinkPredictionEval(object):
 
     def __init__(self, xs, ys):
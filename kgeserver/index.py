@@ -0,0 +1,1027 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# Index classes: nearest neighbour search over entity embeddings
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import json
+import math
+import numpy as np
+from annoy import AnnoyIndex
+
+# Name of the file that describes an index saved on a folder
+META_FILE = "meta.json"
+
+
+def normalize_rows(matrix):
+    """Returns the rows of a matrix scaled to unit length, as float32
+
+    Zero rows are kept as zero.
+
+    :param np.ndarray matrix: A (n, d) matrix
+    :return: The normalized matrix
+    :rtype: np.ndarray
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def angular_distance(similarity):
+    """Converts cosine similarities to Annoy angular distances
+
+    The angular distance is the euclidean distance between normalized
+    vectors: sqrt(2 - 2 * cos(u, v))
+
+    :param np.ndarray similarity: Cosine similarities
+    :return: The distances
+    :rtype: np.ndarray
+    """
+    return np.sqrt(np.maximum(2 - 2 * similarity, 0))
+
+
+def pairwise_distances(x, y, block_elements=2 ** 22):
+    """Yields the angular distances between the rows of two matrices
+
+    Distances are computed by blocks of rows of x, with one matrix product
+    each, so the memory used does not depend on the number of rows of x.
+
+    :param np.ndarray x: A (n, f) matrix
+    :param np.ndarray y: A (m, f) matrix
+    :param int block_elements: Maximum number of distances of each block
+    :return: Pairs with the first row of the block and its (rows, m)
+             distances matrix
+    :rtype: generator
+    """
+    x = normalize_rows(np.atleast_2d(x))
+    y = normalize_rows(np.atleast_2d(y))
+    rows = max(1, block_elements // max(1, y.shape[0]))
+    for start in range(0, x.shape[0], rows):
+        yield start, angular_distance(x[start:start + rows].dot(y.T))
+
+
+def _report(progress, done, total):
+    """Calls the progress callback, if any"""
+    if progress is not None:
+        progress(done, total)
+
+
+def top_k(scores, k):
+    """Returns the positions of the k greatest scores of each row, sorted
+
+    :param np.ndarray scores: A (m, n) matrix
+    :param int k: The number of positions of each row
+    :return: A (m, min(k, n)) matrix of positions
+    :rtype: np.ndarray
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        best = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind='mergesort')
+    return np.take_along_axis(best, order, axis=1)
+
+
+class BaseIndex():
+    """Nearest neighbour search index over the entity embeddings
+
+    All indexes return the Annoy angular distance, sqrt(2 - 2 * cos(u, v)),
+    so they are interchangeable behind Server. Child classes **MUST**
+    implement build, save, load, batch_query and get_item_vector. The other
+    methods are built on top of them, but may be replaced with faster ones.
+
+    Indexes stored on a folder have a ``meta.json`` file with its type and
+    parameters. Use :func:`load_index` to load any of them.
+    """
+    # Name of the index type, stored on meta.json
+    index_type = None
+
+    def __init__(self, f=None):
+        """Creates an empty index
+
+        :param int f: The size of the vectors
+        """
+        self.f = f
+
+    def build(self, matrix, progress=None, **params):
+        """Builds the index with all rows of the matrix
+
+        :param np.ndarray matrix: A (n, f) matrix, with the vector of item i
+                                  on row i
+        :param function progress: Called as progress(done, total) while the
+                                  index is being built
+        """
+        raise NotImplementedError("The method build should be "
+                                  "implemented through a child object")
+
+    def save(self, path):
+        """Saves the index on the disk
+
+        :param str path: The path of the file or folder
+        """
+        raise NotImplementedError("The method save should be "
+                                  "implemented through a child object")
+
+    def load(self, path):
+        """Loads the index from the disk
+
+        :param str path: The path of the file or folder
+        """
+        raise NotImplementedError("The method load should be "
+                                  "implemented through a child object")
+
+    def batch_query(self, queries, n, search_k=-1):
+        """Finds the n nearest items of several query vectors
+
+        :param np.ndarray queries: A (m, f) matrix of query vectors
+        :param int n: The number of neighbours of each query
+        :param int search_k: The number of items inspected on each query.
+                             The higher it is, the better the results are.
+                             -1 uses the default of the index
+        :return: Two (m, n) matrices, with item ids and distances
+        :rtype: tuple
+        """
+        raise NotImplementedError("The method batch_query should be "
+                                  "implemented through a child object")
+
+    def get_item_vector(self, i):
+        """Returns the vector of an item, as stored on the index
+
+        :param int i: The item id
+        :rtype: np.ndarray
+        """
+        raise NotImplementedError("The method get_item_vector should be "
+                                  "implemented through a child object")
+
+    def get_n_items(self):
+        """Returns the number of items of the index"""
+        raise NotImplementedError("The method get_n_items should be "
+                                  "implemented through a child object")
+
+    def query(self, vector, n, search_k=-1):
+        """Finds the n nearest items of a vector
+
+        Less than n items are returned when the index finds less, as Annoy
+        does.
+
+        :param list vector: The query vector
+        :param int n: The number of neighbours
+        :param int search_k: The number of items inspected
+        :return: A list of ids and a list of distances
+        :rtype: tuple
+        """
+        ids, distances = self.batch_query(np.array([vector]), n, search_k)
+        # Rows of batch_query with less than n results are filled with -1
+        found = ids[0] >= 0
+        return ids[0][found].tolist(), distances[0][found].tolist()
+
+    def query_item(self, i, n, search_k=-1):
+        """Finds the n nearest items of another item, included itself
+
+        :param int i: The item id
+        :param int n: The number of neighbours
+        :param int search_k: The number of items inspected
+        :return: A list of ids and a list of distances
+        :rtype: tuple
+        """
+        return self.query(self.get_item_vector(i), n, search_k)
+
+    def batch_query_items(self, items, n, search_k=-1):
+        """Finds the n nearest items of several items at once
+
+        :param list items: The item ids
+        :param int n: The number of neighbours of each item
+        :param int search_k: The number of items inspected on each query
+        :return: Two (m, n) matrices, with item ids and distances
+        :rtype: tuple
+        """
+        queries = np.array([self.get_item_vector(i) for i in items])
+        return self.batch_query(queries, n, search_k)
+
+    def get_item_vectors(self, items):
+        """Returns the vectors of several items, as a matrix
+
+        :param list items: The item ids
+        :rtype: np.ndarray
+        """
+        return np.array([self.get_item_vector(i) for i in items])
+
+    def query_subset(self, vector, n, items):
+        """Finds the n nearest items of a vector among some items
+
+        The distance to every item of the subset is computed, so it is
+        exact, and fast when the subset is small.
+
+        :param list vector: The query vector
+        :param int n: The number of neighbours
+        :param list items: The item ids that may be returned
+        :return: A list of ids and a list of distances
+        :rtype: tuple
+        """
+        items = np.asarray(items, dtype=np.int64)
+        if len(items) == 0:
+            return [], []
+        query = normalize_rows(np.atleast_2d(vector))[0]
+        sims = normalize_rows(self.get_item_vectors(items)).dot(query)
+        best = top_k(sims[np.newaxis, :], n)[0]
+        return items[best].tolist(), angular_distance(sims[best]).tolist()
+
+    def distance(self, i, j):
+        """Returns the angular distance between two items
+
+        :param int i: One item id
+        :param int j: Other item id
+        :rtype: float
+        """
+        vectors = normalize_rows(np.array([self.get_item_vector(i),
+                                           self.get_item_vector(j)]))
+        return float(angular_distance(float(vectors[0].dot(vectors[1]))))
+
+    def _save_meta(self, folder, **params):
+        """Creates the folder and writes the meta.json file on it"""
+        os.makedirs(folder, exist_ok=True)
+        meta = {"type": self.index_type, "f": self.f}
+        meta.update(params)
+        with open(os.path.join(folder, META_FILE), "w") as f:
+            json.dump(meta, f)
+
+    def _load_array(self, folder, name):
+        return np.load(os.path.join(folder, name + ".npy"), mmap_mode='r')
+
+
+class AnnoyTreeIndex(BaseIndex):
+    """Approximate search with the random projection trees of Annoy
+
+    The index is stored on a single file, with the Annoy format.
+    """
+    index_type = "annoy"
+    # Rows converted to Python floats at once when adding items
+    ROWS_PER_BLOCK = 10000
+
+    def __init__(self, f=None):
+        super(AnnoyTreeIndex, self).__init__(f)
+        self.annoy = AnnoyIndex(f, 'angular') if f else None
+
+    def build(self, matrix, n_trees=100, build_path=None, n_jobs=-1,
+              progress=None, **params):
+        """Builds the Annoy trees. This may take long time
+
+        Newer versions of Annoy can build the index directly on a file
+        (instead of RAM) and build the trees on several threads. These
+        features are used when available.
+
+        Annoy does not inform about the progress of the trees, so progress
+        is reported while adding items, and then once all trees are built.
+
+        :param np.ndarray matrix: A (n, f) matrix
+        :param int n_trees: The number of trees. More trees give better
+                            results, but bigger indexes
+        :param str build_path: The file the index will be saved to
+        :param int n_jobs: Threads used to build the trees. -1 uses all
+        :param function progress: Called as progress(done, total)
+        """
+        n_rows, self.f = matrix.shape
+        self.annoy = AnnoyIndex(self.f, 'angular')
+        self.build_path = None
+        if build_path is not None and hasattr(self.annoy, "on_disk_build"):
+            self.annoy.on_disk_build(build_path)
+            self.build_path = build_path
+
+        n_blocks = int(math.ceil(n_rows / float(self.ROWS_PER_BLOCK)))
+        for block in range(n_blocks):
+            start = block * self.ROWS_PER_BLOCK
+            rows = np.asarray(matrix[start:start + self.ROWS_PER_BLOCK],
+                              dtype=np.float64).tolist()
+            for row, vector in enumerate(rows, start):
+                self.annoy.add_item(row, vector)
+            _report(progress, block + 1, n_blocks + 1)
+
+        try:
+            self.annoy.build(n_trees, n_jobs=n_jobs)
+        except TypeError:
+            # Annoy versions without parallel build
+            self.annoy.build(n_trees)
+        _report(progress, n_blocks + 1, n_blocks + 1)
+
+    def save(self, path):
+        if getattr(self, "build_path", None) == path:
+            # Already written while building
+            return True
+        self.annoy.save(path)
+        return True
+
+    def load(self, path):
+        self.annoy.load(path)
+        return True
+
+    def get_n_items(self):
+        return self.annoy.get_n_items()
+
+    def get_item_vector(self, i):
+        return np.array(self.annoy.get_item_vector(i))
+
+    def query(self, vector, n, search_k=-1):
+        return self.annoy.get_nns_by_vector(
+            list(vector), n, search_k=search_k, include_distances=True)
+
+    def query_item(self, i, n, search_k=-1):
+        return self.annoy.get_nns_by_item(
+            i, n, search_k=search_k, include_distances=True)
+
+    def batch_query(self, queries, n, search_k=-1):
+        results = [self.query(vector, n, search_k) for vector in queries]
+        return _stack_results(results, n)
+
+    def batch_query_items(self, items, n, search_k=-1):
+        results = [self.query_item(i, n, search_k) for i in items]
+        return _stack_results(results, n)
+
+    def distance(self, i, j):
+        return self.annoy.get_distance(i, j)
+
+
+def _stack_results(results, n):
+    """Builds the id and distance matrices from several (ids, distances)
+
+    Rows with less than n results are filled with -1 and inf
+    """
+    ids = np.full((len(results), n), -1, dtype=np.int64)
+    distances = np.full((len(results), n), np.inf, dtype=np.float32)
+    for row, (row_ids, row_distances) in enumerate(results):
+        ids[row, :len(row_ids)] = row_ids
+        distances[row, :len(row_distances)] = row_distances
+    return ids, distances
+
+
+class ExactIndex(BaseIndex):
+    """Brute force nearest neighbour search with matrix products
+
+    Vectors are stored normalized, so the cosine similarity of a query with
+    all entities is a matrix product. Entities are scanned by blocks, so
+    memory usage does not depend on the number of entities, and several
+    queries are answered with the same products.
+    """
+    index_type = "exact"
+    # Maximum number of scores computed at once (queries x entities)
+    BLOCK_ELEMENTS = 2 ** 22
+
+    def __init__(self, f=None):
+        super(ExactIndex, self).__init__(f)
+        self.vectors = None
+
+    def build(self, matrix, progress=None, **params):
+        """Stores all rows of the matrix, normalized
+
+        :param np.ndarray matrix: A (n, f) matrix
+        :param function progress: Called as progress(done, total)
+        """
+        self.vectors = normalize_rows(matrix)
+        self.f = self.vectors.shape[1]
+        _report(progress, 1, 1)
+
+    def save(self, folder):
+        self._save_meta(folder)
+        np.save(os.path.join(folder, "vectors.npy"), self.vectors)
+        return True
+
+    def load(self, folder):
+        self.vectors = self._load_array(folder, "vectors")
+        self.f = self.vectors.shape[1]
+        return True
+
+    def get_n_items(self):
+        return self.vectors.shape[0]
+
+    def get_item_vector(self, i):
+        return np.asarray(self.vectors[i])
+
+    def get_item_vectors(self, items):
+        return np.asarray(self.vectors[np.asarray(items, dtype=np.int64)])
+
+    def distance(self, i, j):
+        similarity = float(np.dot(self.vectors[i], self.vectors[j]))
+        return float(angular_distance(similarity))
+
+    def batch_query(self, queries, n, search_k=-1):
+        queries = normalize_rows(np.atleast_2d(queries))
+        n = min(n, self.get_n_items())
+        n_queries = queries.shape[0]
+        block = max(n, self.BLOCK_ELEMENTS // max(n_queries, 1))
+
+        best_ids = np.zeros((n_queries, 0), dtype=np.int64)
+        best_sims = np.zeros((n_queries, 0), dtype=np.float32)
+        for start in range(0, self.get_n_items(), block):
+            vectors = np.asarray(self.vectors[start:start + block])
+            sims = queries.dot(vectors.T)
+            candidates = top_k(sims, n)
+            # Merge the best of this block with the best of previous ones
+            best_ids = np.hstack([best_ids, candidates + start])
+            best_sims = np.hstack([best_sims, np.take_along_axis(
+                sims, candidates, axis=1)])
+            keep = top_k(best_sims, n)
+            best_ids = np.take_along_axis(best_ids, keep, axis=1)
+            best_sims = np.take_along_axis(best_sims, keep, axis=1)
+        return best_ids, angular_distance(best_sims)
+
+    def batch_query_items(self, items, n, search_k=-1):
+        return self.batch_query(self.vectors[np.asarray(items)], n)
+
+
+class DeltaIndex(ExactIndex):
+    """Exact index of the entities added after building a search index
+
+    Its items are the entities with ids from ``first_id``, which is the
+    number of items of the search index it extends. Use it along that index
+    with :class:`MergedIndex`, until a new search index with all entities
+    is built.
+    """
+    index_type = "delta"
+
+    def __init__(self, f=None):
+        super(DeltaIndex, self).__init__(f)
+        self.first_id = 0
+        self.meta = {}
+
+    def build(self, matrix, progress=None, first_id=0, **params):
+        """Stores the vectors of the new entities
+
+        :param np.ndarray matrix: A (m, f) matrix, with the vector of item
+                                  first_id + i on row i
+        :param function progress: Called as progress(done, total)
+        :param int first_id: The id of the first new entity
+        """
+        super(DeltaIndex, self).build(matrix, progress)
+        self.first_id = first_id
+
+    def save(self, folder, **meta):
+        """Saves the index on a folder
+
+        :param str folder: The path of the folder
+        :param meta: Other values stored on the meta.json file
+        """
+        self._save_meta(folder, first_id=self.first_id, **meta)
+        np.save(os.path.join(folder, "vectors.npy"), self.vectors)
+        return True
+
+    def load(self, folder):
+        with open(os.path.join(folder, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.first_id = self.meta["first_id"]
+        return super(DeltaIndex, self).load(folder)
+
+    def get_item_vector(self, i):
+        return super(DeltaIndex, self).get_item_vector(i - self.first_id)
+
+    def get_item_vectors(self, items):
+        return super(DeltaIndex, self).get_item_vectors(
+            np.asarray(items, dtype=np.int64) - self.first_id)
+
+    def distance(self, i, j):
+        return super(DeltaIndex, self).distance(i - self.first_id,
+                                                j - self.first_id)
+
+    def batch_query(self, queries, n, search_k=-1):
+        ids, distances = super(DeltaIndex, self).batch_query(queries, n)
+        return ids + self.first_id, distances
+
+    def batch_query_items(self, items, n, search_k=-1):
+        items = np.asarray(items) - self.first_id
+        # batch_query adds first_id to the ids found
+        return self.batch_query(self.vectors[items], n)
+
+
+class MergedIndex(BaseIndex):
+    """A search index and the delta index of the entities added later
+
+    Queries are made on both indexes, and their results are merged.
+    """
+    index_type = "merged"
+
+    def __init__(self, base, delta):
+        """Creates an index with the items of both indexes
+
+        :param BaseIndex base: The search index
+        :param DeltaIndex delta: The entities added after building it
+        """
+        super(MergedIndex, self).__init__(base.f)
+        self.base = base
+        self.delta = delta
+
+    def _index_of(self, i):
+        return self.base if i < self.delta.first_id else self.delta
+
+    def get_n_items(self):
+        return self.delta.first_id + self.delta.get_n_items()
+
+    def get_item_vector(self, i):
+        return np.asarray(self._index_of(i).get_item_vector(i))
+
+    def distance(self, i, j):
+        if self._index_of(i) is self._index_of(j):
+            return self._index_of(i).distance(i, j)
+        return super(MergedIndex, self).distance(i, j)
+
+    def batch_query(self, queries, n, search_k=-1):
+        queries = np.atleast_2d(queries)
+        base_ids, base_distances = self.base.batch_query(queries, n,
+                                                         search_k=search_k)
+        delta_ids, delta_distances = self.delta.batch_query(queries, n)
+        ids = np.hstack([base_ids, delta_ids])
+        distances = np.hstack([base_distances, delta_distances])
+        best = top_k(-distances, n)
+        return (np.take_along_axis(ids, best, axis=1),
+                np.take_along_axis(distances, best, axis=1))
+
+
+def kmeans(vectors, n_clusters, iterations=20, seed=0, spherical=True):
+    """Clusters vectors with Lloyd's algorithm
+
+    Spherical k-means clusters normalized vectors by cosine similarity, and
+    its centroids are normalized too. Otherwise, the euclidean distance is
+    used.
+
+    :param np.ndarray vectors: A (n, f) matrix of vectors
+    :param int n_clusters: The number of clusters
+    :param int iterations: The number of iterations of Lloyd's algorithm
+    :param int seed: The seed used to pick the initial centroids
+    :param bool spherical: Whether to use the cosine similarity
+    :return: A (n_clusters, f) matrix of centroids
+    :rtype: np.ndarray
+    """
+    random = np.random.RandomState(seed)
+    n_clusters = min(n_clusters, vectors.shape[0])
+    centroids = vectors[random.choice(vectors.shape[0], n_clusters,
+                                      replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign_clusters(vectors, centroids, spherical=spherical)
+        sums = np.zeros_like(centroids)
+        for dim in range(vectors.shape[1]):
+            sums[:, dim] = np.bincount(assignment, weights=vectors[:, dim],
+                                       minlength=n_clusters)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        # Empty clusters get a random vector as new centroid
+        empty = counts == 0
+        sums[empty] = vectors[random.choice(vectors.shape[0], empty.sum())]
+        counts[empty] = 1
+        if spherical:
+            centroids = normalize_rows(sums)
+        else:
+            centroids = (sums / counts[:, np.newaxis]).astype(vectors.dtype)
+    return centroids
+
+
+def assign_clusters(vectors, centroids, block=65536, spherical=True):
+    """Returns the nearest centroid of each vector
+
+    :param np.ndarray vectors: A (n, f) matrix of vectors
+    :param np.ndarray centroids: A (c, f) matrix of centroids
+    :param bool spherical: Whether to use the cosine similarity (vectors
+                           and centroids must be normalized) or the
+                           euclidean distance
+    :return: The position of the nearest centroid of each vector
+    :rtype: np.ndarray
+    """
+    # argmin |x - c|^2 is argmax (x.c - |c|^2 / 2)
+    bias = 0 if spherical else (centroids ** 2).sum(axis=1) / 2
+    assignment = np.zeros(vectors.shape[0], dtype=np.int64)
+    for start in range(0, vectors.shape[0], block):
+        sims = np.asarray(vectors[start:start + block]).dot(centroids.T)
+        assignment[start:start + block] = (sims - bias).argmax(axis=1)
+    return assignment
+
+
+class IVFIndex(BaseIndex):
+    """Inverted file index: vectors grouped by its nearest centroid
+
+    The centroids are learnt with k-means. Each query only inspects the
+    vectors of the ``nprobe`` lists whose centroids are nearest to it, so
+    queries are much faster than the exact search with small loss on
+    recall. Vectors are stored sorted by list, so each list is scanned with
+    a single matrix product.
+
+    The ``search_k`` of a query is the number of vectors to inspect, as
+    with Annoy, and it is translated to a number of lists.
+    """
+    index_type = "ivf"
+    # Maximum number of vectors used to learn the centroids, per centroid
+    TRAIN_SAMPLES_PER_LIST = 256
+
+    def __init__(self, f=None):
+        super(IVFIndex, self).__init__(f)
+        self.centroids = None
+        self.list_offsets = None    # Start of each list on list_vectors
+        self.list_ids = None        # Item id of each row of list_vectors
+        self.list_vectors = None    # Normalized vectors, sorted by list
+        self.positions = None       # Row of each item on list_vectors
+        self.nprobe = 1
+
+    def build(self, matrix, n_lists=None, nprobe=None, progress=None,
+              **params):
+        """Learns the centroids and fills the lists
+
+        :param np.ndarray matrix: A (n, f) matrix
+        :param int n_lists: The number of lists. Defaults to 4 * sqrt(n)
+        :param int nprobe: The lists inspected by default on each query.
+                           Defaults to 5% of the lists
+        :param function progress: Called as progress(done, total)
+        """
+        vectors = normalize_rows(matrix)
+        self.f = vectors.shape[1]
+        n_items = vectors.shape[0]
+        if n_lists is None:
+            n_lists = int(4 * math.sqrt(n_items))
+        n_lists = max(1, min(n_lists, n_items))
+
+        random = np.random.RandomState(0)
+        n_samples = min(n_items, n_lists * self.TRAIN_SAMPLES_PER_LIST)
+        sample = vectors[random.choice(n_items, n_samples, replace=False)]
+        self.centroids = kmeans(sample, n_lists)
+        _report(progress, 1, 2)
+
+        assignment = assign_clusters(vectors, self.centroids)
+        order = np.argsort(assignment, kind='mergesort')
+        counts = np.bincount(assignment, minlength=len(self.centroids))
+        self.list_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        self.list_offsets[1:] = np.cumsum(counts)
+        self.list_ids = order
+        self.list_vectors = vectors[order]
+        self.positions = np.empty(n_items, dtype=np.int64)
+        self.positions[order] = np.arange(n_items)
+        if nprobe is None:
+            nprobe = int(math.ceil(0.05 * len(self.centroids)))
+        self.nprobe = max(1, nprobe)
+        _report(progress, 2, 2)
+
+    def save(self, folder):
+        self._save_meta(folder, n_lists=len(self.centroids),
+                        nprobe=self.nprobe)
+        for name in ('centroids', 'list_offsets', 'list_ids', 'list_vectors',
+                     'positions'):
+            np.save(os.path.join(folder, name + ".npy"), getattr(self, name))
+        return True
+
+    def load(self, folder):
+        with open(os.path.join(folder, META_FILE)) as f:
+            self.nprobe = json.load(f)["nprobe"]
+        for name in ('centroids', 'list_offsets', 'list_ids', 'list_vectors',
+                     'positions'):
+            setattr(self, name, self._load_array(folder, name))
+        self.centroids = np.asarray(self.centroids)
+        self.list_offsets = np.asarray(self.list_offsets)
+        self.f = self.centroids.shape[1]
+        return True
+
+    def get_n_items(self):
+        return self.list_ids.shape[0]
+
+    def get_item_vector(self, i):
+        return np.asarray(self.list_vectors[self.positions[i]])
+
+    def lists_to_probe(self, search_k):
+        """Translates the number of vectors to inspect to a number of lists"""
+        if search_k is None or search_k <= 0:
+            return self.nprobe
+        mean_size = self.get_n_items() / len(self.centroids)
+        return int(min(len(self.centroids),
+                       max(1, math.ceil(search_k / mean_size))))
+
+    def batch_query(self, queries, n, search_k=-1):
+        queries = normalize_rows(np.atleast_2d(queries))
+        nprobe = self.lists_to_probe(search_k)
+        probes = top_k(queries.dot(self.centroids.T), nprobe)
+
+        results = []
+        for query, lists in zip(queries, probes):
+            ids, sims = [], []
+            for lst in lists:
+                start, end = self.list_offsets[lst], self.list_offsets[lst + 1]
+                if end > start:
+                    sims.append(np.asarray(
+                        self.list_vectors[start:end]).dot(query))
+                    ids.append(np.asarray(self.list_ids[start:end]))
+            if not ids:
+                results.append(([], []))
+                continue
+            ids, sims = np.concatenate(ids), np.concatenate(sims)
+            best = top_k(sims[np.newaxis, :], n)[0]
+            results.append((ids[best], angular_distance(sims[best])))
+        return _stack_results(results, n)
+
+
+class PQIndex(BaseIndex):
+    """Product quantization index: each vector is stored as a few bytes
+
+    Normalized vectors are split on ``n_subspaces`` parts, and each part is
+    replaced by the id (one byte) of its nearest centroid on a codebook of
+    256 centroids learnt with k-means. Queries compute, for each subspace,
+    the dot product of the query with every centroid (asymmetric distance),
+    so the similarity with every item is a sum of table lookups.
+
+    If the full vectors are kept (``rerank``), they are stored on a memory
+    mapped file and only used to re-rank the best candidates, so results
+    and distances are almost exact while RAM usage stays low.
+    """
+    index_type = "pq"
+    # Centroids of each codebook. Codes are stored as bytes
+    N_CENTROIDS = 256
+    # Maximum number of vectors used to learn the codebooks
+    TRAIN_SAMPLES = 20000
+    # Candidates re-ranked for each result requested
+    RERANK_FACTOR = 10
+
+    def __init__(self, f=None):
+        super(PQIndex, self).__init__(f)
+        self.codebooks = None   # (n_subspaces, 256, subspace size)
+        self.codes = None       # (n_subspaces, n) uint8, one row per part
+        self.vectors = None     # Normalized vectors, only to re-rank
+
+    def build(self, matrix, n_subspaces=None, rerank=True, progress=None,
+              **params):
+        """Learns the codebooks and encodes all vectors
+
+        :param np.ndarray matrix: A (n, f) matrix
+        :param int n_subspaces: The number of bytes of each code. Defaults
+                                to one byte for every 4 dimensions
+        :param bool rerank: Whether to keep full vectors to re-rank results
+        :param function progress: Called as progress(done, total)
+        """
+        vectors = normalize_rows(matrix)
+        n_items, self.f = vectors.shape
+        if n_subspaces is None:
+            n_subspaces = int(math.ceil(self.f / 4))
+        n_subspaces = max(1, min(n_subspaces, self.f))
+        # Vectors are padded with zeros to split them on equal parts
+        sub_size = int(math.ceil(self.f / n_subspaces))
+        padded = np.zeros((n_items, sub_size * n_subspaces), dtype=np.float32)
+        padded[:, :self.f] = vectors
+
+        random = np.random.RandomState(0)
+        sample = padded[random.choice(
+            n_items, min(n_items, self.TRAIN_SAMPLES), replace=False)]
+        n_centroids = min(self.N_CENTROIDS, n_items)
+        self.codebooks = np.zeros((n_subspaces, n_centroids, sub_size),
+                                  dtype=np.float32)
+        self.codes = np.zeros((n_subspaces, n_items), dtype=np.uint8)
+        for sub in range(n_subspaces):
+            part = slice(sub * sub_size, (sub + 1) * sub_size)
+            self.codebooks[sub] = kmeans(sample[:, part], n_centroids,
+                                         spherical=False)
+            self.codes[sub] = assign_clusters(
+                padded[:, part], self.codebooks[sub], spherical=False)
+            _report(progress, sub + 1, n_subspaces)
+        self.vectors = vectors if rerank else None
+
+    def save(self, folder):
+        self._save_meta(folder, n_subspaces=self.codebooks.shape[0],
+                        rerank=self.vectors is not None)
+        np.save(os.path.join(folder, "codebooks.npy"), self.codebooks)
+        np.save(os.path.join(folder, "codes.npy"), self.codes)
+        if self.vectors is not None:
+            np.save(os.path.join(folder, "vectors.npy"), self.vectors)
+        return True
+
+    def load(self, folder):
+        with open(os.path.join(folder, META_FILE)) as f:
+            meta = json.load(f)
+        self.f = meta["f"]
+        self.codebooks = np.load(os.path.join(folder, "codebooks.npy"))
+        self.codes = self._load_array(folder, "codes")
+        self.vectors = None
+        if meta["rerank"]:
+            self.vectors = self._load_array(folder, "vectors")
+        return True
+
+    def get_n_items(self):
+        return self.codes.shape[1]
+
+    def get_item_vector(self, i):
+        if self.vectors is not None:
+            return np.asarray(self.vectors[i])
+        # Reconstructed from the codebooks
+        parts = self.codebooks[np.arange(self.codebooks.shape[0]),
+                               self.codes[:, i]]
+        return parts.reshape(-1)[:self.f]
+
+    def approximate_similarities(self, query):
+        """Returns the approximate cosine similarity of query with all items
+
+        :param np.ndarray query: A normalized vector
+        :rtype: np.ndarray
+        """
+        n_subspaces, n_centroids, sub_size = self.codebooks.shape
+        padded = np.zeros(n_subspaces * sub_size, dtype=np.float32)
+        padded[:self.f] = query
+        # Dot product of each part of the query with every centroid
+        tables = np.einsum('scd,sd->sc', self.codebooks,
+                           padded.reshape(n_subspaces, sub_size))
+        sims = np.zeros(self.get_n_items(), dtype=np.float32)
+        for sub in range(n_subspaces):
+            sims += tables[sub][self.codes[sub]]
+        return sims
+
+    def batch_query(self, queries, n, search_k=-1):
+        queries = normalize_rows(np.atleast_2d(queries))
+        n = min(n, self.get_n_items())
+        results = []
+        for query in queries:
+            sims = self.approximate_similarities(query)
+            if self.vectors is None:
+                best = top_k(sims[np.newaxis, :], n)[0]
+                results.append((best, angular_distance(sims[best])))
+                continue
+            n_candidates = max(n * self.RERANK_FACTOR, search_k)
+            candidates = top_k(sims[np.newaxis, :], n_candidates)[0]
+            # Sorted to read the memory mapped file sequentially
+            candidates = np.sort(candidates)
+            exact = np.asarray(self.vectors[candidates]).dot(query)
+            best = top_k(exact[np.newaxis, :], n)[0]
+            results.append((candidates[best], angular_distance(exact[best])))
+        return _stack_results(results, n)
+
+
+class ReducedIndex(BaseIndex):
+    """Approximate search on vectors projected to fewer dimensions
+
+    Normalized vectors are projected to ``n_components`` dimensions, with
+    PCA (the directions that best keep their dot products) or with a random
+    gaussian projection. Another index (Annoy by default) finds candidates
+    on the projected vectors, which is faster as its cost grows with the
+    dimension, and ``rerank_factor`` times the results requested are then
+    re-ranked with the full vectors, stored on a memory mapped file. So
+    distances are exact, and recall is close to the one of the inner index.
+    """
+    index_type = "reduced"
+    # Maximum number of vectors used to learn the PCA projection
+    TRAIN_SAMPLES = 20000
+    # Candidates re-ranked for each result requested
+    RERANK_FACTOR = 10
+    PROJECTIONS = ("pca", "random")
+
+    def __init__(self, f=None):
+        super(ReducedIndex, self).__init__(f)
+        self.projection = None  # (f, n_components) matrix
+        self.vectors = None     # Normalized vectors, to re-rank
+        self.inner = None       # Index of the projected vectors
+        self.rerank_factor = self.RERANK_FACTOR
+
+    def build(self, matrix, n_components=None, projection="pca",
+              inner_type="annoy", rerank_factor=None, progress=None,
+              **params):
+        """Learns the projection and indexes the projected vectors
+
+        :param np.ndarray matrix: A (n, f) matrix
+        :param int n_components: The dimension of the projected vectors.
+                                 Defaults to a quarter of f
+        :param str projection: "pca" or "random"
+        :param str inner_type: The index type of the projected vectors
+        :param int rerank_factor: Candidates re-ranked for each result
+        :param function progress: Called as progress(done, total)
+        :param params: Parameters of the inner index (e.g. n_trees)
+        """
+        if projection not in self.PROJECTIONS:
+            raise ValueError("Unknown projection: {}".format(projection))
+        vectors = normalize_rows(matrix)
+        n_items, self.f = vectors.shape
+        if n_components is None:
+            n_components = int(math.ceil(self.f / 4))
+        n_components = max(1, min(n_components, self.f))
+        if rerank_factor is not None:
+            self.rerank_factor = rerank_factor
+
+        random = np.random.RandomState(0)
+        if projection == "pca":
+            sample = vectors[random.choice(
+                n_items, min(n_items, self.TRAIN_SAMPLES), replace=False)]
+            # Right singular vectors of the (uncentered) sample
+            components = np.linalg.svd(sample, full_matrices=False)[2]
+            self.projection = components[:n_components].T
+        else:
+            self.projection = random.normal(
+                size=(self.f, n_components)) / math.sqrt(n_components)
+        self.projection = self.projection.astype(np.float32)
+
+        # The inner index is stored inside the folder of this one
+        params.pop("build_path", None)
+        self.inner = build_index(inner_type, vectors.dot(self.projection),
+                                 progress=progress, **params)
+        self.vectors = vectors
+
+    def _inner_path(self, folder, inner_type):
+        if inner_type == AnnoyTreeIndex.index_type:
+            return os.path.join(folder, "inner.bin")
+        return os.path.join(folder, "inner")
+
+    def save(self, folder):
+        inner_type = self.inner.index_type
+        self._save_meta(folder, n_components=self.projection.shape[1],
+                        inner_type=inner_type,
+                        rerank_factor=self.rerank_factor)
+        np.save(os.path.join(folder, "projection.npy"), self.projection)
+        np.save(os.path.join(folder, "vectors.npy"), self.vectors)
+        self.inner.save(self._inner_path(folder, inner_type))
+        return True
+
+    def load(self, folder):
+        with open(os.path.join(folder, META_FILE)) as f:
+            meta = json.load(f)
+        self.f = meta["f"]
+        self.rerank_factor = meta["rerank_factor"]
+        self.projection = np.load(os.path.join(folder, "projection.npy"))
+        self.vectors = self._load_array(folder, "vectors")
+        self.inner = load_index(self._inner_path(folder, meta["inner_type"]),
+                                meta["n_components"])
+        return True
+
+    def get_n_items(self):
+        return self.vectors.shape[0]
+
+    def get_item_vector(self, i):
+        return np.asarray(self.vectors[i])
+
+    def get_item_vectors(self, items):
+        return np.asarray(self.vectors[np.asarray(items, dtype=np.int64)])
+
+    def distance(self, i, j):
+        similarity = float(np.dot(self.vectors[i], self.vectors[j]))
+        return float(angular_distance(similarity))
+
+    def batch_query(self, queries, n, search_k=-1):
+        queries = normalize_rows(np.atleast_2d(queries))
+        n = min(n, self.get_n_items())
+        candidates, _ = self.inner.batch_query(
+            queries.dot(self.projection), n * self.rerank_factor,
+            search_k=search_k)
+        results = []
+        for query, row in zip(queries, candidates):
+            # Sorted to read the memory mapped file sequentially
+            row = np.sort(row[row >= 0])
+            exact = np.asarray(self.vectors[row]).dot(query)
+            best = top_k(exact[np.newaxis, :], n)[0]
+            results.append((row[best], angular_distance(exact[best])))
+        return _stack_results(results, n)
+
+
+# All index types, by name
+INDEX_TYPES = {
+    AnnoyTreeIndex.index_type: AnnoyTreeIndex,
+    ExactIndex.index_type: ExactIndex,
+    IVFIndex.index_type: IVFIndex,
+    PQIndex.index_type: PQIndex,
+    ReducedIndex.index_type: ReducedIndex
+}
+
+
+def build_index(index_type, matrix, **params):
+    """Builds an index of the given type
+
+    :param str index_type: The name of the index type (see INDEX_TYPES)
+    :param np.ndarray matrix: A (n, f) matrix, with the vector of item i
+                              on row i
+    :param params: Parameters of the build method of the index
+    :return: The built index
+    :rtype: BaseIndex
+    :raises ValueError: If the index type does not exist
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError("Unknown index type: {}".format(index_type))
+    index = INDEX_TYPES[index_type](matrix.shape[1])
+    index.build(matrix, **params)
+    return index
+
+
+def load_index(path, f):
+    """Loads an index from a file (Annoy) or a folder (other types)
+
+    :param str path: The path of the file or folder
+    :param int f: The size of the vectors
+    :return: The loaded index
+    :rtype: BaseIndex
+    :raises ValueError: If the index type does not exist
+    """
+    if not os.path.isdir(path):
+        index = AnnoyTreeIndex(f)
+    else:
+        with open(os.path.join(path, META_FILE)) as meta:
+            index_type = json.load(meta)["type"]
+        if index_type not in INDEX_TYPES:
+            raise ValueError("Unknown index type: {}".format(index_type))
+        index = INDEX_TYPES[index_type](f)
+    index.load(path)
+    return index
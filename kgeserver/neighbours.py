@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# NeighbourTable class: precomputed nearest neighbours of all entities
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from numpy.lib.format import open_memmap
+import kgeserver.index as index
+
+
+class NeighbourTable():
+    """The exact k nearest neighbours of every entity, stored on disk
+
+    The table is a folder with two (n, k) arrays: the ids of the neighbours
+    of each entity and their Annoy angular distances, sorted by distance.
+    As with the search indexes, the first neighbour of an entity is itself.
+    Arrays are memory mapped, so the neighbours of an entity are a slice of
+    them and only the rows used are read from disk.
+    """
+    # Number of entities whose neighbours are computed at once
+    ROWS_PER_BLOCK = 1024
+
+    def __init__(self):
+        self.k = None
+        self.ids = None
+        self.distances = None
+        self.meta = {}
+
+    def build(self, matrix, k, folder, n_jobs=-1, progress=None, **meta):
+        """Computes the neighbours of all rows of a matrix on a folder
+
+        Rows are split on blocks, and the neighbours of each block are found
+        with the blocked matrix products of the exact index. Blocks are
+        computed concurrently, as numpy releases the GIL on them, and each
+        one is written on its rows of the arrays, so the table is never
+        stored on memory.
+
+        :param np.ndarray matrix: A (n, f) matrix, with the vector of item i
+                                  on row i
+        :param int k: The number of neighbours of each entity
+        :param str folder: The folder where the table is stored
+        :param int n_jobs: Threads used. -1 uses all cores
+        :param function progress: Called as progress(done, total)
+        :param meta: Other values stored on the meta.json of the table
+        """
+        exact = index.ExactIndex()
+        exact.build(matrix)
+        n_items = exact.get_n_items()
+        self.k = min(k, n_items)
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = multiprocessing.cpu_count()
+
+        os.makedirs(folder, exist_ok=True)
+        self.ids = open_memmap(os.path.join(folder, "ids.npy"), mode="w+",
+                               dtype=np.int32, shape=(n_items, self.k))
+        self.distances = open_memmap(os.path.join(folder, "distances.npy"),
+                                     mode="w+", dtype=np.float32,
+                                     shape=(n_items, self.k))
+
+        def compute_block(start):
+            end = min(start + self.ROWS_PER_BLOCK, n_items)
+            ids, distances = exact.batch_query_items(range(start, end),
+                                                     self.k)
+            self.ids[start:end] = ids
+            self.distances[start:end] = distances
+            return end - start
+
+        done = 0
+        blocks = range(0, n_items, self.ROWS_PER_BLOCK)
+        with ThreadPool(n_jobs) as pool:
+            for rows in pool.imap_unordered(compute_block, blocks):
+                done += rows
+                index._report(progress, done, n_items)
+        self.ids.flush()
+        self.distances.flush()
+
+        # meta.json is written the last: a table without it is incomplete
+        self.meta = dict(meta, k=self.k, n_items=n_items)
+        with open(os.path.join(folder, index.META_FILE), "w") as f:
+            json.dump(self.meta, f)
+
+    def load(self, folder):
+        """Loads a table built on a folder
+
+        :param str folder: The folder where the table is stored
+        :raises OSError: If the table is not complete
+        """
+        with open(os.path.join(folder, index.META_FILE)) as f:
+            self.meta = json.load(f)
+        self.k = self.meta["k"]
+        self.ids = np.load(os.path.join(folder, "ids.npy"), mmap_mode='r')
+        self.distances = np.load(os.path.join(folder, "distances.npy"),
+                                 mmap_mode='r')
+        return True
+
+    def covers(self, n):
+        """Whether the table has the n nearest neighbours of each entity
+
+        :param int n: The number of neighbours
+        :rtype: bool
+        """
+        return self.k is not None and n <= self.k
+
+    def lookup(self, item, n):
+        """Returns the n nearest neighbours of an entity
+
+        :param int item: The entity id
+        :param int n: The number of neighbours. Must not be greater than k
+        :return: A list with the ids and a list with the distances
+        :rtype: tuple
+        """
+        return (self.ids[item, :n].tolist(),
+                self.distances[item, :n].tolist())
+
+    def batch_lookup(self, items, n):
+        """Returns the n nearest neighbours of several entities
+
+        :param list items: The entity ids
+        :param int n: The number of neighbours. Must not be greater than k
+        :return: A (len(items), n) matrix of ids and one of distances
+        :rtype: tuple
+        """
+        items = np.asarray(items, dtype=np.int64)
+        return self.ids[items, :n], self.distances[items, :n]
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# LinkPredictor class: predict missing entities of triples with a model
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import threading
+import collections
+import numpy as np
+import skge
+import kgeserver.index as index
+import kgeserver.embeddings as embeddings
+
+
+class LinkPredictor():
+    """Scores triples and predicts the missing entity of (s, p, ?) queries
+
+    Supports TransE models, whose score of (s, p, o) is
+    -|E[s] + R[p] - E[o]|, and HolE models, whose score is
+    R[p] . ccorr(E[s], E[o]) (the same scores used to evaluate them on
+    :mod:`kgeserver.algorithm`). Candidates are scored by blocks of
+    entities with matrix operations, and the best ones are selected with
+    argpartition.
+
+    Embeddings are read from a :class:`kgeserver.embeddings.EmbeddingStore`
+    as float32, which is faster while scores keep enough precision to rank
+    entities. With a store saved on disk, they are memory mapped, and may
+    be stored as float16 or int8 to use less memory.
+    """
+    # Maximum number of values computed at once (entities x components)
+    BLOCK_ELEMENTS = 2 ** 22
+    # HolE: relations whose correlation with all entities is kept
+    RELATION_CACHE = 4
+    # Approximate mode: candidates re-scored for each result requested
+    RERANK_FACTOR = 10
+
+    def __init__(self, model, relation_index=None):
+        """Creates a predictor of a trained model
+
+        :param model: A trained TransE or HolE model, or an EmbeddingStore
+        :param RelationIndex relation_index: The triples of the dataset,
+                                             used to filter known triples
+        """
+        if not isinstance(model, embeddings.EmbeddingStore):
+            store = embeddings.EmbeddingStore()
+            store.build(model)
+            model = store
+        self.store = model
+        self.holographic = model.holographic
+        self.relation_index = relation_index
+        self.relation_cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _correlated(self, p):
+        """HolE: returns ccorr(R[p], E), kept for the latest relations"""
+        with self.lock:
+            if p in self.relation_cache:
+                self.relation_cache.move_to_end(p)
+                return self.relation_cache[p]
+        correlated = np.asarray(
+            skge.util.ccorr(self.store.relations(p), self.store.entities()),
+            dtype=np.float32)
+        with self.lock:
+            self.relation_cache[p] = correlated
+            while len(self.relation_cache) > self.RELATION_CACHE:
+                self.relation_cache.popitem(last=False)
+        return correlated
+
+    def _blocks(self, n_rows=None):
+        """Yields the slices of entities (or triples) scored at once"""
+        if n_rows is None:
+            n_rows = self.store.n_entities
+        rows = max(1, self.BLOCK_ELEMENTS // max(1, self.store.dimension))
+        for start in range(0, n_rows, rows):
+            yield slice(start, start + rows)
+
+    def translated(self, entity, p, objects=True):
+        """TransE: returns the vector the missing entity should be close to
+
+        :param int entity: The known entity id
+        :param int p: The relation id
+        :param bool objects: True if the objects are missing, else subjects
+        :rtype: np.ndarray
+        """
+        if objects:
+            return self.store.entities(entity) + self.store.relations(p)
+        return self.store.entities(entity) - self.store.relations(p)
+
+    def scores(self, entity, p, objects=True, candidates=None):
+        """Scores all entities (or some) as the missing one of a triple
+
+        :param int entity: The known entity id
+        :param int p: The relation id
+        :param bool objects: True to score (entity, p, ?) triples, False to
+                             score (?, p, entity) triples
+        :param np.ndarray candidates: If given, only these entity ids are
+                                      scored
+        :return: The score of each entity (or candidate). Higher is better
+        :rtype: np.ndarray
+        """
+        if candidates is None:
+            scores = np.empty(self.store.n_entities, dtype=np.float32)
+            for block in self._blocks():
+                scores[block] = self._scores(entity, p, objects, block)
+            return scores
+        # Candidates are also scored by blocks, to not copy all their rows
+        candidates = np.asarray(candidates, dtype=np.int64)
+        scores = np.empty(len(candidates), dtype=np.float32)
+        for block in self._blocks(len(candidates)):
+            scores[block] = self._scores(entity, p, objects,
+                                         candidates[block])
+        return scores
+
+    def _scores(self, entity, p, objects, rows):
+        if not self.holographic:
+            # (s + p) - o and s - (o - p) are the same difference
+            difference = self.store.entities(rows) - \
+                self.translated(entity, p, objects)
+            return -np.abs(difference).sum(axis=1)
+        correlated = self._correlated(p)
+        if objects:
+            return correlated[rows].dot(self.store.entities(entity))
+        return self.store.entities(rows).dot(correlated[entity])
+
+    def score_triples(self, subjects, predicates, objects):
+        """Returns the score of several triples with the model
+
+        Triples are scored by chunks, so the vectors of all triples are
+        never on memory at once. Scores are the same than the ones of
+        the model: -|E[s] + R[p] - E[o]| for TransE, and
+        R[p] . ccorr(E[s], E[o]) for HolE.
+
+        :param np.ndarray subjects: The subject ids
+        :param np.ndarray predicates: The relation ids
+        :param np.ndarray objects: The object ids
+        :return: The score of each triple. Higher is more probable
+        :rtype: np.ndarray
+        """
+        subjects = np.asarray(subjects, dtype=np.int64)
+        predicates = np.asarray(predicates, dtype=np.int64)
+        objects = np.asarray(objects, dtype=np.int64)
+        scores = np.empty(len(subjects), dtype=np.float32)
+        for block in self._blocks(len(subjects)):
+            ss, ps, os = subjects[block], predicates[block], objects[block]
+            subject_vectors = self.store.entities(ss)
+            object_vectors = self.store.entities(os)
+            relation_vectors = self.store.relations(ps)
+            if self.holographic:
+                correlated = skge.util.ccorr(subject_vectors, object_vectors)
+                scores[block] = np.sum(relation_vectors * correlated, axis=1)
+            else:
+                difference = subject_vectors + relation_vectors - \
+                    object_vectors
+                scores[block] = -np.abs(difference).sum(axis=1)
+        return scores
+
+    def known(self, entity, p, objects=True):
+        """Returns the entities that complete a triple of the dataset
+
+        :param int entity: The known entity id
+        :param int p: The relation id
+        :param bool objects: True for objects of (entity, p, ?) triples
+        :rtype: np.ndarray
+        """
+        if self.relation_index is None:
+            return np.zeros(0, dtype=np.int64)
+        if objects:
+            return self.relation_index.find_objects(p, entity)
+        return self.relation_index.find_subjects(p, entity)
+
+    def predict(self, entity, p, k, objects=True, filter_known=True,
+                search_index=None, search_k=-1):
+        """Returns the k entities that best complete a triple
+
+        With a search index, only the entities nearest to the translated
+        vector of TransE (E[s] + R[p] or E[o] - R[p]) are scored, which is
+        much faster on large datasets, but approximate. HolE models are
+        always scored exactly.
+
+        :param int entity: The known entity id
+        :param int p: The relation id
+        :param int k: The number of predictions
+        :param bool objects: True to predict objects of (entity, p, ?),
+                             False to predict subjects of (?, p, entity)
+        :param bool filter_known: Skip triples already on the dataset
+        :param BaseIndex search_index: An index of the entity embeddings,
+                                       for the approximate mode
+        :param int search_k: The nodes inspected on the search index
+        :return: A list of pairs (entity id, score), best first
+        :rtype: list
+        """
+        known = self.known(entity, p, objects) if filter_known else []
+        if search_index is not None and not self.holographic:
+            n_candidates = (k + len(known)) * self.RERANK_FACTOR
+            candidates, _ = search_index.query(
+                self.translated(entity, p, objects), n_candidates,
+                search_k=search_k)
+            candidates = np.asarray(candidates, dtype=np.int64)
+            candidates = candidates[(candidates >= 0) &
+                                    (candidates < self.store.n_entities)]
+            scores = self.scores(entity, p, objects, candidates)
+        else:
+            # All entities are scored by slices of the store
+            candidates = np.arange(self.store.n_entities)
+            scores = self.scores(entity, p, objects)
+
+        if len(known):
+            scores[np.isin(candidates, known)] = -np.inf
+        best = index.top_k(scores[np.newaxis, :], k)[0]
+        best = best[np.isfinite(scores[best])]
+        return list(zip(candidates[best].tolist(), scores[best].tolist()))
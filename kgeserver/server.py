@@ -19,20 +19,31 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import sys
 import os
+import math
+import numpy as np
 import kgeserver.dataset as dataset
 import kgeserver.algorithm as algorithm
 import skge
-from annoy import AnnoyIndex
+import kgeserver.index as index
 
 
 class Server():
     """The server can perform prediction operations
     """
+    # Each filtered search fetches this many times the expected results
+    FILTER_OVERFETCH = 2
+    # Growth of the fetched results while not enough of them pass a filter
+    FILTER_GROWTH = 4
+
     def __init__(self, search_index):
         """Creates a server, given a indexed search tree
 
         :param SearchIndex search_index: A ready search index
         """
+        # Optional NeighbourTable, used instead of the search index when
+        # it has enough neighbours for a query
+        self.neighbour_table = None
+        self.delta_index = None
         if not search_index or search_index.index is None:
             print("The search index has not been generated")
             return None
@@ -40,50 +51,155 @@ class Server():
             print("The search index must be built")
             return None
         else:
+            self.search_index = search_index
             self.index = search_index.index
 
-    def similarity_by_id(self, id, k, search_k=-1):
+    def set_delta_index(self, delta_index):
+        """Serves also the entities added after building the search index
+
+        :param DeltaIndex delta_index: The index of the new entities, or
+                                       None to use only the search index
+        """
+        if delta_index is self.delta_index:
+            return
+        if delta_index is None:
+            self.index = self.search_index.index
+        else:
+            self.index = index.MergedIndex(self.search_index.index,
+                                           delta_index)
+        self.delta_index = delta_index
+
+    def has_neighbours(self, k):
+        """Whether the k most similar entities are read from a neighbour table
+
+        Neighbour tables don't have the entities of a delta index, so they
+        are not used while the server has one.
+
+        :param int k: The number of similar entities
+        :rtype: bool
+        """
+        return (self.neighbour_table is not None and
+                self.delta_index is None and
+                self.neighbour_table.covers(k))
+
+    def similarity_by_id(self, id, k, search_k=-1, allowed=None):
         """Given an entity id, return the k'th most similar entities
 
         Returns a list of pairs, where the first item is the entity
         and the second item is the distance to entity.
 
+        When the server has a neighbour table with at least k neighbours,
+        they are read from it, and search_k is ignored.
+
         :param int id: The entity id
         :param int k: The entities to show
+        :param list allowed: If given, only these entity ids are returned
+                             (see :meth:`filtered_search`)
         :returns: A list with k id's, which are the most similar entities
         :rtype: list of pairs
         """
         if id is None:
             return None
-        sim = self.index.get_nns_by_item(
-                id, k, include_distances=True, search_k=search_k)
-        return [(sim[0][i], sim[1][i]) for i in range(0, len(sim[0]))]
+        if allowed is not None:
+            return self.filtered_search(self.index.get_item_vector(id), k,
+                                        allowed, search_k=search_k, item=id)
+        if self.has_neighbours(k):
+            ids, distances = self.neighbour_table.lookup(id, k)
+        else:
+            ids, distances = self.index.query_item(id, k, search_k=search_k)
+        return list(zip(ids, distances))
 
-    def similarity_by_vector(self, vector, k):
+    def similarity_by_vector(self, vector, k, search_k=-1):
         """For each id in vector, return a list with k similar entities
 
+        All entities are searched at once, which is faster on indexes
+        that support batched queries.
+
         :param list vector: A list with entity id's
         :param int k: The similar entities shown for each entity
         :returns: a matrix array [][]
         :rtype: list
         """
-        matrix = []
-        for entity in vector:
-            matrix.append(self.similarity_by_id(entity, k))
-
-        return matrix
+        if self.has_neighbours(k):
+            ids, distances = self.neighbour_table.batch_lookup(vector, k)
+        else:
+            ids, distances = self.index.batch_query_items(vector, k,
+                                                          search_k=search_k)
+        # Rows with less than k results are filled with -1
+        return [[(e_id, dist) for e_id, dist
+                 in zip(ids[row].tolist(), distances[row].tolist())
+                 if e_id >= 0]
+                for row in range(len(vector))]
 
-    def similarity_by_embedding(self, embedd, k, search_k=-1):
+    def similarity_by_embedding(self, embedd, k, search_k=-1, allowed=None):
         """For a given embedding, return most similar id's
 
         :param list embedd: An embedding vector
         :param int k: The similar entities shown for each entity
+        :param list allowed: If given, only these entity ids are returned
+                             (see :meth:`filtered_search`)
         :returns: A list with k id's, which are the most similar entities
         :rtype: list
         """
-        sim = self.index.get_nns_by_vector(
-                embedd, k, include_distances=True, search_k=search_k)
-        return [(sim[0][i], sim[1][i]) for i in range(0, len(sim[0]))]
+        if allowed is not None:
+            return self.filtered_search(embedd, k, allowed,
+                                        search_k=search_k)
+        ids, distances = self.index.query(embedd, k, search_k=search_k)
+        return list(zip(ids, distances))
+
+    def filtered_search(self, vector, k, allowed, search_k=-1, item=None):
+        """Returns the k entities most similar to a vector among some ones
+
+        The index is asked for more results than k, as many as expected to
+        get k allowed ones given the fraction of allowed entities, and the
+        others are discarded. While less than k pass, the results requested
+        (and search_k) grow. When the allowed entities are fewer than the
+        results that would be requested, they are compared one by one with
+        the vector instead, which is exact and cheaper.
+
+        :param list vector: The query vector
+        :param int k: The number of results
+        :param list allowed: The ids of the entities that may be returned
+        :param int search_k: The number of nodes inspected
+        :param int item: The id of the entity of the vector, if any. Used to
+                         read its neighbours from a neighbour table
+        :returns: A list of pairs (entity id, distance)
+        :rtype: list
+        """
+        n_items = self.index.get_n_items()
+        allowed = np.unique(np.asarray(allowed, dtype=np.int64))
+        allowed = allowed[(allowed >= 0) & (allowed < n_items)]
+        if len(allowed) == 0:
+            return []
+
+        def keep_allowed(ids, distances):
+            ids = np.asarray(ids, dtype=np.int64)
+            passed = np.isin(ids, allowed)
+            return list(zip(ids[passed][:k].tolist(),
+                            np.asarray(distances)[passed][:k].tolist()))
+
+        # The precomputed neighbours may already have enough allowed ones
+        if item is not None and self.has_neighbours(1):
+            results = keep_allowed(*self.neighbour_table.lookup(
+                item, self.neighbour_table.k))
+            if len(results) == k:
+                return results
+
+        fetch = int(math.ceil(
+            self.FILTER_OVERFETCH * k * n_items / float(len(allowed))))
+        while fetch < min(len(allowed), n_items):
+            ids, distances = self.index.query(vector, fetch,
+                                              search_k=search_k)
+            results = keep_allowed(ids, distances)
+            # Less results than requested means that there are no more
+            if len(results) == k or len(ids) < fetch:
+                return results
+            fetch *= self.FILTER_GROWTH
+            if search_k > 0:
+                search_k *= self.FILTER_GROWTH
+
+        ids, distances = self.index.query_subset(vector, k, allowed)
+        return list(zip(ids, distances))
 
     def distance_between_entities(self, entity_x, entity_y):
         """Gives the distance between two different elements
@@ -95,7 +211,74 @@ class Server():
         """
         if entity_x is None or entity_y is None:
             return None
-        return self.index.get_distance(entity_x, entity_y)
+        return self.index.distance(entity_x, entity_y)
+
+    def distance_matrix(self, rows, columns=None):
+        """Gives the distances between two lists of entities
+
+        :param list rows: The entity ids of the rows
+        :param list columns: The entity ids of the columns. If None, the
+                             distances between all pairs of rows are given
+        :returns: A (len(rows), len(columns)) matrix of distances
+        :rtype: np.ndarray
+        """
+        x = self.index.get_item_vectors(rows)
+        y = x if columns is None else self.index.get_item_vectors(columns)
+        distances = np.empty((len(x), len(y)), dtype=np.float32)
+        for start, block in index.pairwise_distances(x, y):
+            distances[start:start + len(block)] = block
+        return distances
+
+    def closest_pairs(self, rows, columns=None, n_pairs=100,
+                      max_distance=None):
+        """Gives the closest pairs between two lists of entities
+
+        Distances are computed by blocks, and only the best pairs of each
+        block are kept, so the whole matrix is never stored on memory.
+
+        :param list rows: The entity ids of one side of the pairs
+        :param list columns: The entity ids of the other side. If None,
+                             pairs are made between rows, without the pairs
+                             of an entity with itself and each pair once
+        :param int n_pairs: The number of pairs. If None, all pairs
+        :param float max_distance: Only pairs closer than this are given
+        :returns: A list of (entity id, entity id, distance), closest first
+        :rtype: list
+        """
+        symmetric = columns is None
+        if symmetric:
+            columns = rows
+        x = self.index.get_item_vectors(rows)
+        y = x if symmetric else self.index.get_item_vectors(columns)
+        n_columns = len(y)
+        positions = np.zeros(0, dtype=np.int64)
+        distances = np.zeros(0, dtype=np.float32)
+
+        def keep_best(positions, distances):
+            if n_pairs is None or len(positions) <= n_pairs:
+                return positions, distances
+            best = np.argpartition(distances, n_pairs - 1)[:n_pairs]
+            return positions[best], distances[best]
+
+        for start, block in index.pairwise_distances(x, y):
+            if symmetric:
+                block_rows = np.arange(start, start + len(block))
+                block[np.arange(n_columns) <= block_rows[:, np.newaxis]] = \
+                    np.inf
+            if max_distance is not None:
+                block[block > max_distance] = np.inf
+            flat = block.ravel()
+            valid = np.flatnonzero(np.isfinite(flat))
+            valid, block_distances = keep_best(valid, flat[valid])
+            positions, distances = keep_best(
+                np.concatenate([positions, valid + start * n_columns]),
+                np.concatenate([distances, block_distances]))
+
+        order = np.argsort(distances, kind='mergesort')
+        return [(rows[position // n_columns], columns[position % n_columns],
+                 float(distance))
+                for position, distance in zip(positions[order].tolist(),
+                                              distances[order].tolist())]
 
 
 class SearchIndex():
@@ -115,24 +298,27 @@ class SearchIndex():
         self.index = None
         self.ready = False
 
-    def build_from_trained_model(self, trained_model, depth):
+    def build_from_trained_model(self, trained_model, depth,
+                                 index_type="annoy", **index_params):
         """Creates an index from a trained model
 
+        The index type may be "annoy" (approximate search with random
+        projection trees), "exact" (brute force search), "ivf" (inverted
+        file), "pq" (product quantization) or "reduced" (search on projected
+        vectors). See :mod:`kgeserver.index`. All return the same distance.
+
         :param TrainedModel trained_model: The trained model
         :param int depth: The depth desired to generate the search index
+        :param str index_type: The type of the search index
+        :param index_params: Other parameters of the index type, like
+                             ``progress``, a function called as
+                             progress(done, total) while building, or
+                             ``build_path``, the file where an Annoy index
+                             is built instead of RAM
         """
-        entities_matrix = trained_model.E
-        nrows, emb_size = entities_matrix.shape
-
-        self.index = AnnoyIndex(emb_size)
-
-        # Populate the search index with the trained embedding
-        for row in range(0, nrows):
-            vector = list(entities_matrix[row])
-            self.index.add_item(row, vector)
-
         # Generate the index itself. This may take long time
-        self.index.build(depth)
+        self.index = index.build_index(index_type, trained_model.E,
+                                       n_trees=depth, **index_params)
 
         # Index ready
         self.ready = True
@@ -154,11 +340,13 @@ class SearchIndex():
     def load_from_file(self, filepath, emb_size):
         """Load the search tree from a file on disk
 
+        Annoy indexes are stored on a single file, and the other types on a
+        folder with a file describing the index.
+
         :param string filepath: The path where the file will be saved
         :param int emb_size: The size of embedding vector used
         :return: If operations had or not errors
         :rtype: boolean
         """
-        self.index = AnnoyIndex(emb_size)
-        self.index.load(filepath)
+        self.index = index.load_index(filepath, emb_size)
         self.ready = True
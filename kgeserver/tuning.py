@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# Tuning functions: measure recall and latency of search index settings
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import timeit
+import numpy as np
+import kgeserver.index as index
+
+# Settings swept by default
+DEFAULT_N_TREES = [10, 25, 50, 100, 200]
+DEFAULT_SEARCH_K = [-1, 100, 500, 1000, 5000, 10000, 50000]
+
+
+def sample_queries(n_items, n_queries, seed=137):
+    """Returns a random sample of item ids, used as queries
+
+    :param int n_items: The number of items of the index
+    :param int n_queries: The number of queries
+    :rtype: list
+    """
+    random = np.random.RandomState(seed)
+    return random.choice(n_items, min(n_items, n_queries),
+                         replace=False).tolist()
+
+
+def ground_truth(matrix, queries, k):
+    """Returns the exact k nearest neighbours of each query item
+
+    :param np.ndarray matrix: The (n, f) embeddings matrix
+    :param list queries: The item ids used as queries
+    :param int k: The number of neighbours
+    :return: A (len(queries), k) matrix of item ids
+    :rtype: np.ndarray
+    """
+    exact = index.build_index("exact", matrix)
+    return exact.batch_query_items(queries, k)[0]
+
+
+def measure(search_index, queries, expected, k, search_k):
+    """Measures the recall and latency of an index with a search_k
+
+    :param BaseIndex search_index: The index to measure
+    :param list queries: The item ids used as queries
+    :param np.ndarray expected: The exact neighbours of each query
+    :param int k: The number of neighbours
+    :param int search_k: The search_k used on each query
+    :return: A dict with the mean recall and latencies (ms)
+    :rtype: dict
+    """
+    hits, latencies = 0, []
+    for query, row_expected in zip(queries, expected):
+        start = timeit.default_timer()
+        ids, distances = search_index.query_item(query, k, search_k=search_k)
+        latencies.append((timeit.default_timer() - start) * 1000)
+        hits += len(set(ids) & set(row_expected.tolist()))
+    return {
+        "search_k": search_k,
+        "recall": hits / float(expected.size),
+        "mean_ms": float(np.mean(latencies)),
+        "p99_ms": float(np.percentile(latencies, 99))
+    }
+
+
+def sweep(search_index, queries, expected, k, search_ks, callback=None,
+          **build_params):
+    """Measures an index with several search_k values
+
+    :param BaseIndex search_index: The index to measure
+    :param list queries: The item ids used as queries
+    :param np.ndarray expected: The exact neighbours of each query
+    :param int k: The number of neighbours
+    :param list search_ks: The search_k values to measure
+    :param function callback: Called after measuring each search_k
+    :param build_params: Params used to build the index, added to each point
+    :return: A list of points of the recall vs latency curve
+    :rtype: list
+    """
+    curve = []
+    for search_k in search_ks:
+        point = measure(search_index, queries, expected, k, search_k)
+        point.update(build_params)
+        curve.append(point)
+        if callback is not None:
+            callback()
+    return curve
+
+
+def choose_settings(curve, target_recall, **fixed):
+    """Returns the fastest point of the curve that meets the target recall
+
+    If no point meets it, the one with the best recall is returned.
+
+    :param list curve: Points returned by :func:`sweep`
+    :param float target_recall: The minimum recall desired
+    :param fixed: Only points with these values are considered (e.g.
+                  the n_trees of the index already built)
+    :return: The chosen point, or None if the curve has no valid points
+    :rtype: dict
+    """
+    points = [point for point in curve
+              if all(point.get(key) == value for key, value in fixed.items())]
+    if not points:
+        return None
+    valid = [point for point in points if point["recall"] >= target_recall]
+    if valid:
+        return min(valid, key=lambda point: point["mean_ms"])
+    return max(points, key=lambda point: (point["recall"], -point["mean_ms"]))
@@ -19,15 +19,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import absolute_import, unicode_literals
 import os
+import glob
+import shutil
 import multiprocessing
 from multiprocessing.pool import ThreadPool
 from .celery import app
 import time
 import json
+import logging
+import numpy as np
 import skge
 import kgeserver.dataset as dataset
+import kgeserver.autocomplete as autocomplete
 import kgeserver.algorithm as algorithm
 import kgeserver.server as server
+import kgeserver.index as index
+import kgeserver.tuning as tuning
+import kgeserver.neighbours as neighbours
 
 # Import parent directory (data_access)
 import sys
@@ -207,9 +215,14 @@ def train_dataset_from_algorithm(self, dataset_id, algorithm_dict):
     model_path = dtset_path[:-4] + "_model.bin"
     modeloentrenado.save(model_path)
 
+    # Embeddings to be served (see SERVING_DTYPE), read by the service
+    # and the other tasks instead of the whole model
+    dataset_dao.set_model(dataset_id, model_path)
+    dataset_dto, err = dataset_dao.get_dataset_by_id(dataset_id)
+    dataset_dao.export_embedding_store(dataset_dto)
+
     # Update values on DB when model training has finished
     dataset_dao.update_status(dataset_id, TRAINED_MASK, statusAnd=0b1110)
-    dataset_dao.set_model(dataset_id, model_path)
 
     return False
 
@@ -262,29 +275,69 @@ def build_autocomplete_index(self, dataset_id, langs=['en', 'es']):
 
     entity_dao = data_access.EntityDAO(dataset_dto.dataset_type, dataset_id)
 
-    def get_labels(entity):
+    # Labels already downloaded (maybe by other dataset from the same source)
+    # are read from the label store. Only the misses are requested.
+    label_dao = data_access.LabelDAO()
+    source = dtset.SPARQL_ENDPOINT
+    entity_uris = [dtset.get_entity(i) for i in range(len(dtset.entities))]
+    cached_labels = label_dao.get_labels(source, entity_uris, langs)
+    progres_dao.update_progress(celery_uuid, len(cached_labels))
+
+    def get_labels(entity_pair):
         """Auxiliar method to wrap dtset.entity_labels.
 
-        Receives only one entity and stores on search Index
+        Receives only one entity and returns its labels
         """
+        entity, entity_uri = entity_pair
         # Get the labels from endpoint
-        labels, descriptions, alt_labels = dtset.entity_labels(entity,
-                                                               langs=langs)
+        labels = dtset.entity_labels(entity, langs=langs)
 
         # track progress: add one more step
         progres_dao.add_progress(celery_uuid)
+        return entity_uri, labels
 
-        # Create the doc to be stored on elasticsearch and insert it
-        entity_doc = {"entity_id": entity,
-                      "entity_uri": dtset.check_entity(entity),
-                      "label": labels,
-                      "alt_label": alt_labels,
-                      "description": descriptions}
-        entity_dao.insert_entity(entity_doc)
-
+    entity_pairs = list(zip(dtset.entities, entity_uris))
+    missing = [pair for pair in entity_pairs if pair[1] not in cached_labels]
     # Execute get_labels concurrently, using as many processes as cpu cores
     with ThreadPool(multiprocessing.cpu_count()) as p:
-        all_labels = p.map(get_labels, dtset.entities)
+        downloaded = dict(p.map(get_labels, missing))
+
+    # Save the new labels, to be used by the next autocomplete index. Empty
+    # responses are not saved, as they are also returned on endpoint errors
+    label_dao.set_labels(source, {uri: lbl for uri, lbl in downloaded.items()
+                                  if lbl[0]}, langs)
+    cached_labels.update(downloaded)
+
+    def entity_docs():
+        """Generates the docs to be stored on the search index"""
+        for entity, entity_uri in entity_pairs:
+            labels, descriptions, alt_labels = cached_labels[entity_uri]
+            yield {"entity_id": entity,
+                   "entity_uri": dtset.check_entity(entity),
+                   "label": labels,
+                   "alt_label": alt_labels,
+                   "description": descriptions}
+
+    documents = list(entity_docs())
+    inserted, failures = entity_dao.insert_entities(documents)
+    for failure in failures:
+        logging.warning("Entity not indexed: {}".format(failure))
+    logging.info("{} of {} entities indexed".format(inserted,
+                                                    len(documents)))
+
+    # Build also the local autocomplete index, ranked by entity degree
+    degree = np.zeros(len(dtset.entities))
+    if len(dtset.subs) > 0:
+        subs = np.array(dtset.subs)
+        degree = np.bincount(subs[:, :2].ravel(),
+                             minlength=len(dtset.entities))
+    prefix_index = autocomplete.PrefixIndex()
+    prefix_index.build(documents, degree)
+    # Written aside and then moved, to not modify files being read
+    suggest_folder = dataset_dto.get_binary_suggest_index()
+    prefix_index.save_to_folder(suggest_folder + ".new")
+    shutil.rmtree(suggest_folder, ignore_errors=True)
+    os.rename(suggest_folder + ".new", suggest_folder)
 
     # Update status on DB when finished
     dataset_dao.update_status(dataset_id, SEARCHINDEXED_MASK, statusAnd=0b1110)
@@ -293,88 +346,289 @@ def build_autocomplete_index(self, dataset_id, langs=['en', 'es']):
 
 
 @app.task(bind=True)
-def build_search_index(self, dataset_id, n_trees):
+def build_search_index(self, dataset_id, n_trees, index_type="annoy",
+                       index_params=None):
     """Builds the search index and stores in disk
 
     :param str model_path: The path to the binary file which stores the model
     :param int n_trees: The number of trees to be generated. Default is 100
+    :param str index_type: The type of search index: annoy, exact, ivf, pq
+                           or reduced
+    :param dict index_params: Other params of the index type (e.g. n_lists)
     """
     # Check input Params
     if n_trees is None:
         n_trees = 100
+    if index_type is None:
+        index_type = "annoy"
+    if index_params is None:
+        index_params = {}
 
-    # Creates the progress object in redis
+    # Creates the progress object in redis. Progress is a percentage
     celery_uuid = self.request.id
     progres_dao = data_access.ProgressDAO()
-    progres_dao.create_progress(celery_uuid, 3)
+    progres_dao.create_progress(celery_uuid, 100)
     progres_dao.update_progress(celery_uuid, 0)
 
     dataset_dao = data_access.DatasetDAO()
-    # Set working status
-    dataset_dao.update_status(dataset_id, INDEXED_MASK | RUNNING_TASK_MASK)
+    # Set working status. The current index, if any, is still served
+    dataset_dao.update_status(dataset_id, RUNNING_TASK_MASK)
+    dataset_dto, err = dataset_dao.get_dataset_by_id(dataset_id)
     model_path, err = dataset_dao.get_model(dataset_id)
-    # Load the model and initialize the search index
-    model = skge.TransE.load(model_path)
+    # Load the embeddings of the model and initialize the search index
+    model = dataset_dao.get_embedding_store(dataset_dto)
+    if model is None:
+        raise FileNotFoundError("The model of the dataset can't be found")
     search_index = server.SearchIndex()
 
-    # File to store the search index
-    search_index_file = model_path[:-4] + "_annoy_{}.bin".format(n_trees)
+    # Each index is stored on a new file (or folder), with its version
+    version = "v{}".format(int(time.time() * 1000))
+    if index_type == "annoy":
+        search_index_file = model_path[:-4] + "_{}_annoy_{}.bin".format(
+            version, n_trees)
+    else:
+        search_index_file = model_path[:-4] + "_{}_{}".format(version,
+                                                              index_type)
+
+    last_percent = [0]
+
+    def build_progress(done, total):
+        # Building is 95% of the task. Redis is updated only on changes
+        percent = int(95 * done / total)
+        if percent != last_percent[0]:
+            last_percent[0] = percent
+            progres_dao.update_progress(celery_uuid, percent)
 
     # Execute heavy task and track the progress
-    progres_dao.update_progress(celery_uuid, 1)
-    search_index.build_from_trained_model(model, n_trees)
-    progres_dao.update_progress(celery_uuid, 2)
+    search_index.build_from_trained_model(model, n_trees,
+                                          index_type=index_type,
+                                          progress=build_progress,
+                                          build_path=search_index_file,
+                                          **index_params)
     search_index.save_to_binary(search_index_file)
-    progres_dao.update_progress(celery_uuid, 3)
+    del search_index
 
-    # Update values on DB
-    dataset_dao.update_status(dataset_id, INDEXED_MASK, statusAnd=0b1110)
+    # Publish the new index: the service uses it from the next request
     dataset_dao.set_search_index(dataset_id, search_index_file)
+    dataset_dao.update_status(dataset_id, INDEXED_MASK, statusAnd=0b1110)
+    progres_dao.update_progress(celery_uuid, 100)
+
+    # The index just replaced is kept, as it may be used by requests still
+    # running. Older ones are removed
+    keep = [search_index_file]
+    if dataset_dto._binary_index:
+        keep.append(dataset_dto.get_binary_index())
+    remove_old_indexes(model_path, keep)
+
+    # Entities added after training are indexed again for the new index
+    update_index_delta.delay(dataset_id)
 
     return False
 
 
-def find_embeddings_on_model(dataset_id, entities):
-    """Returns a list with the corresponding embeddings
+def remove_old_indexes(model_path, keep):
+    """Removes the search indexes of a model, except the given ones
+
+    Search indexes are the files and folders next to the model whose name
+    starts with the model name.
 
-    This will return a list like this:
+    :param str model_path: The path of the binary model
+    :param list keep: The paths of the indexes to keep
+    """
+    keep = [os.path.abspath(path) for path in keep]
+    for path in glob.glob(glob.escape(model_path[:-4]) + "_*"):
+        if os.path.abspath(path) in keep:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-    [["Q1", [0, 1, -1, 0.4]], ["Q5", [1, -0.5, -0.1, 0]]]
 
-    :param str model_path: The path to the binary model
-    :param list entities: A list with the URI (or identifiers) of entities
-    :returns: The embedding vector of each entity
-    :rtype: dict
+@app.task(bind=True)
+def update_index_delta(self, dataset_id):
+    """Indexes the entities added to the dataset after its search index
+
+    Their embeddings are estimated from the trained model and their triples
+    (see kgeserver.algorithm.fold_in_entities), and stored on a small exact
+    index, used along the search index until a new one is built with a new
+    model.
+
+    :param int dataset_id: The dataset ID
     """
-    # Expected to return: {entities: [], embeddings: []} IN THE SAME ORDER!!
     dataset_dao = data_access.DatasetDAO()
-    # dataset, err = dataset_dao.get_dataset_by_id(dataset_id)
-    # if dataset is None:
-    #     raise LookupError("The dataset couldn't be located")
+    dataset_dto, err = dataset_dao.get_dataset_by_id(dataset_id)
+    if dataset_dto is None or not dataset_dto._binary_index:
+        return False
+    dtset = dataset.Dataset()
+    dtset.load_from_binary(dataset_dto.get_binary_dataset())
+    model = dataset_dao.get_embedding_store(dataset_dto)
+    if model is None:
+        return False
+
+    # The index must have been built with this model
+    search_index = index.load_index(dataset_dto.get_binary_index(),
+                                    model.dimension)
+    first_id = search_index.get_n_items()
+    delta_folder = dataset_dto.get_binary_delta()
+    if first_id != model.n_entities or len(dtset.entities) <= first_id:
+        if os.path.isdir(delta_folder):
+            shutil.rmtree(delta_folder)
+        return False
+
+    vectors = algorithm.fold_in_entities(model.E, model.R, dtset.subs,
+                                         len(dtset.entities))
+    delta_index = index.DeltaIndex()
+    delta_index.build(vectors, first_id=first_id)
+
+    # The delta is built aside, the old one may be in use by the service
+    new_delta_folder = delta_folder + ".new"
+    if os.path.isdir(new_delta_folder):
+        shutil.rmtree(new_delta_folder)
+    delta_index.save(new_delta_folder, index=dataset_dto._binary_index)
+    if os.path.isdir(delta_folder):
+        shutil.rmtree(delta_folder)
+    os.replace(new_delta_folder, delta_folder)
 
-    dataset_path, err = dataset_dao.get_binary_path(dataset_id)
-    if dataset_path is None:
-        raise FileNotFoundError("The binary dataset doesn't exist on database")
+    return False
 
-    # Load dataset from binary
-    dtset = dataset.Dataset()
-    dtset.load_from_binary(dataset_path)
 
+@app.task(bind=True)
+def build_neighbour_table(self, dataset_id, k=100, n_jobs=-1):
+    """Computes the exact k nearest neighbours of every entity
+
+    The table is used by the service to answer similar entities searches of
+    up to k - 1 results without using the search index.
+
+    :param int dataset_id: The dataset ID
+    :param int k: The number of neighbours of each entity (itself included)
+    :param int n_jobs: Threads used. -1 uses all cores
+    """
+    if k is None:
+        k = 100
+
+    # Creates the progress object in redis. Progress is a percentage
+    celery_uuid = self.request.id
+    progres_dao = data_access.ProgressDAO()
+    progres_dao.create_progress(celery_uuid, 100)
+    progres_dao.update_progress(celery_uuid, 0)
+
+    dataset_dao = data_access.DatasetDAO()
+    dataset_dto, err = dataset_dao.get_dataset_by_id(dataset_id)
     model_path, err = dataset_dao.get_model(dataset_id)
-    if model_path is None:
-        raise FileNotFoundError("The model path does not exist on database")
-    # Load the model and initialize the search index
-    model = skge.TransE.load(model_path)
-
-    return_list = []
-    for entity in entities:
-        position = dtset.get_entity_id(entity)
-        if position is None or position < 0:
-            continue
-        else:
-            embedding = model.E[position]
-        return_list.append([entity, embedding.tolist()])
-    return return_list
+    model = dataset_dao.get_embedding_store(dataset_dto)
+    if model is None:
+        raise FileNotFoundError("The model of the dataset can't be found")
+
+    # The table is built aside, the old one may be in use by the service
+    table_folder = dataset_dto.get_binary_neighbours()
+    new_table_folder = table_folder + ".new"
+    if os.path.isdir(new_table_folder):
+        shutil.rmtree(new_table_folder)
+
+    last_percent = [0]
+
+    def build_progress(done, total):
+        percent = int(99 * done / total)
+        if percent != last_percent[0]:
+            last_percent[0] = percent
+            progres_dao.update_progress(celery_uuid, percent)
+
+    table = neighbours.NeighbourTable()
+    table.build(model.E, k, new_table_folder, n_jobs=n_jobs,
+                progress=build_progress,
+                model_mtime=os.path.getmtime(model_path))
+    del table
+    if os.path.isdir(table_folder):
+        shutil.rmtree(table_folder)
+    os.replace(new_table_folder, table_folder)
+    progres_dao.update_progress(celery_uuid, 100)
+
+    return False
+
+
+@app.task(bind=True)
+def tune_search_index(self, dataset_id, n_trees_list=None, search_k_list=None,
+                      k=10, n_queries=200):
+    """Measures recall and latency of search index settings of a dataset
+
+    A sample of entities is searched with the exact index to get the real
+    neighbours, and then with each setting. For Annoy indexes, a temporary
+    index is built in memory for each number of trees; for other types, the
+    index of the dataset is used. Results are stored on a JSON file, used
+    by the service to choose default search settings.
+
+    :param int dataset_id: The dataset ID
+    :param list n_trees_list: The number of trees of Annoy indexes to test
+    :param list search_k_list: The search_k values to test
+    :param int k: The number of neighbours searched on each query
+    :param int n_queries: The number of entities used as queries
+    """
+    if n_trees_list is None:
+        n_trees_list = tuning.DEFAULT_N_TREES
+    if search_k_list is None:
+        search_k_list = tuning.DEFAULT_SEARCH_K
+
+    dataset_dao = data_access.DatasetDAO()
+    dataset_dto, err = dataset_dao.get_dataset_by_id(dataset_id)
+    model_path, err = dataset_dao.get_model(dataset_id)
+    model = dataset_dao.get_embedding_store(dataset_dto)
+    if model is None:
+        raise FileNotFoundError("The model of the dataset can't be found")
+    index_type = dataset_dao.get_index_type(dataset_dto) or "annoy"
+    if index_type == "annoy":
+        steps = len(n_trees_list) * len(search_k_list)
+    else:
+        steps = len(search_k_list)
+
+    # Creates the progress object in redis. One step for each setting
+    celery_uuid = self.request.id
+    progres_dao = data_access.ProgressDAO()
+    progres_dao.create_progress(celery_uuid, steps)
+    progres_dao.update_progress(celery_uuid, 0)
+
+    def step():
+        progres_dao.add_progress(celery_uuid)
+
+    matrix = model.E
+    queries = tuning.sample_queries(len(matrix), n_queries)
+    expected = tuning.ground_truth(matrix, queries, k)
+    curve = []
+    if index_type == "annoy":
+        for n_trees in n_trees_list:
+            search_index = index.build_index("annoy", matrix,
+                                             n_trees=n_trees)
+            curve.extend(tuning.sweep(search_index, queries, expected, k,
+                                      search_k_list, callback=step,
+                                      n_trees=n_trees))
+            del search_index
+    else:
+        search_index, err = dataset_dao.get_search_index(dataset_dto,
+                                                         ignore_status=True)
+        if search_index is None:
+            raise FileNotFoundError(err[1])
+        curve.extend(tuning.sweep(search_index.index, queries, expected, k,
+                                  search_k_list, callback=step))
+
+    tuning_results = {
+        "model_mtime": os.path.getmtime(model_path),
+        "index_type": index_type,
+        "k": k,
+        "n_queries": len(queries),
+        "created": time.time(),
+        "curve": curve
+    }
+    # Written aside and renamed, as the service may be reading it
+    tuning_file = dataset_dto.get_binary_tuning()
+    tmp_file = "{}.{}.tmp".format(tuning_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(tuning_results, f)
+    os.replace(tmp_file, tuning_file)
+
+    return False
 
 
 def delete_dataset_by_id(dataset_id):
@@ -385,4 +639,4 @@ def delete_dataset_by_id(dataset_id):
         try:
             os.remove(bin_file)
         except IsADirectoryError as err:
-            os.rmdir(bin_file)
+            shutil.rmtree(bin_file)
@@ -29,11 +29,13 @@ import data_access.dataset_dao as dataset_dao
 import data_access.algorithm_dao as algorithm_dao
 import data_access.data_access_base as data_access_base
 import data_access.entity_dao as entity_dao
+import data_access.label_dao as label_dao
 DatasetDAO = dataset_dao.DatasetDAO
 AlgorithmDAO = algorithm_dao.AlgorithmDAO
 MainDAO = data_access_base.MainDAO
 EntityDAO = entity_dao.EntityDAO
 EntityDTO = entity_dao.EntityDTO
+LabelDAO = label_dao.LabelDAO
 
 
 class RedisBackend:
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# cache.py: Objects shared by all the requests served by the same process
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import json
+import hashlib
+import threading
+import collections
+import redis
+import data_access.data_access_base as data_access_base
+
+
+def file_version(path):
+    """Returns a value that changes every time the file is replaced
+
+    :param str path: The path of a file or a folder
+    :return: A tuple (path, inode, modification time)
+    :rtype: tuple
+    """
+    stat = os.stat(path)
+    return (path, stat.st_ino, stat.st_mtime)
+
+
+def file_size(path):
+    """Returns the size in bytes of a file, or all the files of a folder"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, names in os.walk(path) for name in names)
+
+
+class FileCache():
+    """Keeps objects loaded from files shared by all requests of a process
+
+    Each object is stored with a name (i.e: the dataset id) and the version
+    of the file it was loaded from. When the file changes (e.g. a new search
+    index has been built), the next request will load the new one and will
+    replace the old one. While the new object is loading, other requests
+    still use the old one.
+
+    When the sum of the size of all files is greater than `max_bytes`, the
+    least recently used objects are removed.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = collections.defaultdict(threading.Lock)
+
+    def get(self, name, path, loader):
+        """Returns the object stored with name, or load it with loader
+
+        :param name: The name of the object
+        :param str path: The file the object is loaded from
+        :param function loader: Receives the path and returns the object
+        :return: The object
+        :raises OSError: If the file does not exist
+        """
+        version = file_version(path)
+        entry = self._lookup(name, version)
+        if entry is not None:
+            return entry
+
+        # Only one request loads the object, the others will wait for it
+        with self.loading[name]:
+            entry = self._lookup(name, version)
+            if entry is not None:
+                return entry
+            loaded = loader(path)
+            size = file_size(path)
+            with self.lock:
+                self.entries[name] = (version, loaded, size)
+                self.entries.move_to_end(name)
+                self._evict()
+        return loaded
+
+    def _lookup(self, name, version):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or entry[0] != version:
+                return None
+            self.entries.move_to_end(name)
+            return entry[1]
+
+    def _evict(self):
+        """Removes least recently used objects until the budget is met
+
+        The most recently used object is never removed
+        """
+        total = sum(entry[2] for entry in self.entries.values())
+        while total > self.max_bytes and len(self.entries) > 1:
+            name, entry = self.entries.popitem(last=False)
+            total -= entry[2]
+
+    def invalidate(self, name):
+        """Removes an object, if it is stored"""
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def names(self):
+        """Returns the names of all objects stored"""
+        with self.lock:
+            return list(self.entries.keys())
+
+
+class ResultCache():
+    """Keeps the latest results of similarity searches
+
+    Results are stored on a bounded LRU dict in memory and, optionally, on
+    Redis, so they are shared by all processes. Keys contain the version of
+    the search index, so when an index is replaced (e.g. after training
+    again or building a new index) old results are never returned, and
+    they are removed by the LRU policy or the Redis TTL.
+    """
+    def __init__(self, max_items, use_redis=False, ttl=24 * 3600):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.redis = None
+        if use_redis:
+            self.redis = redis.StrictRedis(host="redis", port="6379", db=0)
+
+    def get(self, key, compute):
+        """Returns the result stored with key, or computes and stores it
+
+        :param str key: The key of the result
+        :param function compute: Returns the result. Must be JSON serializable
+        :return: The result
+        """
+        if self.max_items <= 0:
+            return compute()
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        result = self._redis_get(key)
+        if result is None:
+            result = compute()
+            self._redis_set(key, result)
+            hit = False
+        else:
+            hit = True
+
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+        return result
+
+    def _redis_get(self, key):
+        if self.redis is None:
+            return None
+        try:
+            value = self.redis.get(key)
+        except redis.exceptions.RedisError:
+            return None
+        if value is None:
+            return None
+        return json.loads(value.decode('utf-8'))
+
+    def _redis_set(self, key, result):
+        if self.redis is None:
+            return
+        try:
+            self.redis.setex(key, self.ttl, json.dumps(result))
+        except redis.exceptions.RedisError:
+            pass
+
+    def stats(self):
+        """Returns the hit and miss counters of this process
+
+        :rtype: dict
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_items,
+                "redis": self.redis is not None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else None
+            }
+
+
+def similarity_key(dataset_id, index_path, query, limit, search_k,
+                   delta_path=None):
+    """Builds the key of the results of a similarity search
+
+    :param int dataset_id: The dataset id
+    :param str index_path: The search index file the search is made on
+    :param query: An entity id or an embedding vector
+    :param int limit: The number of results requested
+    :param int search_k: The number of nodes inspected
+    :param str delta_path: The index of the entities added later, if any
+    :return: The key
+    :rtype: str
+    :raises OSError: If the index does not exist
+    """
+    path, inode, mtime = file_version(index_path)
+    if delta_path is not None and os.path.exists(delta_path):
+        path, delta_inode, delta_mtime = file_version(delta_path)
+        mtime = "{}:{}:{}".format(mtime, delta_inode, delta_mtime)
+    if isinstance(query, int):
+        query_key = "id{}".format(query)
+    else:
+        query_key = hashlib.sha1(
+            json.dumps([float(x) for x in query]).encode('utf-8')).hexdigest()
+    return "similar:{}:{}:{}:{}:{}:{}".format(dataset_id, inode, mtime,
+                                               query_key, limit, search_k)
+
+
+# Search servers (with its search index) of every dataset
+servers = FileCache(data_access_base._CONFIG_get_index_cache_size())
+
+# Local autocomplete indexes of every dataset
+suggest_indexes = FileCache(data_access_base._CONFIG_get_index_cache_size())
+
+# Entities and relations of every dataset
+vocabularies = FileCache(data_access_base._CONFIG_get_index_cache_size())
+
+# Triples of every dataset, sorted by relation
+relation_indexes = FileCache(
+    data_access_base._CONFIG_get_index_cache_size())
+
+# Indexes of the entities added after building the search index
+delta_indexes = FileCache(data_access_base._CONFIG_get_index_cache_size())
+
+# Precomputed neighbours of the entities of every dataset
+neighbour_tables = FileCache(
+    data_access_base._CONFIG_get_index_cache_size())
+
+# Embeddings of the trained model of every dataset
+embedding_stores = FileCache(
+    data_access_base._CONFIG_get_index_cache_size())
+
+# Link predictors of every dataset, using its embeddings
+predictors = FileCache(data_access_base._CONFIG_get_index_cache_size())
+
+# Search index tuning results of every dataset
+tunings = FileCache(data_access_base._CONFIG_get_index_cache_size())
+
+# Latest results of similar entities searches
+results = ResultCache(
+    data_access_base._CONFIG_get_result_cache_size(),
+    use_redis=data_access_base._CONFIG_get_result_cache_redis(),
+    ttl=data_access_base._CONFIG_get_result_cache_ttl())
+
+# State of the warm-up made when the service starts. It is kept on a file,
+# written by the process that preloads the datasets (the gunicorn master)
+# and read by all workers. The service is ready once all datasets have been
+# loaded on the caches
+WARM_UP_DISABLED = {
+    "enabled": False,
+    "ready": True,
+    "started": None,
+    "finished": None,
+    "done": 0,
+    "total": 0,
+    "datasets": [],
+    "errors": []
+}
+warm_up = dict(WARM_UP_DISABLED)
+
+
+def _write_warm_up():
+    """Writes the warm-up state on its file, replacing it at once"""
+    path = data_access_base._CONFIG_get_warm_up_file()
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(warm_up, f)
+    os.replace(tmp_path, path)
+
+
+def read_warm_up():
+    """Returns the warm-up state, as written by the process that made it
+
+    :returns: The warm-up state. If there is no warm-up, it is ready
+    :rtype: dict
+    """
+    try:
+        with open(data_access_base._CONFIG_get_warm_up_file()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict(WARM_UP_DISABLED)
+
+
+def clear_warm_up():
+    """Removes the state of a previous warm-up, if any"""
+    try:
+        os.remove(data_access_base._CONFIG_get_warm_up_file())
+    except OSError:
+        pass
+
+
+def start_warm_up():
+    """Marks that the service started to preload the datasets"""
+    warm_up.update(WARM_UP_DISABLED, enabled=True, ready=False,
+                   started=time.time())
+    _write_warm_up()
+
+
+def update_warm_up(done, total):
+    """Updates the number of datasets already preloaded
+
+    :param int done: The datasets loaded (or failed) so far
+    :param int total: The datasets to load
+    """
+    warm_up["done"] = done
+    warm_up["total"] = total
+    _write_warm_up()
+
+
+def finish_warm_up(datasets, errors):
+    """Marks that all datasets have been preloaded
+
+    :param list datasets: The ids of the datasets loaded
+    :param list errors: Messages of the datasets that could not be loaded
+    """
+    warm_up["datasets"] = datasets
+    warm_up["errors"] = errors
+    warm_up["finished"] = time.time()
+    warm_up["ready"] = True
+    _write_warm_up()
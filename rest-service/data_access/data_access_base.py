@@ -62,6 +62,125 @@ def _CONFIG_get_database_fill():
         return False
 
 
+def _CONFIG_get_label_cache_max_age():
+    """Seconds that a label downloaded from a SPARQL endpoint is considered
+    fresh. By default, labels are kept for 30 days.
+    """
+    try:
+        return float(os.environ["LABEL_CACHE_MAX_AGE"])
+    except (KeyError, ValueError):
+        return 30 * 24 * 3600.0
+
+
+def _CONFIG_get_index_cache_size():
+    """Maximum size (in bytes) of the search indexes that each process will
+    keep loaded. Read from ``INDEX_CACHE_MAX_MB``, 2048 MB by default.
+    """
+    try:
+        return float(os.environ["INDEX_CACHE_MAX_MB"]) * 1024 * 1024
+    except (KeyError, ValueError):
+        return 2048 * 1024 * 1024
+
+
+def _CONFIG_get_preload_indexes():
+    """Whether the service loads the vocabulary and search index of every
+    dataset when it starts. Read from ``PRELOAD_INDEXES``, False by default.
+    """
+    try:
+        var = os.environ["PRELOAD_INDEXES"]
+        if var.lower() == "true":
+            return True
+        else:
+            return False
+    except KeyError:
+        return False
+
+
+def _CONFIG_get_warm_up_file():
+    """File where the state of the warm-up is shared with all the workers.
+    Read from ``WARM_UP_FILE``, ``warm_up.json`` inside the datasets folder
+    by default.
+    """
+    try:
+        return os.environ["WARM_UP_FILE"]
+    except KeyError:
+        return os.path.join(_CONFIG_get_dataset_path(), "warm_up.json")
+
+
+def _CONFIG_get_result_cache_size():
+    """Number of similar entities results that each process keeps in memory.
+    Read from ``RESULT_CACHE_SIZE``, 10000 by default. 0 disables the cache.
+    """
+    try:
+        return int(os.environ["RESULT_CACHE_SIZE"])
+    except (KeyError, ValueError):
+        return 10000
+
+
+def _CONFIG_get_result_cache_redis():
+    """Whether similar entities results are also shared through Redis
+    between all processes. Read from ``RESULT_CACHE_REDIS``, False by default.
+    """
+    try:
+        var = os.environ["RESULT_CACHE_REDIS"]
+        if var.lower() == "true":
+            return True
+        else:
+            return False
+    except KeyError:
+        return False
+
+
+def _CONFIG_get_result_cache_ttl():
+    """Seconds that a result is kept on Redis. Read from ``RESULT_CACHE_TTL``,
+    one day by default.
+    """
+    try:
+        return int(os.environ["RESULT_CACHE_TTL"])
+    except (KeyError, ValueError):
+        return 24 * 3600
+
+
+def _CONFIG_get_batch_search_threads():
+    """Threads used to answer each batch of similarity searches. Read from
+    ``BATCH_SEARCH_THREADS``, 4 by default.
+    """
+    try:
+        return max(1, int(os.environ["BATCH_SEARCH_THREADS"]))
+    except (KeyError, ValueError):
+        return 4
+
+
+def _CONFIG_get_serving_dtype():
+    """Type of the embeddings served of the trained models: float32,
+    float16 or int8. Read from ``SERVING_DTYPE``, float32 by default.
+    """
+    dtype = os.environ.get("SERVING_DTYPE", "float32").lower()
+    if dtype not in ("float32", "float16", "int8"):
+        return "float32"
+    return dtype
+
+
+def _CONFIG_get_max_distance_matrix():
+    """Maximum number of distances of a dense distance matrix response.
+    Read from ``MAX_DISTANCE_MATRIX``, 1000000 by default.
+    """
+    try:
+        return max(1, int(os.environ["MAX_DISTANCE_MATRIX"]))
+    except (KeyError, ValueError):
+        return 1000000
+
+
+def _CONFIG_get_target_recall():
+    """Recall that search settings chosen by the tuning job must reach.
+    Read from ``TARGET_RECALL``, 0.9 by default.
+    """
+    try:
+        return float(os.environ["TARGET_RECALL"])
+    except (KeyError, ValueError):
+        return 0.9
+
+
 class MainDAO():
 
     def __init__(self):
@@ -213,6 +332,25 @@ class MainDAO():
         connection.commit()
         return cursor  # Must be closed outside function
 
+    def execute_many(self, query, rows):
+        """Executes the same query for every row inside one transaction
+
+        This is intended to insert a lot of rows at once without doing a
+        commit for each one of them.
+
+        :param string query: The SQL query.
+        :param list rows: A list of tuples, one for each execution.
+        :return: The number of rows modified
+        :rtype: int
+        """
+        connection = self.connection
+        cursor = connection.cursor()
+        cursor.executemany(query, rows)
+        connection.commit()
+        rowcount = cursor.rowcount
+        cursor.close()
+        return rowcount
+
 
 class DTOClass():
 
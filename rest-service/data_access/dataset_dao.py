@@ -19,16 +19,28 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
+import fcntl
 import time
+import shutil
 import sqlite3
 import redis
 import json
 from pathlib import PurePath
+import numpy as np
+import skge
 import kgeserver.server as server
 import kgeserver.dataset as dataset
+import kgeserver.autocomplete as autocomplete
+import kgeserver.tuning as tuning
+import kgeserver.neighbours as neighbours
+import kgeserver.prediction as prediction
+import kgeserver.embeddings as embeddings
+import kgeserver.index as index
 import kgeserver.wikidata_dataset as wikidata_dataset
 import kgeserver.dbpedia_dataset as dbpedia_dataset
 import data_access.data_access_base as data_access_base
+import data_access.cache as cache
 from data_access.dataset_dto import DatasetDTO
 from data_access.algorithm_dao import AlgorithmDAO
 
@@ -268,6 +280,213 @@ class DatasetDAO(data_access_base.MainDAO):
         else:
             return None
 
+    def build_vocabulary_object(self, dataset_dto):
+        """Returns the entities and relations of the dataset, without triples
+
+        The vocabulary is stored on its own file, next to the binary dataset.
+        If that file does not exist or is older than the dataset, it is
+        generated again from the dataset. Once loaded, the vocabulary is
+        shared by all requests of the process.
+
+        :returns: a Vocabulary object or None
+        :rtype: kgeserver.dataset.Vocabulary
+        """
+        if not dataset_dto or not dataset_dto._binary_dataset:
+            return None
+        dtset_path = dataset_dto.get_binary_dataset()
+        vocab_path = dataset_dto.get_binary_vocabulary()
+
+        def load_vocabulary(path):
+            vocabulary = dataset.Vocabulary()
+            vocabulary.load_from_binary(path)
+            return vocabulary
+
+        try:
+            if not os.path.isfile(vocab_path) or \
+                    os.path.getmtime(vocab_path) < \
+                    os.path.getmtime(dtset_path):
+                dtst = dataset.Dataset()
+                dtst.load_from_binary(dtset_path)
+                # Other processes may be reading or writing the same file
+                tmp_path = "{}.{}.tmp".format(vocab_path, os.getpid())
+                dtst.save_vocabulary(tmp_path)
+                os.replace(tmp_path, vocab_path)
+            return cache.vocabularies.get(dataset_dto.id, vocab_path,
+                                          load_vocabulary)
+        except OSError:
+            return None
+
+    def get_relation_index(self, dataset_dto):
+        """Returns the triples of the dataset, sorted by relation
+
+        Like the vocabulary, it is stored on its own file and generated
+        again when the dataset changes.
+
+        :returns: a RelationIndex object or None
+        :rtype: kgeserver.dataset.RelationIndex
+        """
+        if not dataset_dto or not dataset_dto._binary_dataset:
+            return None
+        dtset_path = dataset_dto.get_binary_dataset()
+        relations_path = dataset_dto.get_binary_relations()
+
+        def load_relation_index(path):
+            relation_index = dataset.RelationIndex()
+            relation_index.load_from_binary(path)
+            return relation_index
+
+        try:
+            if not os.path.isfile(relations_path) or \
+                    os.path.getmtime(relations_path) < \
+                    os.path.getmtime(dtset_path):
+                dtst = dataset.Dataset()
+                dtst.load_from_binary(dtset_path)
+                # Other processes may be reading or writing the same file
+                tmp_path = "{}.{}.tmp".format(relations_path, os.getpid())
+                dtst.save_relation_index(tmp_path)
+                os.replace(tmp_path, relations_path)
+            return cache.relation_indexes.get(dataset_dto.id, relations_path,
+                                              load_relation_index)
+        except OSError:
+            return None
+
+    def export_embedding_store(self, dataset_dto, force=True):
+        """Saves the embeddings of the trained model, ready to be served
+
+        They are stored with the type given by SERVING_DTYPE. The store is
+        written aside and then replaces the old one, which may be in use.
+        Only one process exports the store of a dataset at a time, holding
+        a lock file next to it.
+
+        :param bool force: If False, the store is not exported again when
+                           it already has the embeddings of the current
+                           model (e.g. another process just exported it)
+        :returns: The path of the store folder
+        :rtype: str
+        """
+        model_path = dataset_dto.get_binary_model()
+        folder = dataset_dto.get_binary_serving()
+        with open(folder + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            model_mtime = os.path.getmtime(model_path)
+            if not force and self._store_model_mtime(folder) == model_mtime:
+                return folder
+            model = skge.TransE.load(model_path)
+            store = embeddings.EmbeddingStore()
+            tmp_folder = "{}.{}.tmp".format(folder, os.getpid())
+            if os.path.isdir(tmp_folder):
+                shutil.rmtree(tmp_folder)
+            store.build(model, tmp_folder,
+                        dtype=data_access_base._CONFIG_get_serving_dtype(),
+                        model_mtime=model_mtime)
+            del store
+            old_folder = "{}.{}.old".format(folder, os.getpid())
+            if os.path.isdir(folder):
+                os.replace(folder, old_folder)
+            os.replace(tmp_folder, folder)
+            shutil.rmtree(old_folder, ignore_errors=True)
+        return folder
+
+    def _store_model_mtime(self, folder):
+        """Returns the model_mtime saved on a store, or None"""
+        try:
+            with open(os.path.join(folder, index.META_FILE)) as f:
+                return json.load(f).get("model_mtime")
+        except (OSError, ValueError):
+            return None
+
+    def get_embedding_store(self, dataset_dto):
+        """Returns the embeddings of the trained model of a dataset
+
+        They are read from memory mapped arrays, so the model is not loaded.
+        If they have not been exported, or the model has been trained
+        again, they are exported first.
+
+        :returns: The EmbeddingStore object or None
+        :rtype: kgeserver.embeddings.EmbeddingStore
+        """
+        if not dataset_dto or not dataset_dto._binary_model:
+            return None
+
+        def load_store(folder):
+            store = embeddings.EmbeddingStore()
+            store.load(folder)
+            return store
+
+        try:
+            model_mtime = os.path.getmtime(dataset_dto.get_binary_model())
+            try:
+                store = cache.embedding_stores.get(
+                    dataset_dto.id, dataset_dto.get_binary_serving(),
+                    load_store)
+            except (OSError, ValueError, KeyError):
+                store = None
+            if store is None or store.meta.get("model_mtime") != model_mtime:
+                # Other processes may be exporting it at the same time
+                self.export_embedding_store(dataset_dto, force=False)
+                store = cache.embedding_stores.get(
+                    dataset_dto.id, dataset_dto.get_binary_serving(),
+                    load_store)
+            return store
+        except OSError:
+            return None
+
+    def get_link_predictor(self, dataset_dto):
+        """Returns the link predictor of the trained model of a dataset
+
+        It uses the embeddings of the model (see get_embedding_store), and
+        the triples of the dataset are attached to filter the known ones.
+
+        :return: The LinkPredictor object or None
+        :rtype: tuple
+        """
+        if dataset_dto.status & TRAINED_MASK == 0:
+            return None, (409, "Dataset {id} has {status} status and is not "
+                          "trained yet".format(**dataset_dto.to_dict()))
+
+        store = self.get_embedding_store(dataset_dto)
+        if store is None:
+            return None, (500, "The model of the dataset can't be found")
+        try:
+            predictor = cache.predictors.get(
+                dataset_dto.id, store.folder,
+                lambda folder: prediction.LinkPredictor(store))
+            predictor.relation_index = self.get_relation_index(dataset_dto)
+            return predictor, None
+        except (OSError, TypeError) as err:
+            msg = "The server has encountered an error: '{}'."
+            return None, (500, msg.format(err.args))
+
+    def get_embeddings_file(self, dataset_dto):
+        """Returns the entity embeddings of the model as a .npy file
+
+        The matrix is stored as little-endian float32, one row for each
+        entity id. If the embeddings are served as float32, it is the file
+        of the store, otherwise they are exported from it.
+
+        :returns: The path of the file or None
+        :rtype: str
+        """
+        store = self.get_embedding_store(dataset_dto)
+        if store is None:
+            return None
+        if store.dtype == "float32":
+            return store.path("entities")
+        embeddings_path = dataset_dto.get_binary_embeddings()
+
+        try:
+            if not os.path.isfile(embeddings_path) or \
+                    os.path.getmtime(embeddings_path) < \
+                    os.path.getmtime(store.path("entities")):
+                # Other processes may be reading or writing the same file
+                tmp_path = "{}.{}.tmp".format(embeddings_path, os.getpid())
+                with open(tmp_path, "wb") as f:
+                    np.save(f, store.entities().astype('<f4'))
+                os.replace(tmp_path, embeddings_path)
+            return embeddings_path
+        except OSError:
+            return None
+
     # def build_dataset_path(self, dataset_dto):  # TODO deprecated
     #     """Generates a relative path to the dataset from a DTO
     #     :deprecated: See get_binary_path
@@ -302,30 +521,226 @@ class DatasetDAO(data_access_base.MainDAO):
         :returns: The search index or None
         :rtype: tuple
         """
+        search_server, err = self.get_server(dataset_dto,
+                                             ignore_status=ignore_status)
+        if search_server is None:
+            return None, err
+        return search_server.search_index, None
+
+    def get_server(self, dataset_dto, ignore_status=False):
+        """Returns the server with the correct search index loaded.
+
+        Servers are shared by all requests of the same process, so the search
+        index is only loaded the first time, or when it has been replaced by
+        a new one.
+
+        :return: The Server object or None
+        :rtype: tuple
+        """
         # Dataset must be on indexed status
         if dataset_dto.status & INDEXED_MASK == 0 and not ignore_status:
             return None, (409, "Dataset {id} has {status} status and is not "
                           "ready for search".format(**dataset_dto.to_dict()))
-        try:
+
+        def load_server(index_path):
             sch_in = server.SearchIndex()
-            sch_in.load_from_file(dataset_dto.get_binary_index(),
+            sch_in.load_from_file(index_path,
                                   dataset_dto.algorithm['embedding_size'])
-            return sch_in, None
-        except OSError as err:
+            return server.Server(sch_in)
+
+        try:
+            search_server = cache.servers.get(
+                dataset_dto.id, dataset_dto.get_binary_index(), load_server)
+            search_server.neighbour_table = self.get_neighbour_table(
+                dataset_dto)
+            search_server.set_delta_index(self.get_delta_index(dataset_dto))
+            return search_server, None
+        except (OSError, TypeError) as err:
             msg = "The server has encountered an error: '{}'."
             return None, (500, msg.format(err.args))
 
-    def get_server(self):  # TODO: Deprecated
-        """Returns the server with the correct search index loaded.
+    def get_delta_index(self, dataset_dto):
+        """Returns the index of the entities added after the search index
 
-        :return: The Server object or None
+        Delta indexes built for other search index are discarded.
+
+        :returns: The delta index or None
+        :rtype: kgeserver.index.DeltaIndex
+        """
+        def load_delta(folder):
+            delta_index = index.DeltaIndex()
+            delta_index.load(folder)
+            return delta_index
+
+        try:
+            delta_index = cache.delta_indexes.get(
+                dataset_dto.id, dataset_dto.get_binary_delta(), load_delta)
+        except (OSError, TypeError, ValueError, KeyError):
+            return None
+        if delta_index.meta.get("index") != dataset_dto._binary_index:
+            return None
+        return delta_index
+
+    def get_neighbour_table(self, dataset_dto):
+        """Returns the precomputed neighbours of the dataset, if exists
+
+        Tables of a model that has been trained again are discarded.
+
+        :returns: The neighbour table or None
+        :rtype: kgeserver.neighbours.NeighbourTable
+        """
+        def load_table(folder):
+            table = neighbours.NeighbourTable()
+            table.load(folder)
+            return table
+
+        try:
+            table = cache.neighbour_tables.get(
+                dataset_dto.id, dataset_dto.get_binary_neighbours(),
+                load_table)
+            model_mtime = os.path.getmtime(dataset_dto.get_binary_model())
+        except (OSError, TypeError, ValueError, KeyError):
+            return None
+        if table.meta.get("model_mtime") != model_mtime:
+            return None
+        return table
+
+    def get_suggest_index(self, dataset_dto):
+        """Returns the local autocomplete index of the dataset, if exists
+
+        The index is loaded only once for each process, and it is loaded
+        again only if the files on disk change.
+
+        :returns: The autocomplete index or None
+        :rtype: kgeserver.autocomplete.PrefixIndex
+        """
+        def load_prefix_index(folder):
+            prefix_index = autocomplete.PrefixIndex()
+            prefix_index.load_from_folder(folder)
+            return prefix_index
+
+        try:
+            return cache.suggest_indexes.get(
+                dataset_dto.id, dataset_dto.get_binary_suggest_index(),
+                load_prefix_index)
+        except OSError:
+            return None
+
+    def get_tuning(self, dataset_dto):
+        """Returns the results of the last tuning job of the dataset
+
+        Results of a model that has been trained again are discarded.
+
+        :returns: The tuning results, with the recall vs latency curve
+        :rtype: dict
+        """
+        def load_tuning(path):
+            with open(path) as f:
+                return json.load(f)
+
+        try:
+            tuning_results = cache.tunings.get(
+                dataset_dto.id, dataset_dto.get_binary_tuning(), load_tuning)
+            model_mtime = os.path.getmtime(dataset_dto.get_binary_model())
+        except (OSError, TypeError, ValueError):
+            return None
+        if tuning_results.get("model_mtime") != model_mtime:
+            return None
+        return tuning_results
+
+    def get_index_n_trees(self, dataset_dto):
+        """Returns the number of trees of the Annoy index of the dataset
+
+        :returns: The number of trees, or None if it is not an Annoy index
+        :rtype: int
+        """
+        if not dataset_dto._binary_index:
+            return None
+        match = re.search(r"_annoy_(\d+)\.bin$", dataset_dto._binary_index)
+        return int(match.group(1)) if match else None
+
+    def get_index_type(self, dataset_dto):
+        """Returns the type of the search index of the dataset
+
+        :returns: The index type (see kgeserver.index.INDEX_TYPES) or None
+        :rtype: str
+        """
+        if not dataset_dto._binary_index:
+            return None
+        index_path = dataset_dto.get_binary_index()
+        if not os.path.isdir(index_path):
+            return "annoy"
+        try:
+            with open(os.path.join(index_path, index.META_FILE)) as f:
+                return json.load(f)["type"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def get_tuned_settings(self, dataset_dto, current_index=True):
+        """Returns the cheapest search settings that meet the target recall
+
+        The target recall is read from ``TARGET_RECALL``. By default, the
+        settings are chosen for the index currently built for the dataset,
+        and None is returned if the tuning was made for other kind of index.
+
+        :param DTO dataset_dto: The dataset
+        :param bool current_index: If False, settings are chosen among all
+                                   the index configurations tested
+        :returns: A point of the tuning curve (n_trees, search_k, recall...)
+                  or None if the dataset has not been tuned
+        :rtype: dict
+        """
+        tuning_results = self.get_tuning(dataset_dto)
+        if tuning_results is None:
+            return None
+        target = data_access_base._CONFIG_get_target_recall()
+        curve = tuning_results["curve"]
+        if not current_index:
+            return tuning.choose_settings(curve, target)
+
+        if self.get_index_type(dataset_dto) != tuning_results["index_type"]:
+            return None
+        n_trees = self.get_index_n_trees(dataset_dto)
+        if n_trees is not None:
+            return tuning.choose_settings(curve, target, n_trees=n_trees)
+        return tuning.choose_settings(curve, target)
+
+    def preload_datasets(self, progress=None):
+        """Loads on the process caches everything needed to serve datasets
+
+        The vocabulary, search index and autocomplete index of every indexed
+        dataset are loaded. When this is done before the web server forks
+        its workers, all of them share the same memory pages.
+
+        :param function progress: Called as progress(done, total) after
+                                  each dataset
+        :returns: The ids of the datasets loaded and the errors found
         :rtype: tuple
         """
-        search_index, err = self.get_search_index()
-        if search_index is None:
-            return None, err
-        else:
-            return server.Server(search_index), None
+        all_datasets, err = self.get_all_datasets()
+        if all_datasets is None:
+            return [], [str(err)]
+
+        indexed = [dataset_dto for dataset_dto in all_datasets
+                   if dataset_dto.status is not None and
+                   dataset_dto.status & INDEXED_MASK != 0]
+        loaded, errors = [], []
+        for done, dataset_dto in enumerate(indexed):
+            if progress is not None:
+                progress(done, len(indexed))
+            if self.build_vocabulary_object(dataset_dto) is None:
+                errors.append("Dataset {}: vocabulary not found"
+                              .format(dataset_dto.id))
+                continue
+            search_server, err = self.get_server(dataset_dto)
+            if search_server is None:
+                errors.append("Dataset {}: {}".format(dataset_dto.id, err))
+                continue
+            self.get_suggest_index(dataset_dto)
+            loaded.append(dataset_dto.id)
+        if progress is not None:
+            progress(len(indexed), len(indexed))
+        return loaded, errors
 
     def insert_empty_dataset(self, datasetClass, name=None, description=None):
         """Creates an empty dataset on database.
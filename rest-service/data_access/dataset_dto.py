@@ -147,3 +147,49 @@ class DatasetDTO(data_access_base.DTOClass):
         """Return the path of the binary model file
         """
         return os.path.join(self._base, self._binary_model)
+
+    def get_binary_suggest_index(self):
+        """Return the path of the folder with the local autocomplete index
+        """
+        return os.path.join(self._base, self._binary_dataset[:-4] + "_suggest")
+
+    def get_binary_delta(self):
+        """Return the path of the folder with the index of new entities
+        """
+        return os.path.join(self._base, self._binary_dataset[:-4] + "_delta")
+
+    def get_binary_serving(self):
+        """Return the path of the folder with the embeddings to be served
+        """
+        return os.path.join(self._base,
+                            self._binary_dataset[:-4] + "_serving")
+
+    def get_binary_embeddings(self):
+        """Return the path of the file with the exported entity embeddings
+        """
+        return os.path.join(self._base,
+                            self._binary_dataset[:-4] + "_embeddings.npy")
+
+    def get_binary_neighbours(self):
+        """Return the path of the folder with the neighbour table
+        """
+        return os.path.join(self._base,
+                            self._binary_dataset[:-4] + "_neighbours")
+
+    def get_binary_relations(self):
+        """Return the path of the file with the triples sorted by relation
+        """
+        return os.path.join(self._base,
+                            self._binary_dataset[:-4] + "_relations.npz")
+
+    def get_binary_tuning(self):
+        """Return the path of the file with the search index tuning results
+        """
+        return os.path.join(self._base,
+                            self._binary_dataset[:-4] + "_tuning.json")
+
+    def get_binary_vocabulary(self):
+        """Return the path of the file with entities and relations only
+        """
+        return os.path.join(self._base,
+                            self._binary_dataset[:-4] + "_vocab.bin")
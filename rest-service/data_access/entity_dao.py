@@ -22,6 +22,7 @@ import os
 import redis
 import json
 import elasticsearch.exceptions as es_exceptions
+import elasticsearch.helpers as es_helpers
 from elasticsearch import Elasticsearch
 import data_access.data_access_base as data_access_base
 import logging
@@ -51,7 +52,9 @@ class EntityDAO():
         """Data Access Object to interact with autocomplete
 
         The autocomplete is provided by Elasticsearch, and it is not divided
-        by datasets, instead it is divided by dataset type.
+        by datasets, instead it is divided by dataset type. Each entity stores
+        the datasets it belongs to as a context of the completion field, so
+        suggestions are filtered by dataset inside Elasticsearch.
         """
         # TODO: Generate an index on elasticsearch with allowed fields
         # The entity must be loaded with a dataset
@@ -63,9 +66,12 @@ class EntityDAO():
         # Create Elasticsearch object
         self.es = Elasticsearch(self.ELASTIC_ENDPOINT,
                                 http_auth=self.ELASTIC_AUTH)
-        self.index = "entities"
+        # The completion field has a dataset context since "entities_v2".
+        # Older indexes does not have it and must be generated again
+        self.index = "entities_v2"
         self.type = dataset_type
-        self.dataset_id = dataset_id
+        # Context values on Elasticsearch are always strings
+        self.dataset_id = str(dataset_id)
         # Test if index exists, and if not, creates it
         if not self.es.indices.exists(index=self.index):
             self.generate_index(self.index)
@@ -106,7 +112,8 @@ class EntityDAO():
             'analyzer': 'my_custom_analyzer',
             'search_analyzer': 'standard',
             'preserve_separators': False,
-            'preserve_position_increments': False
+            'preserve_position_increments': False,
+            'contexts': [{'name': 'dataset', 'type': 'category'}]
         }
         body['mappings'][self.type]['properties'] = {
             'entity_id': {'type': 'string'},
@@ -122,14 +129,16 @@ class EntityDAO():
             pass
         self.es.indices.create(index=indexName, body=body)
 
-    def suggest_entity(self, input_string):
+    def suggest_entity(self, input_string, size=10):
         """Calls Elasticsearch to get an autocomplete suggestion
 
         Given an input string, calls Elasticsearch to get autocomplete
         suggestions based on "completion" suggester. Gives the results filtered
-        for an specific dataset (already choosen on constructor).
+        for an specific dataset (already choosen on constructor), using the
+        dataset context of the suggest field.
 
         :param str input_string: The string to be asked for
+        :param int size: The maximum number of suggestions
         :rtype: list(EntityDTO)
         :returns: a list of EntityDTO
         """
@@ -138,27 +147,22 @@ class EntityDAO():
           "entities": {
             "text": input_string,
             "completion": {
-                "field": "label_suggest"
+                "field": "label_suggest",
+                "size": size,
+                "contexts": {
+                    "dataset": [self.dataset_id]
+                }
             }
           }
         }
         resp = self.es.suggest(index=self.index, body=request)
 
-        # Filter entities to return only the entities for self.dataset_id
         entities = []
         try:
             for entity in resp['entities'][0]['options']:
-                try:
-                    # Append to entities if dataset_id appears on result
-                    if self.dataset_id in entity['_source']['datasets']:
-                        es_entity = EntityDTO(entity['_source'])
-                        entities.append({"entity": es_entity.to_dict(),
-                                         "text": entity['text']})
-                except KeyError as invalid_key:
-                    # If dataset info is not present, just skip it
-                    if str(invalid_key) != "datasets":
-                        # Re-Raise the error if KeyError is not from 'datasets'
-                        raise
+                es_entity = EntityDTO(entity['_source'])
+                entities.append({"entity": es_entity.to_dict(),
+                                 "text": entity['text']})
 
         except KeyError as invalid_key:
             if str(invalid_key) == "entities":
@@ -166,49 +170,106 @@ class EntityDAO():
                 entities = []
         return entities
 
-    def insert_entity(self, entity):
-        """Insert an entity on Elasticsearch
+    def _entity_update(self, entity):
+        """Builds the id and the update body of an entity
 
-        Inserts the entity on Elasticsearch and stores the dataset it is, in
-        order to get better performance when getting autocomplete predictions
+        The body is a scripted upsert: the same script creates the document
+        if it does not exist and adds the dataset id to the datasets list.
 
         :param dict entity: The entity to be inserted
+        :returns: The elasticsearch id and the update body
+        :rtype: tuple
         """
         # Suggestions to be stored
         alt_labels = entity['alt_label'].values()
         suggestions = list(entity['label'].values()) +\
             list([item for sublist in alt_labels for item in sublist])
-        # Entity document which will be stored on elasticsearch
+        # Entity document which will be stored on elasticsearch. The suggest
+        # field is built by the script, as it depends on stored datasets
         full_doc = {"entity_id": entity['entity_id'],
                     "entity_uri": entity['entity_uri'],
                     "description": entity['description'],
                     "label": entity['label'],
-                    "alt_label": entity['alt_label'],
-                    "label_suggest": suggestions
+                    "alt_label": entity['alt_label']
                     }
         # TODO: Could be useful to use a hash function or similar to avoid
         #       possible URL encoding issues with some entities ID's
         e_uuid = hashlib.md5(entity['entity_uri'].encode('utf-8')).hexdigest()
 
-        insert = self.es.update(index=self.index, doc_type=self.type,
-                                body={"doc": full_doc, "doc_as_upsert": True},
-                                id=e_uuid)
-
-        # Script to update dataset id
+        # Script to update the document and the dataset id
         script = {"inline": "",         # Filled below due to high size
                   "lang": "painless",   # Elasticsearch language
                   "params": {
+                      "doc": full_doc,
+                      "suggestions": suggestions,
                       "dataset": self.dataset_id
                   }}
 
-        script['inline'] = """if (ctx._source.datasets == null) {
+        script['inline'] = """ctx._source.putAll(params.doc);
+        if (ctx._source.datasets == null) {
             ctx._source.datasets = [params.dataset]
         } else if(!ctx._source.datasets.contains(params.dataset)) {
             ctx._source.datasets.add(params.dataset)
-        }"""
-        # TODO: To avoid having two update queries, mix both in one script
-        update = self.es.update(index=self.index, doc_type=self.type,
-                                body={"script": script}, id=e_uuid)
+        }
+        ctx._source.label_suggest = ['input': params.suggestions,
+            'contexts': ['dataset': ctx._source.datasets]];"""
+        body = {"script": script, "scripted_upsert": True, "upsert": {}}
+        return e_uuid, body
+
+    def insert_entity(self, entity):
+        """Insert an entity on Elasticsearch
+
+        Inserts the entity on Elasticsearch and stores the dataset it is, in
+        order to get better performance when getting autocomplete predictions
+
+        :param dict entity: The entity to be inserted
+        """
+        e_uuid, body = self._entity_update(entity)
+        return self.es.update(index=self.index, doc_type=self.type,
+                              body=body, id=e_uuid, retry_on_conflict=3)
+
+    def insert_entities(self, entities, batch_size=500, threads=4):
+        """Insert several entities on Elasticsearch using the bulk API
+
+        Entities are sent on batches of `batch_size` updates, with up to
+        `threads` batches in flight at the same time. The index is refreshed
+        only once, when all the batches have been sent.
+
+        Failures do not stop the insertion. They are returned instead, one
+        item for each entity that could not be inserted.
+
+        :param iterable entities: The entities (dicts) to be inserted
+        :param int batch_size: Number of entities sent on each request
+        :param int threads: Number of requests sent in parallel
+        :returns: The number of entities inserted and a list of failures
+        :rtype: tuple
+        """
+        def bulk_actions():
+            for entity in entities:
+                e_uuid, body = self._entity_update(entity)
+                action = {"_op_type": "update",
+                          "_index": self.index,
+                          "_type": self.type,
+                          "_id": e_uuid,
+                          "_retry_on_conflict": 3}
+                action.update(body)
+                yield action
+
+        inserted = 0
+        failures = []
+        results = es_helpers.parallel_bulk(self.es, bulk_actions(),
+                                           thread_count=threads,
+                                           chunk_size=batch_size,
+                                           raise_on_error=False,
+                                           raise_on_exception=False)
+        for success, item in results:
+            if success:
+                inserted += 1
+            else:
+                failures.append(item)
+
+        self.es.indices.refresh(index=self.index)
+        return inserted, failures
 
     def get_entity_dto(self, entity_uri):
         """Returns an EntityDAO given an entity_id
@@ -222,3 +283,22 @@ class EntityDAO():
 
         except es_exceptions.NotFoundError:
             return EntityDTO({})
+
+    def get_entity_dtos(self, entity_uris):
+        """Returns a list of EntityDTO given a list of entities
+
+        All entities are requested on a single multi-get. Entities that are
+        not found are returned as empty EntityDTO.
+
+        :param list entity_uris: The URIs of the entities
+        :returns: A list of EntityDTO, in the same order
+        :rtype: list
+        """
+        if len(entity_uris) == 0:
+            return []
+        e_uuids = [hashlib.md5(entity_uri.encode('utf-8')).hexdigest()
+                   for entity_uri in entity_uris]
+        response = self.es.mget(index=self.index, doc_type=self.type,
+                                body={"ids": e_uuids})
+        return [EntityDTO(doc['_source']) if doc.get('found') else
+                EntityDTO({}) for doc in response['docs']]
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# label_dao.py: Persistent store of entity labels shared between datasets
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import json
+import data_access.data_access_base as data_access_base
+
+# SQLite does not allow more than 999 variables on a single query
+_QUERY_CHUNK = 500
+
+
+def _lang_matches(tag, lang):
+    """Same semantics as SPARQL LANGMATCHES: 'en-gb' matches 'en'"""
+    return tag == lang or tag.startswith(lang + "-")
+
+
+class LabelDAO(data_access_base.MainDAO):
+    """Stores the labels downloaded from SPARQL endpoints
+
+    Datasets built from the same source usually share a lot of entities, so
+    labels are stored by source (the SPARQL endpoint), entity URI and
+    language, no matter which dataset requested them first. Each row has a
+    timestamp, and rows older than the configured max age are considered
+    missing and will be downloaded again.
+    """
+    def __init__(self):
+        super(LabelDAO, self).__init__()
+        self.max_age = data_access_base._CONFIG_get_label_cache_max_age()
+        # Databases created before this table existed must also work
+        self.execute_query("CREATE TABLE IF NOT EXISTS entity_label "
+                           "(source TEXT, "
+                           "entity_uri TEXT, "
+                           "lang TEXT, "
+                           "label TEXT, "
+                           "description TEXT, "
+                           "alt_label TEXT, "
+                           "updated FLOAT, "
+                           "PRIMARY KEY (source, entity_uri, lang)"
+                           ");")
+
+    def get_labels(self, source, entity_uris, langs):
+        """Returns the cached labels of every entity fresh in all languages
+
+        The values of the returned dict have the same format than
+        `WikidataDataset.entity_labels`: (labels, descriptions, alt_labels).
+        Entities not present on the returned dict must be downloaded again.
+
+        :param str source: The source of the labels (SPARQL endpoint)
+        :param list entity_uris: The URIs of the entities to look for
+        :param list langs: A list of languages in ISO 639-1 format
+        :returns: A dict with the labels of each entity found
+        :rtype: dict
+        """
+        min_updated = time.time() - self.max_age
+        lang_marks = ",".join("?" * len(langs))
+        found = {}
+        for start in range(0, len(entity_uris), _QUERY_CHUNK):
+            chunk = entity_uris[start:start + _QUERY_CHUNK]
+            query = ("SELECT * FROM entity_label WHERE source=? AND "
+                     "updated>=? AND lang IN ({0}) AND entity_uri IN ({1}) ;"
+                     .format(lang_marks, ",".join("?" * len(chunk))))
+            rows = self.execute_query(query, source, min_updated,
+                                      *(list(langs) + list(chunk)))
+            for row in rows:
+                found.setdefault(row['entity_uri'], []).append(row)
+
+        labels = {}
+        for entity_uri, rows in found.items():
+            # Only entities with every language cached are valid hits
+            if len(set(row['lang'] for row in rows)) < len(set(langs)):
+                continue
+            label, description, alt_label = {}, {}, {}
+            for row in rows:
+                label.update(json.loads(row['label']))
+                description.update(json.loads(row['description']))
+                alt_label.update(json.loads(row['alt_label']))
+            labels[entity_uri] = (label, description, alt_label)
+        return labels
+
+    def set_labels(self, source, entity_labels, langs):
+        """Stores the labels of several entities on the database
+
+        Labels are split by the requested language, so an entity that has no
+        label on one language is also stored (and will not be requested again
+        until it expires).
+
+        :param str source: The source of the labels (SPARQL endpoint)
+        :param dict entity_labels: Entity URI as key and a tuple
+                                   (labels, descriptions, alt_labels) as value
+        :param list langs: The languages that were requested
+        """
+        now = time.time()
+        rows = []
+        for entity_uri, (label, description, alt_label) in \
+                entity_labels.items():
+            for lang in langs:
+                rows.append((
+                    source, entity_uri, lang,
+                    json.dumps({k: v for k, v in label.items()
+                                if _lang_matches(k, lang)}),
+                    json.dumps({k: v for k, v in description.items()
+                                if _lang_matches(k, lang)}),
+                    json.dumps({k: v for k, v in alt_label.items()
+                                if _lang_matches(k, lang)}),
+                    now))
+        query = ("INSERT OR REPLACE INTO entity_label (source, entity_uri, "
+                 "lang, label, description, alt_label, updated) VALUES "
+                 "(?, ?, ?, ?, ?, ?, ?) ;")
+        self.execute_many(query, rows)
+        return True, None
@@ -21,6 +21,8 @@
 import json
 import copy
 import falcon
+import numpy as np
+from multiprocessing.pool import ThreadPool
 import kgeserver.server as server
 import endpoints.common_hooks as common_hooks
 
@@ -29,6 +31,8 @@ import sys
 sys.path.insert(0, '..')
 try:
     import data_access
+    import data_access.cache as cache
+    import data_access.data_access_base as data_access_base
     import async_server.tasks as async_tasks
 except ImportError:
     raise
@@ -53,9 +57,168 @@ def read_pair_list(req, resp, resource, params):
         raise falcon.HTTPMissingParam(err(str))
 
 
+def cached_search(dataset_dto, query, limit, search_k, search):
+    """Returns the result of search, which may be already cached
+
+    :param DTO dataset_dto: The dataset the search is made on
+    :param query: The entity id or the embedding vector searched
+    :param int limit: The number of results
+    :param int search_k: The number of nodes inspected
+    :param function search: Makes the search on the search index
+    :returns: A list of pairs (entity id, distance)
+    :rtype: list
+    """
+    try:
+        key = cache.similarity_key(dataset_dto.id,
+                                   dataset_dto.get_binary_index(),
+                                   query, limit, search_k,
+                                   dataset_dto.get_binary_delta())
+    except (OSError, TypeError, ValueError):
+        # The search will fail or the query can't be hashed
+        return search()
+    return cache.results.get(key, search)
+
+
+def search_by_id(dataset_dto, search_server, entity_id, limit, search_k,
+                 allowed=None):
+    """Returns the entities most similar to an entity of the dataset
+
+    Results read from a neighbour table are not cached, as reading them is
+    already a single lookup. Neither are filtered results.
+
+    :param DTO dataset_dto: The dataset the search is made on
+    :param Server search_server: The server of the dataset
+    :param int entity_id: The entity id
+    :param int limit: The number of results
+    :param int search_k: The number of nodes inspected
+    :param np.ndarray allowed: The entities allowed by a filter, or None.
+                               The entity itself is always returned
+    :returns: A list of pairs (entity id, distance)
+    :rtype: list
+    """
+    if allowed is not None:
+        return search_server.similarity_by_id(
+            entity_id, limit, search_k=search_k,
+            allowed=np.append(allowed, entity_id))
+    if search_server.has_neighbours(limit):
+        return search_server.similarity_by_id(entity_id, limit)
+    return cached_search(dataset_dto, entity_id, limit, search_k,
+                         lambda: search_server.similarity_by_id(
+                             entity_id, limit, search_k=search_k))
+
+
+def search_by_embedding(dataset_dto, search_server, embedding, limit,
+                        search_k, allowed=None):
+    """Returns the entities most similar to an embedding vector
+
+    :param DTO dataset_dto: The dataset the search is made on
+    :param Server search_server: The server of the dataset
+    :param list embedding: The embedding vector
+    :param int limit: The number of results
+    :param int search_k: The number of nodes inspected
+    :param np.ndarray allowed: The entities allowed by a filter, or None
+    :returns: A list of pairs (entity id, distance)
+    :rtype: list
+    """
+    if allowed is not None:
+        return search_server.similarity_by_embedding(
+            embedding, limit, search_k=search_k, allowed=allowed)
+    return cached_search(dataset_dto, embedding, limit, search_k,
+                         lambda: search_server.similarity_by_embedding(
+                             embedding, limit, search_k=search_k))
+
+
+def read_filters(req, filters=None):
+    """Returns the filter of a similarity search
+
+    It is read from the body (already parsed) or from the query params
+    filter_entities, filter_relation and filter_object.
+
+    :param filters: The filter object of the body, if any
+    :returns: A dict with entities, relation and object keys, or None
+    :rtype: dict
+    """
+    if filters is None:
+        filters = {"entities": req.get_param_as_list("filter_entities"),
+                   "relation": req.get_param("filter_relation"),
+                   "object": req.get_param("filter_object")}
+    if not isinstance(filters, dict):
+        raise falcon.HTTPInvalidParam("Must be an object", "filter")
+    filters = {key: filters.get(key)
+               for key in ("entities", "relation", "object")}
+    if filters["entities"] is not None and \
+            not isinstance(filters["entities"], list):
+        raise falcon.HTTPInvalidParam("Must be a list of entities",
+                                      "filter.entities")
+    if filters["object"] is not None and filters["relation"] is None:
+        raise falcon.HTTPMissingParam("filter.relation")
+    if filters["entities"] is None and filters["relation"] is None:
+        return None
+    return filters
+
+
+def allowed_entities(dataset_dao, dataset_dto, dataset, filters):
+    """Returns the ids of the entities that pass a filter
+
+    An entity passes it if it is on the entities list, and if it is the
+    subject of a triple with the relation (and the object) given, when
+    they are given.
+
+    :param DatasetDAO dataset_dao: The dataset DAO
+    :param DTO dataset_dto: The dataset the search is made on
+    :param Vocabulary dataset: The vocabulary of the dataset
+    :param dict filters: The filter returned by read_filters, or None
+    :returns: The sorted entity ids, or None if there is no filter
+    :rtype: np.ndarray
+    """
+    if filters is None:
+        return None
+    allowed = None
+    if filters["entities"] is not None:
+        ids = [dataset.get_entity_id(entity)
+               for entity in filters["entities"]]
+        allowed = np.unique(np.array([entity_id for entity_id in ids
+                                      if entity_id is not None],
+                                     dtype=np.int64))
+    if filters["relation"] is not None:
+        relation_index = dataset_dao.get_relation_index(dataset_dto)
+        if relation_index is None:
+            raise falcon.HTTPNotFound(
+                description="The binary dataset file can't be found")
+        relation_id = dataset.get_relation_id(filters["relation"])
+        object_id = None
+        if filters["object"] is not None:
+            object_id = dataset.get_entity_id(filters["object"])
+        if relation_id is None or \
+                (filters["object"] is not None and object_id is None):
+            subjects = np.zeros(0, dtype=np.int64)
+        else:
+            subjects = relation_index.find_subjects(relation_id, object_id)
+        allowed = subjects if allowed is None else \
+            np.intersect1d(allowed, subjects)
+    return allowed
+
+
+def default_search_k(dataset_dao, dataset_dto):
+    """Returns the search_k used when it is not given on the request
+
+    It is the cheapest one that meets the target recall on the last tuning
+    of the dataset, or -1 (the default of the index) if it is not tuned.
+
+    :param DatasetDAO dataset_dao: The dataset DAO
+    :param DTO dataset_dto: The dataset the search is made on
+    :rtype: int
+    """
+    settings = dataset_dao.get_tuned_settings(dataset_dto)
+    if settings is None:
+        return -1
+    return settings["search_k"]
+
+
 class PredictSimilarEntitiesResource(object):
     # TODO: Refactor this class using hooks
-    def on_get(self, req, resp, dataset_id, entity, embedding=False):
+    def on_get(self, req, resp, dataset_id, entity, embedding=False,
+               filters=None):
         """Makes HTTP response for a SimilarEntities search
 
         It may be used directly with get, but it is discouraged. This method
@@ -64,11 +227,17 @@ class PredictSimilarEntitiesResource(object):
         :param int dataset_id: The dataset identifier on database
         :param string entity: Can be either identifier or embedding vector
         :param boolean embedding: True if entity param is an embedding
+        :param dict filters: The filter object of the body, if any
         :query int limit: Limit of similar entities returned.
                           By default is set to 10
+        :query list filter_entities: Only return these entities
+        :query str filter_relation: Only return subjects of this relation
+        :query str filter_object: With filter_relation, only return subjects
+                                  of triples with this object
         :query int search_k: Maximum number of nodes where the search is made.
                              The higher this param is, the higher quality is,
-                             but the performance is worse. Defaults to -1
+                             but the performance is worse. Defaults to the
+                             tuned value (see tune_index), or -1
         :returns: None
         """
         # Get dataset
@@ -82,16 +251,17 @@ class PredictSimilarEntitiesResource(object):
         if ignore is None:
             ignore = False
 
-        dataset = dataset_dao.build_dataset_object(dataset_dto)  # TODO: design
+        dataset = dataset_dao.build_vocabulary_object(dataset_dto)
+        if dataset is None:
+            raise falcon.HTTPNotFound(
+                description="The binary dataset file can't be found")
 
         # Get server to do 'queries'
-        search_index, err = dataset_dao.get_search_index(dataset_dto,
-                                                         ignore_status=ignore)
-        if search_index is None:
+        search_server, err = dataset_dao.get_server(dataset_dto,
+                                                    ignore_status=ignore)
+        if search_server is None:
             msg_title = "Dataset not ready perform search operation"
             raise falcon.HTTPConflict(title=msg_title, description=str(err))
-        # TODO: Maybe extract server management anywhere to simplify this
-        search_server = server.Server(search_index)
 
         # Dig for the limit param on Query Params
         limit = req.get_param_as_int('limit')
@@ -103,12 +273,16 @@ class PredictSimilarEntitiesResource(object):
         # Dig for the search_k param on Query Params
         search_k = req.get_param_as_int('search_k')
         if search_k is None:
-            search_k = -1
+            search_k = default_search_k(dataset_dao, dataset_dto)
+
+        filters = read_filters(req, filters)
+        allowed = allowed_entities(dataset_dao, dataset_dto, dataset, filters)
 
         # If looking for similar_entities given an embedding vector
         if embedding:
-            similar_entities = search_server.similarity_by_embedding(
-                entity, limit, search_k=search_k)
+            similar_entities = search_by_embedding(
+                dataset_dto, search_server, entity, limit, search_k,
+                allowed=allowed)
             similar_entities = [{"entity": dataset.get_entity(e_id),
                                  "distance": dist}
                                 for e_id, dist in similar_entities]
@@ -119,25 +293,27 @@ class PredictSimilarEntitiesResource(object):
             }
         # If looking for similar_entities given an entity
         else:
-            entity_dao = data_access.EntityDAO(dataset_dto.dataset_type,
-                                               dataset_id)
             entity_id = dataset.get_entity_id(entity)
             if entity_id is None:
                 raise falcon.HTTPNotFound(
                     description="The {} entity can't be found inside dataset."
                     .format(entity))
-            sim_entities = search_server.similarity_by_id(
-                entity_id, limit, search_k=search_k)
+            sim_entities = search_by_id(dataset_dto, search_server,
+                                        entity_id, limit, search_k,
+                                        allowed=allowed)
 
-            def getEntityDTO(e_id):
-                entity = dataset.check_entity(dataset.get_entity(e_id))
-                entity_dto = entity_dao.get_entity_dto(entity)
-                return entity_dto.to_dict()
             if req.get_param_as_bool('object'):
+                entity_dao = data_access.EntityDAO(dataset_dto.dataset_type,
+                                                   dataset_id)
+                # All entities are requested at once to the search database
+                entity_dtos = entity_dao.get_entity_dtos(
+                    [dataset.check_entity(dataset.get_entity(e_id))
+                     for e_id, dist in sim_entities])
                 similar_entities = [{"entity": dataset.get_entity(e_id),
-                                     "object": getEntityDTO(e_id),
+                                     "object": entity_dto.to_dict(),
                                      "distance": dist}
-                                    for e_id, dist in sim_entities]
+                                    for (e_id, dist), entity_dto
+                                    in zip(sim_entities, entity_dtos)]
             else:
                 similar_entities = [{"entity": dataset.get_entity(e_id),
                                      "distance": dist}
@@ -156,6 +332,8 @@ class PredictSimilarEntitiesResource(object):
                 "response": similar_entities
             }
         }
+        if filters is not None:
+            response["similar_entities"]["filter"] = filters
         resp.body = json.dumps(response)
         resp.content_type = 'application/json'
         resp.status = falcon.HTTP_200
@@ -174,17 +352,27 @@ class PredictSimilarEntitiesResource(object):
           {"value": "http://www.wikidata.org/entity/Q1492", "type": "uri"}
         }
 
+        It may contain a filter object too, with the same params than the
+        query (entities, relation and object):
+
+        { "entity": {...},
+          "filter": {"relation": "http://www.wikidata.org/prop/direct/P31",
+                     "object": "http://www.wikidata.org/entity/Q5"}
+        }
+
         :param int dataset_id: The dataset identifier on database
         :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
         """
         body = json.loads(req.stream.read().decode('utf-8'))
         if 'entity' in body and 'type' in body['entity']:
             if body['entity']['type'].lower() == "uri":
-                self.on_get(req, resp, dataset_id, body['entity']['value'])
+                self.on_get(req, resp, dataset_id, body['entity']['value'],
+                            filters=body.get('filter'))
                 return
             if body['entity']['type'].lower() == "embedding":
                 self.on_get(req, resp, dataset_id,
-                            body['entity']['value'], embedding=True)
+                            body['entity']['value'], embedding=True,
+                            filters=body.get('filter'))
                 return
             else:
                 errmsg = ("The type '{}' of the entity {} is not recognized. "
@@ -199,6 +387,333 @@ class PredictSimilarEntitiesResource(object):
         resp.status = falcon.HTTP_400
 
 
+def read_entities_list(req, resp, resource, params):
+    """Reads a list of entities (URIs or embedding vectors) from the body
+
+    Entities without type are considered URIs.
+    """
+    body = common_hooks.read_body_as_json(req)
+    if not isinstance(body, dict) or "entities" not in body:
+        raise falcon.HTTPMissingParam("entities")
+    if not isinstance(body["entities"], list):
+        raise falcon.HTTPInvalidParam(
+            "Must be a list of entities", "entities")
+
+    entities = []
+    for entity in body["entities"]:
+        if not isinstance(entity, dict):
+            entity = {"value": entity, "type": "uri"}
+        if "value" not in entity or \
+                entity.get("type", "uri").lower() not in ("uri", "embedding"):
+            raise falcon.HTTPInvalidParam(
+                "The entity {} is not valid. Please, take a look to the "
+                "documentation.".format(entity), "entities")
+        entities.append({"value": entity["value"],
+                         "type": entity.get("type", "uri").lower()})
+    params["entities"] = entities
+    params["filters"] = body.get("filter")
+
+
+class BatchSimilarEntitiesResource():
+    @falcon.before(read_entities_list)
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_post(self, req, resp, dataset_id, dataset_dto, entities, filters):
+        """Looks for the similar entities of several entities at once
+
+        The body contains a list of entities, with the same format than
+        the similar_entities resource:
+
+        {"entities": [
+            {"value": "http://www.wikidata.org/entity/Q1492", "type": "uri"},
+            {"value": [0.12, -0.4, ...], "type": "embedding"}
+        ]}
+
+        Searches are made on a pool of threads, and the response is streamed
+        as newline delimited JSON, one line for each entity in the same order.
+
+        :param int dataset_id: The dataset identifier on database
+        :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
+        :param list entities: The entities to search (from hook)
+        :param dict filters: The filter applied to all searches (from hook)
+        :query int limit: Limit of similar entities returned for each entity
+        :query int search_k: Maximum number of nodes where the search is made
+        """
+        dataset_dao = data_access.DatasetDAO()
+
+        ignore = req.get_param_as_bool("ignore_status")
+        if ignore is None:
+            ignore = False
+
+        dataset = dataset_dao.build_vocabulary_object(dataset_dto)
+        if dataset is None:
+            raise falcon.HTTPNotFound(
+                description="The binary dataset file can't be found")
+
+        search_server, err = dataset_dao.get_server(dataset_dto,
+                                                    ignore_status=ignore)
+        if search_server is None:
+            msg_title = "Dataset not ready perform search operation"
+            raise falcon.HTTPConflict(title=msg_title, description=str(err))
+
+        limit = req.get_param_as_int('limit')
+        if limit is None:
+            limit = 10
+        # Needed because server returns also the identical entity
+        limit = int(limit) + 1
+
+        search_k = req.get_param_as_int('search_k')
+        if search_k is None:
+            search_k = default_search_k(dataset_dao, dataset_dto)
+
+        allowed = allowed_entities(dataset_dao, dataset_dto, dataset,
+                                   read_filters(req, filters))
+
+        def search_entity(entity):
+            result = {"entity": entity}
+            if entity["type"] == "uri":
+                entity_id = dataset.get_entity_id(entity["value"])
+                if entity_id is None:
+                    result["error"] = {
+                        "status": 404,
+                        "message": "The entity can't be found inside dataset."
+                    }
+                    return result
+                similar = search_by_id(dataset_dto, search_server,
+                                       entity_id, limit, search_k,
+                                       allowed=allowed)
+            else:
+                try:
+                    similar = search_by_embedding(
+                        dataset_dto, search_server, entity["value"], limit,
+                        search_k, allowed=allowed)
+                except (IndexError, TypeError, ValueError) as err:
+                    result["error"] = {"status": 400, "message": str(err)}
+                    return result
+            result["similar_entities"] = [{"entity": dataset.get_entity(e_id),
+                                           "distance": dist}
+                                          for e_id, dist in similar]
+            return result
+
+        def stream_results():
+            # Annoy releases the GIL while searching
+            threads = data_access_base._CONFIG_get_batch_search_threads()
+            pool = ThreadPool(threads)
+            try:
+                for result in pool.imap(search_entity, entities, chunksize=8):
+                    yield (json.dumps(result) + "\n").encode('utf-8')
+            finally:
+                pool.terminate()
+
+        resp.stream = stream_results()
+        resp.content_type = 'application/x-ndjson'
+        resp.status = falcon.HTTP_200
+
+
+class LinkPredictionResource():
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_get(self, req, resp, dataset_id, dataset_dto):
+        """Predicts the missing entity of a triple with the trained model
+
+        Given a subject and a relation, returns the objects that best
+        complete the triple (subject, relation, ?). Given an object and a
+        relation, returns the best subjects of (?, relation, object). All
+        entities are scored with the model, and the triples that already
+        exist on the dataset are skipped.
+
+        :param int dataset_id: The dataset identifier on database
+        :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
+        :query str subject: The subject of the triple, to predict objects
+        :query str object: The object of the triple, to predict subjects
+        :query str relation: The relation of the triple
+        :query int limit: Number of entities returned. Defaults to 10
+        :query bool filter: Skip triples of the dataset. Defaults to true
+        :query bool approximate: Only score the entities found on the search
+                                 index (TransE models). Faster on very
+                                 large datasets, but may miss some results
+        :query int search_k: Nodes inspected on the approximate mode
+        :returns: A prediction object with entities and scores
+        """
+        dataset_dao = data_access.DatasetDAO()
+        dataset = dataset_dao.build_vocabulary_object(dataset_dto)
+        if dataset is None:
+            raise falcon.HTTPNotFound(
+                description="The binary dataset file can't be found")
+
+        predictor, err = dataset_dao.get_link_predictor(dataset_dto)
+        if predictor is None:
+            msg_title = "Dataset not ready to predict triples"
+            raise falcon.HTTPConflict(title=msg_title, description=str(err))
+
+        subject = req.get_param("subject")
+        obj = req.get_param("object")
+        relation = req.get_param("relation", required=True)
+        if (subject is None) == (obj is None):
+            raise falcon.HTTPInvalidParam(
+                "Give either a subject or an object", "subject")
+        predict_objects = subject is not None
+        entity = subject if predict_objects else obj
+
+        entity_id = dataset.get_entity_id(entity)
+        if entity_id is None:
+            raise falcon.HTTPNotFound(
+                description="The {} entity can't be found inside dataset."
+                .format(entity))
+        relation_id = dataset.get_relation_id(relation)
+        if relation_id is None:
+            raise falcon.HTTPNotFound(
+                description="The {} relation can't be found inside dataset."
+                .format(relation))
+        if entity_id >= predictor.store.n_entities or \
+                relation_id >= predictor.store.n_relations:
+            msg_title = "Entity or relation added after training"
+            raise falcon.HTTPConflict(
+                title=msg_title,
+                description="The model must be trained again to predict "
+                            "triples with them")
+
+        limit = req.get_param_as_int("limit")
+        if limit is None:
+            limit = 10
+        filter_known = req.get_param_as_bool("filter")
+        if filter_known is None:
+            filter_known = True
+        if filter_known and predictor.relation_index is None:
+            raise falcon.HTTPNotFound(
+                description="The binary dataset file can't be found")
+
+        search_index = None
+        search_k = req.get_param_as_int("search_k")
+        if req.get_param_as_bool("approximate"):
+            search_server, err = dataset_dao.get_server(dataset_dto)
+            if search_server is None:
+                msg_title = "Dataset not ready perform search operation"
+                raise falcon.HTTPConflict(title=msg_title,
+                                          description=str(err))
+            search_index = search_server.index
+            if search_k is None:
+                search_k = default_search_k(dataset_dao, dataset_dto)
+        if search_k is None:
+            search_k = -1
+
+        predictions = predictor.predict(
+            entity_id, relation_id, limit, objects=predict_objects,
+            filter_known=filter_known, search_index=search_index,
+            search_k=search_k)
+
+        response = {
+            "dataset": dataset_dto.to_dict(),
+            "prediction": {
+                "subject": subject,
+                "relation": relation,
+                "object": obj,
+                "limit": len(predictions),
+                "filter": filter_known,
+                "approximate": search_index is not None,
+                "response": [{"entity": dataset.get_entity(e_id),
+                              "score": score}
+                             for e_id, score in predictions]
+            }
+        }
+        resp.body = json.dumps(response)
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_200
+
+
+def read_triples_list(req, resp, resource, params):
+    """Reads a list of triples [subject, relation, object] from the body"""
+    body = common_hooks.read_body_as_json(req)
+    if not isinstance(body, dict) or "triples" not in body:
+        raise falcon.HTTPMissingParam("triples")
+    if not isinstance(body["triples"], list):
+        raise falcon.HTTPInvalidParam("Must be a list of triples", "triples")
+    for triple in body["triples"]:
+        if not isinstance(triple, list) or len(triple) != 3 or \
+                not all(isinstance(value, str) for value in triple):
+            raise falcon.HTTPInvalidParam(
+                "The triple {} is not valid. It must be a list with a "
+                "subject, a relation and an object".format(triple),
+                "triples")
+    params["triples"] = body["triples"]
+
+
+class ScoreTriplesResource():
+    # Number of triples converted to ids and scored at once
+    CHUNK_SIZE = 65536
+
+    @falcon.before(read_triples_list)
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_post(self, req, resp, dataset_id, dataset_dto, triples):
+        """Scores several triples with the trained model
+
+        The body contains a list of triples, as lists of URIs:
+
+        {"triples": [
+            ["http://www.wikidata.org/entity/Q1492",
+             "http://www.wikidata.org/prop/direct/P17",
+             "http://www.wikidata.org/entity/Q29"]
+        ]}
+
+        Triples are scored by chunks with the model, and the response is
+        streamed as newline delimited JSON, one line for each triple in the
+        same order.
+
+        :param int dataset_id: The dataset identifier on database
+        :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
+        :param list triples: The triples to score (from hook)
+        """
+        dataset_dao = data_access.DatasetDAO()
+        dataset = dataset_dao.build_vocabulary_object(dataset_dto)
+        if dataset is None:
+            raise falcon.HTTPNotFound(
+                description="The binary dataset file can't be found")
+
+        predictor, err = dataset_dao.get_link_predictor(dataset_dto)
+        if predictor is None:
+            msg_title = "Dataset not ready to predict triples"
+            raise falcon.HTTPConflict(title=msg_title, description=str(err))
+
+        def score_chunk(chunk):
+            ids = [(dataset.get_entity_id(subject),
+                    dataset.get_relation_id(relation),
+                    dataset.get_entity_id(obj))
+                   for subject, relation, obj in chunk]
+            found = np.array([None not in triple_ids for triple_ids in ids],
+                             dtype=bool)
+            ids = np.array([triple_ids if is_found else (0, 0, 0)
+                            for triple_ids, is_found in zip(ids, found)],
+                           dtype=np.int64).reshape(-1, 3)
+            # Entities and relations added after training have no embedding
+            found &= (ids[:, 0] < predictor.store.n_entities) & \
+                (ids[:, 1] < predictor.store.n_relations) & \
+                (ids[:, 2] < predictor.store.n_entities)
+            scores = np.zeros(len(chunk), dtype=np.float32)
+            scores[found] = predictor.score_triples(
+                ids[found, 0], ids[found, 1], ids[found, 2])
+            lines = []
+            for triple, is_found, score in zip(chunk, found.tolist(),
+                                               scores.tolist()):
+                result = {"triple": triple}
+                if is_found:
+                    result["score"] = score
+                else:
+                    result["error"] = {
+                        "status": 404,
+                        "message": "The entity or relation can't be found "
+                                   "inside dataset."
+                    }
+                lines.append(json.dumps(result) + "\n")
+            # One write for each chunk, instead of one for each triple
+            return "".join(lines).encode('utf-8')
+
+        def stream_results():
+            for start in range(0, len(triples), self.CHUNK_SIZE):
+                yield score_chunk(triples[start:start + self.CHUNK_SIZE])
+
+        resp.stream = stream_results()
+        resp.content_type = 'application/x-ndjson'
+        resp.status = falcon.HTTP_200
+
+
 class DistanceTriples():
     @falcon.before(read_pair_list)
     @falcon.before(common_hooks.check_dataset_exsistence)
@@ -217,15 +732,16 @@ class DistanceTriples():
         :rtype: dict
         """
         dataset_dao = data_access.DatasetDAO()
-        dataset = dataset_dao.build_dataset_object(dataset_dto)  # TODO: design
+        dataset = dataset_dao.build_vocabulary_object(dataset_dto)
+        if dataset is None:
+            raise falcon.HTTPNotFound(
+                description="The binary dataset file can't be found")
 
         # Get server to do 'queries'
-        search_index, err = dataset_dao.get_search_index(dataset_dto)
-        if search_index is None:
+        search_server, err = dataset_dao.get_server(dataset_dto)
+        if search_server is None:
             msg_title = "Dataset not ready perform search operation"
             raise falcon.HTTPConflict(title=msg_title, description=str(err))
-        # TODO: Maybe extract server management anywhere to simplify this
-        search_server = server.Server(search_index)
         entity_x, entity_y = entities_pair
         id_x = dataset.get_entity_id(entity_x)
         id_y = dataset.get_entity_id(entity_y)
@@ -242,16 +758,130 @@ class DistanceTriples():
         resp.status = falcon.HTTP_200
 
 
+def read_distance_lists(req, resp, resource, params):
+    """Reads the entities (and other entities) of a distance matrix"""
+    body = common_hooks.read_body_as_json(req)
+    if not isinstance(body, dict) or "entities" not in body:
+        raise falcon.HTTPMissingParam("entities")
+    for key in ("entities", "other_entities"):
+        entities = body.get(key)
+        if entities is None and key == "other_entities":
+            continue
+        if not isinstance(entities, list) or not entities or \
+                not all(isinstance(entity, str) for entity in entities):
+            raise falcon.HTTPInvalidParam(
+                "Must be a non empty list of entities", key)
+    params["entities"] = body["entities"]
+    params["other_entities"] = body.get("other_entities")
+
+
+class DistanceMatrix():
+    @falcon.before(read_distance_lists)
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_post(self, req, resp, dataset_id, dataset_dto, entities,
+                other_entities):
+        """Returns the distances between two lists of entities
+
+        The body contains a list of entities and, optionally, other list:
+
+        {"entities": ["http://www.wikidata.org/entity/Q1492",
+                      "http://www.wikidata.org/entity/Q2807"],
+         "other_entities": ["http://www.wikidata.org/entity/Q5682"]}
+
+        Without other_entities, the distances between all pairs of entities
+        are returned. All distances are computed with blocked matrix
+        products, instead of one request for each pair.
+
+        :param int dataset_id: The dataset identifier on database
+        :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
+        :param list entities: The entities of the rows (from hook)
+        :param list other_entities: The entities of the columns (from hook)
+        :query str format: dense (default) returns the whole matrix, pairs
+                           returns the closest pairs only
+        :query int limit: Number of pairs returned. Defaults to 100
+        :query float max_distance: Only return pairs closer than this
+        :returns: A distance matrix or a list of pairs
+        :rtype: dict
+        """
+        dataset_dao = data_access.DatasetDAO()
+        dataset = dataset_dao.build_vocabulary_object(dataset_dto)
+        if dataset is None:
+            raise falcon.HTTPNotFound(
+                description="The binary dataset file can't be found")
+
+        search_server, err = dataset_dao.get_server(dataset_dto)
+        if search_server is None:
+            msg_title = "Dataset not ready perform search operation"
+            raise falcon.HTTPConflict(title=msg_title, description=str(err))
+
+        def entity_ids(entities):
+            ids = [dataset.get_entity_id(entity) for entity in entities]
+            missing = [entity for entity, entity_id in zip(entities, ids)
+                       if entity_id is None]
+            if missing:
+                raise falcon.HTTPNotFound(
+                    description="The entities {} can't be found on the "
+                    "dataset".format(missing[:10]))
+            return ids
+
+        rows = entity_ids(entities)
+        columns = None if other_entities is None else \
+            entity_ids(other_entities)
+
+        matrix_format = req.get_param("format")
+        if matrix_format is None:
+            matrix_format = "dense"
+        if matrix_format == "dense":
+            n_columns = len(rows) if columns is None else len(columns)
+            max_size = data_access_base._CONFIG_get_max_distance_matrix()
+            if len(rows) * n_columns > max_size:
+                raise falcon.HTTPInvalidParam(
+                    "The matrix has more than {} distances. Use the pairs "
+                    "format instead".format(max_size), "format")
+            distances = search_server.distance_matrix(rows, columns)
+            response = {
+                "entities": entities,
+                "other_entities": other_entities or entities,
+                "distances": distances.tolist()
+            }
+        elif matrix_format == "pairs":
+            limit = req.get_param_as_int("limit")
+            if limit is None:
+                limit = 100
+            max_distance = req.get_param("max_distance")
+            if max_distance is not None:
+                try:
+                    max_distance = float(max_distance)
+                except ValueError:
+                    raise falcon.HTTPInvalidParam("Must be a number",
+                                                  "max_distance")
+            pairs = search_server.closest_pairs(
+                rows, columns, n_pairs=limit, max_distance=max_distance)
+            response = {
+                "pairs": [{"entities": [dataset.get_entity(x),
+                                        dataset.get_entity(y)],
+                           "distance": dist}
+                          for x, y, dist in pairs]
+            }
+        else:
+            raise falcon.HTTPInvalidParam("Must be dense or pairs", "format")
+
+        resp.body = json.dumps(response)
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_200
+
+
 class SuggestEntityName():
     @falcon.before(common_hooks.check_dataset_exsistence)
     def on_post(self, req, resp, dataset_id, dataset_dto):
         """Return suggests to use with autocomplete
 
         This method will return suggestions to be used on frontend while users
-        input the entity name.
+        input the entity name. Only entities that exists on the dataset are
+        returned.
 
-        TODO: this should only return entities that exists on dataset, right
-        now returns all possible entities.
+        If the dataset has a local autocomplete index (built along with the
+        Elasticsearch one) it will be used instead of Elasticsearch.
 
         :param int dataset_id: The id of the dataset to autocomplete
         :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
@@ -264,11 +894,19 @@ class SuggestEntityName():
             input_text = body['input']
         except KeyError as err:
             raise falcon.HTTPMissingParam("input")
-        entity_dao = data_access.EntityDAO(dataset_dto.dataset_type,
-                                           dataset_id)
+        # Use the local autocomplete index if it has been built
+        dataset_dao = data_access.DatasetDAO()
+        prefix_index = dataset_dao.get_suggest_index(dataset_dto)
+        if prefix_index is not None:
+            suggestion = [{"entity": data_access.EntityDTO(doc).to_dict(),
+                           "text": text}
+                          for doc, text in prefix_index.suggest(input_text)]
+        else:
+            entity_dao = data_access.EntityDAO(dataset_dto.dataset_type,
+                                               dataset_id)
 
-        # Extract suggestion from elasticsearch
-        suggestion = entity_dao.suggest_entity(input_text)
+            # Extract suggestion from elasticsearch
+            suggestion = entity_dao.suggest_entity(input_text)
 
         # Return a response
         resp.body = json.dumps(suggestion)
@@ -22,6 +22,7 @@ import json
 import copy
 import falcon
 import kgeserver.server as server
+import kgeserver.index as index
 import endpoints.common_hooks as common_hooks
 
 # Import parent directory (data_access)
@@ -29,6 +30,7 @@ import sys
 sys.path.insert(0, '..')
 try:
     import data_access
+    import data_access.data_access_base as data_access_base
     import async_server.tasks as async_tasks
 except ImportError:
     raise
@@ -115,16 +117,66 @@ class DatasetIndex():
 
         This task may take long time to complete, so it uses tasks.
 
-        :query int n_trees: The number of trees generated
+        :query int n_trees: The number of trees generated. By default, the
+                            tuned value (see DatasetTuning) or 100
+        :query str index_type: annoy (default), exact, ivf, pq or reduced
+        :query int n_lists: The number of lists of an ivf index
+        :query int nprobe: The lists inspected by default on an ivf index
+        :query int n_subspaces: The bytes of each vector on a pq index
+        :query bool rerank: Keep full vectors to re-rank pq results
+        :query int n_components: The dimension of a reduced index
+        :query str projection: pca (default) or random, on a reduced index
+        :query str inner_type: The index of the projected vectors of a
+                               reduced index. Default is annoy
+        :query int rerank_factor: Candidates re-ranked for each result on a
+                                  reduced index
         :param id dataset_id: The dataset to insert triples into
         :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
         """
 
         # Dig for the param on Query Params
         n_trees = req.get_param_as_int('n_trees')
+        index_type = req.get_param('index_type')
+        if index_type is None:
+            index_type = "annoy"
+        if index_type not in index.INDEX_TYPES:
+            raise falcon.HTTPInvalidParam(
+                "Must be one of: " + ", ".join(sorted(index.INDEX_TYPES)),
+                "index_type")
+        index_params = {}
+        for param in ('n_lists', 'nprobe', 'n_subspaces', 'n_components',
+                      'rerank_factor'):
+            value = req.get_param_as_int(param, min=1)
+            if value is not None:
+                index_params[param] = value
+        rerank = req.get_param_as_bool('rerank')
+        if rerank is not None:
+            index_params['rerank'] = rerank
+        projection = req.get_param('projection')
+        if projection is not None:
+            if projection not in index.ReducedIndex.PROJECTIONS:
+                raise falcon.HTTPInvalidParam(
+                    "Must be one of: " +
+                    ", ".join(index.ReducedIndex.PROJECTIONS), "projection")
+            index_params['projection'] = projection
+        inner_type = req.get_param('inner_type')
+        if inner_type is not None:
+            if (inner_type not in index.INDEX_TYPES or
+                    inner_type == index.ReducedIndex.index_type):
+                raise falcon.HTTPInvalidParam(
+                    "Must be an index type other than reduced", "inner_type")
+            index_params['inner_type'] = inner_type
+        # Without n_trees, use the cheapest one that meets the target recall
+        if n_trees is None and index_type == "annoy":
+            dataset_dao = data_access.DatasetDAO()
+            settings = dataset_dao.get_tuned_settings(dataset_dto,
+                                                      current_index=False)
+            if settings is not None:
+                n_trees = settings.get("n_trees")
 
         # Call to the task
-        task = async_tasks.build_search_index.delay(dataset_id, n_trees)
+        task = async_tasks.build_search_index.delay(dataset_id, n_trees,
+                                                    index_type, index_params)
 
         # Create the new task
         task_dao = data_access.TaskDAO()
@@ -142,6 +194,107 @@ class DatasetIndex():
         resp.status = falcon.HTTP_202
 
 
+class DatasetNeighbours():
+    @falcon.before(common_hooks.dataset_trained_status)
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_post(self, req, resp, dataset_id, dataset_dto):
+        """Precomputes the most similar entities of every entity
+
+        Similar entities searches of an entity of the dataset with a limit
+        lower than k are then answered from this table, without searching
+        on the index. This task may take long time to complete, so it uses
+        tasks.
+
+        :query int k: The neighbours stored for each entity. Default is 100
+        :param id dataset_id: The dataset
+        :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
+        """
+        k = req.get_param_as_int('k', min=2)
+
+        # Call to the task
+        task = async_tasks.build_neighbour_table.delay(dataset_id, k=k)
+
+        # Create the new task
+        task_dao = data_access.TaskDAO()
+        task_obj, err = task_dao.add_task_by_uuid(task.id)
+        if task_obj is None:
+            raise falcon.HTTPNotFound(description=str(err))
+        task_obj["next"] = "/datasets/" + dataset_id
+        task_dao.update_task(task_obj)
+
+        msg = "Task {} created successfuly".format(task_obj['id'])
+        textbody = {"status": 202, "message": msg}
+        resp.location = "/tasks/" + str(task_obj['id'])
+        resp.body = json.dumps(textbody)
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_202
+
+
+class DatasetTuning():
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_get(self, req, resp, dataset_id, dataset_dto):
+        """Returns the results of the last tuning of the search index
+
+        Includes the recall vs latency curve, and the settings chosen to
+        meet the target recall.
+
+        :param id dataset_id: The dataset
+        :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
+        """
+        dataset_dao = data_access.DatasetDAO()
+        tuning_results = dataset_dao.get_tuning(dataset_dto)
+        if tuning_results is None:
+            raise falcon.HTTPNotFound(
+                description="The search index of this dataset is not tuned")
+        tuning_results = copy.deepcopy(tuning_results)
+        tuning_results["target_recall"] = \
+            data_access_base._CONFIG_get_target_recall()
+        tuning_results["settings"] = dataset_dao.get_tuned_settings(
+            dataset_dto)
+        resp.body = json.dumps(tuning_results)
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_200
+
+    @falcon.before(common_hooks.dataset_trained_status)
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_post(self, req, resp, dataset_id, dataset_dto):
+        """Measures recall and latency of the search index settings
+
+        This task may take long time to complete, so it uses tasks.
+
+        :query list n_trees: The number of trees of Annoy indexes to test
+        :query list search_k: The search_k values to test
+        :query int k: The number of similar entities searched
+        :query int n_queries: The number of entities used as queries
+        :param id dataset_id: The dataset
+        :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
+        """
+        n_trees = req.get_param_as_list('n_trees', transform=int)
+        search_k = req.get_param_as_list('search_k', transform=int)
+        k = req.get_param_as_int('k', min=1)
+        n_queries = req.get_param_as_int('n_queries', min=1)
+
+        # Call to the task
+        task = async_tasks.tune_search_index.delay(
+            dataset_id, n_trees_list=n_trees, search_k_list=search_k,
+            k=k or 10, n_queries=n_queries or 200)
+
+        # Create the new task
+        task_dao = data_access.TaskDAO()
+        task_obj, err = task_dao.add_task_by_uuid(task.id)
+        if task_obj is None:
+            raise falcon.HTTPNotFound(description=str(err))
+        task_obj["next"] = "/datasets/" + dataset_id + "/tune_index"
+        task_dao.update_task(task_obj)
+
+        msg = "Task {} created successfuly".format(task_obj['id'])
+        textbody = {"status": 202, "message": msg}
+        resp.location = "/tasks/" + str(task_obj['id'])
+        resp.body = json.dumps(textbody)
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_202
+
+
 class AutocompleteIndex():
     @falcon.before(common_hooks.check_dataset_exsistence)
     def on_post(self, req, resp, dataset_id, dataset_dto):
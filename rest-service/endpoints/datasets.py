@@ -21,6 +21,7 @@
 import json
 import copy
 import falcon
+import numpy as np
 import kgeserver.server as server
 import endpoints.common_hooks as common_hooks
 
@@ -84,6 +85,43 @@ def read_vector_from_body(req, resp, resource, params):
         raise falcon.HTTPMissingParam(str(err))
 
 
+def read_byte_range(req, size):
+    """Returns the first and last bytes of the range requested, if any
+
+    :param int size: The size in bytes of the whole resource
+    :returns: A (first, last) tuple, both included, or None
+    :rtype: tuple
+    """
+    if req.range is None:
+        return None
+    first, last = req.range
+    if first < 0:
+        # Suffix range: the last bytes of the resource
+        first, last = max(0, size + first), size - 1
+    elif last < 0 or last >= size:
+        last = size - 1
+    if first > last:
+        raise falcon.HTTPRangeNotSatisfiable(size)
+    return first, last
+
+
+def stream_file(path, start, length, chunk_size=2 ** 20):
+    """Yields the bytes of a part of a file, by chunks
+
+    :param str path: The path of the file
+    :param int start: The position of the first byte
+    :param int length: The number of bytes
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
 class HTTPUserDatasetDTO(object):
     def __init__(self):
         self.name = None
@@ -228,6 +266,101 @@ class DatasetFactory(object):
 
 
 class EmbeddingResource():
+    # Content types of the embeddings
+    FORMATS = {"npy": "application/octet-stream",
+               "binary": "application/octet-stream",
+               "json": "application/json"}
+
+    def check_trained(self, dataset_dto):
+        istrained = dataset_dto.is_trained()
+        if istrained is None or not istrained:
+            raise falcon.HTTPConflict(
+                title="Dataset has not a valid state",
+                description="Dataset {} has a {} state".format(
+                    dataset_dto.id, dataset_dto.status))
+
+    def model_not_found(self, dataset_dto):
+        return falcon.HTTPNotFound(
+            title="The file on database couldn't be located",
+            description=("The model of the dataset {} has been found on "
+                         "database, but it does not exist on filesystem"
+                         ).format(dataset_dto.id))
+
+    def get_embeddings(self, dataset_dto):
+        """Returns the path of the embeddings file of a trained dataset"""
+        self.check_trained(dataset_dto)
+        embeddings_path = data_access.DatasetDAO().get_embeddings_file(
+            dataset_dto)
+        if embeddings_path is None:
+            raise self.model_not_found(dataset_dto)
+        return embeddings_path
+
+    def get_embedding_store(self, dataset_dto):
+        """Returns the embeddings of the model of a trained dataset"""
+        self.check_trained(dataset_dto)
+        store = data_access.DatasetDAO().get_embedding_store(dataset_dto)
+        if store is None:
+            raise self.model_not_found(dataset_dto)
+        return store
+
+    def read_format(self, req, default):
+        matrix_format = req.get_param("format") or default
+        if matrix_format not in self.FORMATS:
+            raise falcon.HTTPInvalidParam(
+                "Must be one of {}".format(", ".join(sorted(self.FORMATS))),
+                "format")
+        return matrix_format
+
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_get(self, req, resp, dataset_id, dataset_dto):
+        """Exports the embeddings of all entities
+
+        The row i of the matrix is the embedding of the entity with id i.
+        The matrix is stored as little-endian float32 and streamed from
+        disk, and HTTP Range requests are supported, so big matrices can be
+        downloaded by parts.
+
+        :param integer dataset_id: Unique ID of dataset
+        :param integer dataset_dto: Dataset DTO (from hook)
+        :query str format: npy (default) returns a NumPy .npy file, binary
+                           returns only the raw float32 values
+        :returns: The embeddings matrix
+        """
+        matrix_format = self.read_format(req, "npy")
+        if matrix_format == "json":
+            raise falcon.HTTPInvalidParam(
+                "Must be npy or binary. Use POST to get embeddings as JSON",
+                "format")
+        embeddings_path = self.get_embeddings(dataset_dto)
+
+        with open(embeddings_path, "rb") as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+            data_offset = f.tell()
+            f.seek(0, 2)
+            file_size = f.tell()
+
+        offset = data_offset if matrix_format == "binary" else 0
+        size = file_size - offset
+        byte_range = read_byte_range(req, size)
+        if byte_range is None:
+            first, last = 0, size - 1
+            resp.status = falcon.HTTP_200
+        else:
+            first, last = byte_range
+            resp.content_range = (first, last, size)
+            resp.status = falcon.HTTP_206
+
+        resp.accept_ranges = "bytes"
+        resp.content_type = self.FORMATS[matrix_format]
+        resp.set_header("X-Embeddings-Shape",
+                        ",".join(str(value) for value in shape))
+        resp.set_header("X-Embeddings-Dtype", dtype.str)
+        resp.set_stream(stream_file(embeddings_path, offset + first,
+                                    last - first + 1), last - first + 1)
 
     @falcon.before(read_vector_from_body)
     @falcon.before(common_hooks.check_dataset_exsistence)
@@ -236,31 +369,53 @@ class EmbeddingResource():
 
         {"entities": ["Q1492", "Q2807", "Q1"]}
 
+        With format=binary, the embeddings are returned as a raw
+        little-endian float32 matrix, one row for each entity of the
+        request, in the same order. Rows of unknown entities are NaN.
+
         :param integer dataset_id: Unique ID of dataset
         :param integer dataset_dto: Dataset DTO (from hook)
         :param list entities: List of entities to get embeddings (from hook)
+        :query str format: json (default) or binary
         :returns: A list of list with entities and its embeddings
         :rtype: list
         """
+        matrix_format = self.read_format(req, "json")
+        if matrix_format == "npy":
+            raise falcon.HTTPInvalidParam(
+                "Must be json or binary. Use GET to get a .npy file",
+                "format")
+        store = self.get_embedding_store(dataset_dto)
 
-        istrained = dataset_dto.is_trained()
-        if istrained is None or not istrained:
-            raise falcon.HTTPConflict(
-                title="Dataset has not a valid state",
-                description="Dataset {} has a {} state".format(
-                    dataset_id, dataset_dto.status))
-
-        try:
-            result = async_tasks.find_embeddings_on_model(dataset_id, entities)
-        except OSError as err:
-            filerr = err.filename
+        dataset = data_access.DatasetDAO().build_vocabulary_object(
+            dataset_dto)
+        if dataset is None:
             raise falcon.HTTPNotFound(
-                title="The file on database couldn't be located",
-                description=("A file ({}) has been found on database, but it "
-                             "does not exist on filesystem").format(filerr))
-
-        textbody = {"embeddings": result}
-        resp.body = json.dumps(textbody)
+                description="The binary dataset file can't be found")
+        ids = [dataset.get_entity_id(entity) for entity in entities]
+        found = np.array([entity_id is not None for entity_id in ids],
+                         dtype=bool)
+        ids = np.array([entity_id if entity_id is not None else 0
+                        for entity_id in ids], dtype=np.int64)
+        # Entities added after training have no embedding yet
+        found &= ids < store.n_entities
+
+        if matrix_format == "binary":
+            matrix = np.full((len(ids), store.dimension), np.nan,
+                             dtype='<f4')
+            matrix[found] = store.entities(ids[found])
+            resp.data = matrix.tobytes()
+            resp.set_header("X-Embeddings-Shape",
+                            ",".join(str(value) for value in matrix.shape))
+            resp.set_header("X-Embeddings-Dtype", matrix.dtype.str)
+        else:
+            vectors = store.entities(ids[found]).tolist()
+            found_entities = [entity for entity, is_found
+                              in zip(entities, found.tolist()) if is_found]
+            textbody = {"embeddings": [list(pair) for pair
+                                       in zip(found_entities, vectors)]}
+            resp.body = json.dumps(textbody)
+        resp.content_type = self.FORMATS[matrix_format]
         resp.status = falcon.HTTP_200
 
 
@@ -297,6 +452,11 @@ class TriplesResource():
         if res is None:
             raise falcon.HTTPBadRequest(description=str(err))
 
+        # New entities of an indexed dataset (status 0b0100) are served
+        # from a delta index until the dataset is trained and indexed again
+        if dataset_dto.status & 0b0100:
+            async_tasks.update_index_delta.delay(dataset_id)
+
         textbody = {"status": 202, "message": "Resources created successfuly"}
         resp.body = json.dumps(textbody)
         resp.content_type = 'application/json'
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# endpoints/status.py: Falcon file to report the status of the service
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import falcon
+
+# Import parent directory (data_access)
+import sys
+sys.path.insert(0, '..')
+try:
+    import data_access.cache as cache
+except ImportError:
+    raise
+
+
+class StatusResource():
+    def on_get(self, req, resp):
+        """Returns whether the service is ready to answer requests
+
+        While the datasets are being preloaded, the response has a 503
+        status code, so it can be used as a readiness probe.
+
+        :returns: The warm-up state, the datasets loaded by this process and
+                  the hit ratio of the similar entities cache
+        :rtype: dict
+        """
+        # Shared by all workers, as the warm-up is made before forking them
+        warm_up = cache.read_warm_up()
+        status = {
+            "ready": warm_up["ready"],
+            "warm_up": warm_up,
+            "loaded": {
+                "servers": cache.servers.names(),
+                "vocabularies": cache.vocabularies.names(),
+                "suggest_indexes": cache.suggest_indexes.names(),
+                "neighbour_tables": cache.neighbour_tables.names(),
+                "embedding_stores": cache.embedding_stores.names(),
+                "predictors": cache.predictors.names(),
+                "delta_indexes": cache.delta_indexes.names()
+            },
+            "similarity_cache": cache.results.stats()
+        }
+
+        resp.body = json.dumps(status)
+        resp.content_type = 'application/json'
+        if warm_up["ready"]:
+            resp.status = falcon.HTTP_200
+        else:
+            resp.status = falcon.HTTP_503
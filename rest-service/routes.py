@@ -23,6 +23,8 @@ import copy
 import falcon
 from falcon_cors import CORS
 import data_access
+import data_access.cache as cache
+import data_access.data_access_base as data_access_base
 import kgeserver.server as server
 import async_server.tasks as async_tasks
 import async_server.celery as celery_server
@@ -35,12 +37,19 @@ from endpoints.datasets import (DatasetFactory,
 from endpoints.dataset_tasks import (GenerateTriplesResource,
                                      AutocompleteIndex,
                                      DatasetIndex,
+                                     DatasetNeighbours,
+                                     DatasetTuning,
                                      DatasetTrain)
 from endpoints.dataset_prediction import (PredictSimilarEntitiesResource,
+                                          BatchSimilarEntitiesResource,
                                           DistanceTriples,
+                                          DistanceMatrix,
+                                          LinkPredictionResource,
+                                          ScoreTriplesResource,
                                           SuggestEntityName)
 from endpoints.algorithms import AlgorithmFactory, AlgorithmResource
 from endpoints.tasks import TasksResource
+from endpoints.status import StatusResource
 
 # CORS
 cors = CORS(allow_all_origins=True, allow_all_headers=True,
@@ -53,14 +62,21 @@ app = falcon.API(middleware=[cors.middleware])
 dataset = DatasetResource()
 datasetcreate = DatasetFactory()
 similar_entities = PredictSimilarEntitiesResource()
+batch_similar_entities = BatchSimilarEntitiesResource()
 triples = TriplesResource()
 gentriples = GenerateTriplesResource()
 triples_distance = DistanceTriples()
+distance_matrix = DistanceMatrix()
+link_prediction = LinkPredictionResource()
+score_triples = ScoreTriplesResource()
 dataset_train = DatasetTrain()
 dataset_index = DatasetIndex()
+dataset_neighbours = DatasetNeighbours()
+dataset_tuning = DatasetTuning()
 dataset_embedding = EmbeddingResource()
 autocompleteIndex = AutocompleteIndex()
 task_resource = TasksResource()
+status_resource = StatusResource()
 suggest_name = SuggestEntityName()
 
 algorithm_resource = AlgorithmResource()
@@ -72,11 +88,19 @@ app.add_route('/datasets/{dataset_id}', dataset)
 app.add_route('/datasets/{dataset_id}/triples', triples)
 app.add_route('/datasets/{dataset_id}/generate_triples', gentriples)
 app.add_route('/datasets/{dataset_id}/distance', triples_distance)
+app.add_route('/datasets/{dataset_id}/distance_matrix', distance_matrix)
+app.add_route('/datasets/{dataset_id}/predict', link_prediction)
+app.add_route('/datasets/{dataset_id}/score', score_triples)
 app.add_route('/datasets/{dataset_id}/similar_entities/{entity}',
               similar_entities)
 app.add_route('/datasets/{dataset_id}/similar_entities', similar_entities)
+app.add_route('/datasets/{dataset_id}/batch_similar_entities',
+              batch_similar_entities)
 app.add_route('/datasets/{dataset_id}/train', dataset_train)
 app.add_route('/datasets/{dataset_id}/generate_index', dataset_index)
+app.add_route('/datasets/{dataset_id}/generate_neighbours',
+              dataset_neighbours)
+app.add_route('/datasets/{dataset_id}/tune_index', dataset_tuning)
 app.add_route('/datasets/{dataset_id}/embeddings', dataset_embedding)
 app.add_route('/datasets/{dataset_id}/generate_autocomplete_index',
               autocompleteIndex)
@@ -85,5 +109,22 @@ app.add_route('/datasets/{dataset_id}/suggest_name', suggest_name)
 
 app.add_route('/tasks/{task_id}', task_resource)
 
+app.add_route('/status', status_resource)
+
 app.add_route('/algorithms/{algorithm_id}', algorithm_resource)
 app.add_route('/algorithms/', algorithm_factory)
+
+
+# Load all datasets before serving any request. gunicorn is launched with
+# --preload, so this is done only once, before forking the workers, and all
+# of them share the loaded pages. The state is written on a file, so every
+# worker reports the same one on /status
+if data_access_base._CONFIG_get_preload_indexes():
+    cache.start_warm_up()
+    preloaded, preload_errors = data_access.DatasetDAO().preload_datasets(
+        progress=cache.update_warm_up)
+    for error in preload_errors:
+        logging.warning("Preload: %s", error)
+    cache.finish_warm_up(preloaded, preload_errors)
+else:
+    cache.clear_warm_up()